@@ -0,0 +1,60 @@
+
+import timeit
+from optparse import OptionParser
+from katcp import Message
+from katcp.kattypes import (request, return_reply, Int, Float, Bool,
+                            Discrete, Str, Parameter, FailReply,
+                            DEFAULT_KATCP_MAJOR)
+
+TYPES = (Int(min=0, max=1000), Float(), Bool(), Discrete(('on', 'off')))
+REPLY_TYPES = (Int(), Float())
+MSG = Message.request('configure', '10', '2.5', '1', 'on')
+
+# The argument handling of the decorators before codecs were compiled,
+# kept here to compare against.
+
+def legacy_unpack_types(types, args, argnames, major):
+    multiple = types[-1]._multiple if types else False
+    if len(types) < len(args) and not multiple:
+        raise FailReply("Too many parameters given.")
+    params = []
+    for i, kattype in enumerate(types):
+        name = argnames[i] if i < len(argnames) else ""
+        params.append(Parameter(i + 1, name, kattype, major))
+    return map(lambda param, arg: param.unpack(arg), params, args)
+
+def legacy_pack_types(types, args, major):
+    return [ktype.pack(arg, major=major) for ktype, arg in zip(types, args)]
+
+def legacy_handler(msg):
+    level, gain, enabled, mode = legacy_unpack_types(
+        TYPES, msg.arguments, ['level', 'gain', 'enabled', 'mode'],
+        DEFAULT_KATCP_MAJOR)
+    return Message.reply('configure', *legacy_pack_types(
+        (Str(),) + REPLY_TYPES, ('ok', level + 1, gain * 2),
+        DEFAULT_KATCP_MAJOR))
+
+class Device(object):
+    @request(*TYPES)
+    @return_reply(*REPLY_TYPES)
+    def request_configure(self, req, level, gain, enabled, mode):
+        return ('ok', level + 1, gain * 2)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--number', dest='number', type=int, default=100000)
+    options, args = parser.parse_args()
+    device = Device()
+    assert str(legacy_handler(MSG)) == \
+        str(device.request_configure(None, MSG))
+    legacy = min(timeit.repeat(lambda: legacy_handler(MSG), repeat=3,
+                               number=options.number))
+    compiled = min(timeit.repeat(
+        lambda: device.request_configure(None, MSG), repeat=3,
+        number=options.number))
+    print "LEGACY: %.2f us, COMPILED: %.2f us, SPEEDUP: %.2f" % (
+        1e6 * legacy / options.number, 1e6 * compiled / options.number,
+        legacy / compiled)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+
+import time, resource
+from optparse import OptionParser
+from katcp import DeviceServer, Sensor
+
+class StartupServer(DeviceServer):
+    VERSION_INFO = ("startup-bench", 0, 1)
+    BUILD_INFO = ("startup-bench", 0, 1, "")
+
+    def __init__(self, no_of_sensors):
+        self.no_of_sensors = no_of_sensors
+        DeviceServer.__init__(self, 'localhost', 0)
+
+    def setup_sensors(self):
+        for i in xrange(self.no_of_sensors):
+            if i % 2:
+                sensor = Sensor.float('float_sensor%d' % i, unit='V',
+                                      params=[0.0, 5.0])
+            else:
+                sensor = Sensor.integer('int_sensor%d' % i, unit='count',
+                                        params=[-10, 10])
+            self.add_sensor(sensor)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--sensors', dest='sensors', type=int, default=100000)
+    options, args = parser.parse_args()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    server = StartupServer(options.sensors)
+    elapsed = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "SENSORS: %d, TIME: %.3f s, PER SENSOR: %.1f us, MEMORY: %d kB" % (
+        len(server._sensors), elapsed, 1e6 * elapsed / options.sensors,
+        rss_after - rss_before)
+
+if __name__ == '__main__':
+    main()
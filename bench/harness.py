@@ -0,0 +1,805 @@
+#!/usr/bin/env python
+
+""" A self-contained benchmark harness for the threaded and twisted katcp
+stacks.
+
+All servers and clients run in this process and talk over localhost, so
+results can be reproduced on a single machine (or a CI runner). Results
+can be written to a JSON file and compared with an earlier run::
+
+  python harness.py --output base.json
+  python harness.py --compare base.json --threshold 0.2
+
+The comparison exits with a non-zero status if any metric got worse by
+more than the threshold.
+"""
+
+import gc
+import json
+import platform
+import sys
+import threading
+import time
+import timeit
+from optparse import OptionParser
+
+from katcp import (DeviceServer, BlockingClient, Message, MessageParser,
+                   Sensor)
+from katcp.sampling import SampleReactor, SamplePeriod
+from katcp.version import VERSION_STR
+
+# metric directions
+HIGHER, LOWER = 'higher', 'lower'
+
+SENSOR_STATUS = Message.inform('sensor-status', '1234567890.123', '1',
+                               'rack1.device1.temperature', 'nominal',
+                               '23.125000')
+SENSOR_LINE = str(SENSOR_STATUS)
+
+
+def rate(value, unit):
+    return {'value': value, 'unit': unit, 'better': HIGHER}
+
+
+def latency(value, unit='us'):
+    return {'value': value, 'unit': unit, 'better': LOWER}
+
+
+def percentile(ordered, fraction):
+    """Return the given fraction percentile of a sorted list."""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+def latency_metrics(durations, elapsed):
+    """Summarise a list of round trip times in seconds."""
+    durations = sorted(durations)
+    metrics = {'requests_per_sec': rate(len(durations) / elapsed, 'req/s')}
+    for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+        metrics['rtt_' + name] = latency(
+            1e6 * percentile(durations, fraction))
+    metrics['rtt_max'] = latency(1e6 * durations[-1])
+    return metrics
+
+
+def best_rate(func, number, repeat=3):
+    """Return the best calls per second of func over a few repeats."""
+    return number / min(timeit.repeat(func, repeat=repeat, number=number))
+
+
+def parse_size(text):
+    """Parse a size in bytes with an optional k or M suffix."""
+    multiplier = {'k': 2 ** 10, 'M': 2 ** 20}.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return int(text) * multiplier
+
+
+def size_label(size):
+    for suffix, multiplier in [('M', 2 ** 20), ('k', 2 ** 10)]:
+        if size >= multiplier and size % multiplier == 0:
+            return '%d%s' % (size // multiplier, suffix)
+    return '%d' % size
+
+
+# the largest line katcp.tx accepts, the threaded server is configured to
+# match for the echo scenarios
+ECHO_MAX_LENGTH = 64 * 2 ** 20
+# room for the message name, id and separators around an echoed argument
+ECHO_OVERHEAD = 64
+
+
+def echo_payload(size):
+    # arguments at the line length limit are shortened to fit
+    return 'x' * min(size, ECHO_MAX_LENGTH - ECHO_OVERHEAD)
+
+
+def echo_count(size, options):
+    """Number of echo requests to send for a given argument size."""
+    return max(options.echo_min_requests,
+               min(options.requests, options.echo_bytes // size))
+
+
+def echo_metrics(size, rtt):
+    """Pick the echo metrics for one argument size out of rtt."""
+    prefix = size_label(size) + '_'
+    requests_per_sec = rtt['requests_per_sec']['value']
+    return {
+        prefix + 'requests_per_sec': rtt['requests_per_sec'],
+        prefix + 'mb_per_sec': rate(
+            requests_per_sec * len(echo_payload(size)) / 2 ** 20, 'MB/s'),
+        prefix + 'rtt_p50': rtt['rtt_p50'],
+    }
+
+
+# Message level scenarios
+
+def bench_parser(options):
+    parser = MessageParser()
+    parse = parser.parse
+    request_line = '?sensor-sampling[12] rack1.device1.temperature period 1'
+    return {
+        'sensor_status_per_sec': rate(best_rate(
+            lambda: parse(SENSOR_LINE), options.number), 'msg/s'),
+        'request_per_sec': rate(best_rate(
+            lambda: parse(request_line), options.number), 'msg/s'),
+        'escaped_per_sec': rate(best_rate(
+            lambda: parse(r'#log info 1234.5 root a\_message\_with\_spaces'),
+            options.number), 'msg/s'),
+    }
+
+
+def bench_serialize(options):
+    reply = Message.reply('sensor-value', 'ok', '1', mid='12')
+    escaped = Message.inform('log', 'info', '1234.5', 'root',
+                             'a message with spaces\nand a newline')
+    return {
+        'sensor_status_per_sec': rate(best_rate(
+            lambda: str(SENSOR_STATUS), options.number), 'msg/s'),
+        'reply_per_sec': rate(best_rate(
+            lambda: str(reply), options.number), 'msg/s'),
+        'escaped_per_sec': rate(best_rate(
+            lambda: str(escaped), options.number), 'msg/s'),
+    }
+
+
+def reactor_window(options):
+    """Return the number of whole periods to count reactor samples over and
+    the length of that window in seconds.
+    """
+    periods = max(1, int(round(options.duration / options.period)))
+    return periods, periods * options.period
+
+
+def reactor_metrics(count, setup, delivered, periods, options, lateness):
+    """Summarise one run of count periodic strategies."""
+    window = periods * options.period
+    prefix = '%d_' % count
+    results = {
+        prefix + 'setup': latency(setup, 's'),
+        prefix + 'samples_per_sec': rate(delivered / window, 'samples/s'),
+        prefix + 'demand_met': rate(
+            delivered / float(periods * count), 'ratio'),
+    }
+    if lateness is not None and lateness.count:
+        results[prefix + 'lateness_p50'] = latency(
+            1e3 * lateness.percentile(0.5), 'ms')
+        results[prefix + 'lateness_p99'] = latency(
+            1e3 * lateness.percentile(0.99), 'ms')
+    return results
+
+
+def bench_reactor(options):
+    results = {}
+    sensor = Sensor(Sensor.INTEGER, 'bench.int', 'A benchmark sensor.',
+                    'count', [0, 1000])
+    for count in options.strategies:
+        samples = [0]
+
+        def inform(name, timestamp, status, value):
+            samples[0] += 1
+
+        reactor = SampleReactor()
+        start = time.time()
+        strategies = [SamplePeriod(inform, sensor, options.period)
+                      for _ in xrange(count)]
+        for strategy in strategies:
+            reactor.add_strategy(strategy)
+        setup = time.time() - start
+        reactor.start()
+        # skip the first period, in which the samples are still spread out
+        # over the time it took to add the strategies, then count over whole
+        # periods starting half way between two bursts so that no burst is
+        # split by the edges of the window
+        periods, window = reactor_window(options)
+        time.sleep(1.5 * options.period)
+        samples[0] = 0
+        time.sleep(window)
+        delivered = samples[0]
+        reactor.stop()
+        reactor.join(timeout=10.0)
+        results.update(reactor_metrics(
+            count, setup, delivered, periods, options,
+            reactor.lateness.get('period')))
+        for strategy in strategies:
+            strategy.detach()
+        del strategies
+        gc.collect()
+    return results
+
+
+# Threaded stack scenarios
+
+class BenchServer(DeviceServer):
+    def setup_sensors(self):
+        self.bench_sensor = Sensor(Sensor.INTEGER, 'bench.int',
+                                   'A benchmark sensor.', 'count',
+                                   [0, 1000000])
+        self.add_sensor(self.bench_sensor)
+
+    def request_echo(self, req, msg):
+        """Reply with the arguments of the request."""
+        return Message.reply('echo', 'ok', *msg.arguments)
+
+
+class FanoutClient(BlockingClient):
+    def __init__(self, *args, **kwargs):
+        super(FanoutClient, self).__init__(*args, **kwargs)
+        self.received = 0
+        self.expected = None
+        self.done = threading.Event()
+
+    def inform_sensor_status(self, msg):
+        """Count sensor updates."""
+        self.received += 1
+        if self.received == self.expected:
+            self.done.set()
+
+
+def start_threaded_server():
+    server = BenchServer('127.0.0.1', 0)
+    server.start(timeout=5.0)
+    server.wait_running(timeout=5.0)
+    # the bound address is only known once the server thread has bound
+    while server._bindaddr[1] == 0:
+        time.sleep(0.01)
+    return server
+
+
+def start_threaded_client(server, client_class=BlockingClient):
+    client = client_class(*server._bindaddr, timeout=10.0)
+    client.start(timeout=5.0)
+    client.wait_protocol(timeout=5.0)
+    return client
+
+
+def bench_threaded_rtt(options):
+    server = start_threaded_server()
+    client = start_threaded_client(server)
+    try:
+        durations = []
+        watchdog = Message.request('watchdog')
+        start = time.time()
+        for _ in xrange(options.requests):
+            t0 = time.time()
+            client.blocking_request(watchdog)
+            durations.append(time.time() - t0)
+        return latency_metrics(durations, time.time() - start)
+    finally:
+        client.stop()
+        client.join()
+        server.stop()
+        server.join()
+
+
+def bench_threaded_echo(options):
+    server = start_threaded_server()
+    server.MAX_LINE_LENGTH = ECHO_MAX_LENGTH
+    client = start_threaded_client(server)
+    try:
+        results = {}
+        for size in options.echo_sizes:
+            msg = Message.request('echo', echo_payload(size))
+            durations = []
+            start = time.time()
+            for _ in xrange(echo_count(size, options)):
+                t0 = time.time()
+                reply, informs = client.blocking_request(msg, timeout=600.0)
+                if not reply.reply_ok():
+                    raise RuntimeError("Echo of %d bytes failed: %s" %
+                                       (size, reply.arguments[:2]))
+                durations.append(time.time() - t0)
+            results.update(echo_metrics(size, latency_metrics(
+                durations, time.time() - start)))
+        return results
+    finally:
+        client.stop()
+        client.join()
+        server.stop()
+        server.join()
+
+
+def bench_threaded_fanout(options):
+    server = start_threaded_server()
+    clients = [start_threaded_client(server, FanoutClient)
+               for _ in xrange(options.clients)]
+    try:
+        for client in clients:
+            client.blocking_request(Message.request(
+                'sensor-sampling', 'bench.int', 'event'))
+            # the current value is sent when the strategy is set
+            client.expected = client.received + options.updates
+        start = time.time()
+        for value in xrange(1, options.updates + 1):
+            server.bench_sensor.set_value(value)
+        for client in clients:
+            client.done.wait(timeout=60.0)
+        elapsed = time.time() - start
+        delivered = sum(client.received for client in clients)
+        return {'updates_per_sec': rate(delivered / elapsed, 'informs/s')}
+    finally:
+        for client in clients:
+            client.stop()
+            client.join()
+        server.stop()
+        server.join()
+
+
+# Twisted stack scenarios, these all run within a single reactor.run()
+
+def tx_connect(port, protocol_class=None):
+    from twisted.internet import reactor
+    from twisted.internet.protocol import ClientCreator
+    from katcp.tx.core import ClientKatCPProtocol
+    cc = ClientCreator(reactor, protocol_class or ClientKatCPProtocol)
+    return cc.connectTCP('127.0.0.1', port)
+
+
+def tx_serial_requests(protocol, request, count):
+    """Send count requests one after the other and fire the returned
+    deferred with the latency metrics.
+    """
+    from twisted.internet.defer import Deferred
+    finished = Deferred()
+    durations = []
+    state = {'start': time.time()}
+
+    def send(_=None):
+        if len(durations) == count:
+            finished.callback(latency_metrics(
+                durations, time.time() - state['start']))
+            return
+        state['t0'] = time.time()
+        protocol.send_request(*request).addCallbacks(
+            received, finished.errback)
+
+    def received((informs, reply)):
+        durations.append(time.time() - state['t0'])
+        if not reply.reply_ok():
+            raise RuntimeError("Request failed: %s" % reply)
+        send()
+
+    send()
+    return finished
+
+
+def tx_bench_server():
+    from katcp.tx.core import DeviceServer as TxDeviceServer, DeviceProtocol
+
+    class TxBenchProtocol(DeviceProtocol):
+        def request_echo(self, msg):
+            """Reply with the arguments of the request."""
+            return Message.reply('echo', 'ok', *msg.arguments)
+
+    class TxBenchServer(TxDeviceServer):
+        protocol = TxBenchProtocol
+
+        def setup_sensors(self):
+            self.bench_sensor = Sensor(Sensor.INTEGER, 'bench.int',
+                                       'A benchmark sensor.', 'count',
+                                       [0, 1000000])
+            self.add_sensor(self.bench_sensor)
+
+    server = TxBenchServer(0, '127.0.0.1')
+    server.start()
+    return server
+
+
+def bench_tx_reactor(options):
+    from twisted.internet import reactor
+    from twisted.internet.defer import Deferred
+    from katcp.tx.sampling import TwistedSampleReactor
+
+    sensor = Sensor(Sensor.INTEGER, 'bench.int', 'A benchmark sensor.',
+                    'count', [0, 1000])
+    counts = list(options.strategies)
+    periods, window = reactor_window(options)
+    results = {}
+
+    def next_count(_=None):
+        if not counts:
+            return results
+        count = counts.pop(0)
+        samples = [0]
+
+        def inform(name, timestamp, status, value):
+            samples[0] += 1
+
+        sample_reactor = TwistedSampleReactor(reactor=reactor)
+        start = time.time()
+        strategies = [SamplePeriod(inform, sensor, options.period)
+                      for _ in xrange(count)]
+        for strategy in strategies:
+            sample_reactor.add_strategy(strategy)
+        setup = time.time() - start
+        finished = Deferred()
+
+        # the same window as the threaded reactor scenario
+        def begin():
+            samples[0] = 0
+            reactor.callLater(window, end)
+
+        def end():
+            delivered = samples[0]
+            sample_reactor.stop()
+            results.update(reactor_metrics(
+                count, setup, delivered, periods, options,
+                sample_reactor.lateness.get('period')))
+            for strategy in strategies:
+                strategy.detach()
+            del strategies[:]
+            gc.collect()
+            finished.callback(None)
+
+        reactor.callLater(1.5 * options.period, begin)
+        return finished.addCallback(next_count)
+
+    return next_count()
+
+
+def bench_tx_rtt(options):
+    server = tx_bench_server()
+
+    def connected(protocol):
+        d = tx_serial_requests(protocol, ('watchdog',), options.requests)
+        d.addBoth(finish, protocol)
+        return d
+
+    def finish(result, protocol):
+        protocol.transport.loseConnection()
+        server.stop()
+        return result
+
+    return tx_connect(server.port.getHost().port).addCallback(connected)
+
+
+def bench_tx_echo(options):
+    server = tx_bench_server()
+    sizes = list(options.echo_sizes)
+    results = {}
+    state = {}
+
+    def connected(protocol):
+        state['client'] = protocol
+        return next_size(None, protocol)
+
+    def next_size(_, protocol):
+        if not sizes:
+            return results
+        size = sizes.pop(0)
+        d = tx_serial_requests(protocol, ('echo', echo_payload(size)),
+                               echo_count(size, options))
+        d.addCallback(store, size)
+        return d.addCallback(next_size, protocol)
+
+    def store(metrics, size):
+        results.update(echo_metrics(size, metrics))
+
+    def finish(result):
+        if 'client' in state:
+            state['client'].transport.loseConnection()
+        server.stop()
+        return result
+
+    d = tx_connect(server.port.getHost().port).addCallback(connected)
+    return d.addBoth(finish)
+
+
+def bench_tx_fanout(options):
+    from twisted.internet.defer import Deferred, DeferredList
+    from katcp.tx.core import ClientKatCPProtocol
+
+    class TxFanoutClient(ClientKatCPProtocol):
+        received = 0
+        expected = None
+        done = None
+
+        def inform_sensor_status(self, msg):
+            self.received += 1
+            if self.received == self.expected:
+                self.done.callback(None)
+
+    server = tx_bench_server()
+    port = server.port.getHost().port
+    state = {}
+
+    def connected(protocols):
+        state['clients'] = clients = [protocol for _, protocol in protocols]
+        return DeferredList([client.send_request(
+            'sensor-sampling', 'bench.int', 'event') for client in clients],
+            fireOnOneErrback=True).addCallback(subscribed)
+
+    def subscribed(_):
+        clients = state['clients']
+        for client in clients:
+            client.expected = client.received + options.updates
+            client.done = Deferred()
+        done = DeferredList([client.done for client in clients])
+        start = time.time()
+        for value in xrange(1, options.updates + 1):
+            server.bench_sensor.set_value(value)
+        return done.addCallback(finished, start)
+
+    def finished(_, start):
+        elapsed = time.time() - start
+        delivered = sum(client.received for client in state['clients'])
+        return {'updates_per_sec': rate(delivered / elapsed, 'informs/s')}
+
+    def cleanup(result):
+        for client in state.get('clients', []):
+            client.transport.loseConnection()
+        server.stop()
+        return result
+
+    connecting = [tx_connect(port, TxFanoutClient)
+                  for _ in xrange(options.clients)]
+    d = DeferredList(connecting, fireOnOneErrback=True)
+    return d.addCallback(connected).addBoth(cleanup)
+
+
+def bench_tx_proxy(options):
+    from twisted.internet.defer import Deferred
+    from katcp.tx.proxy import ProxyKatCP, DeviceHandler
+
+    device = tx_bench_server()
+    scanned = Deferred()
+
+    class BenchProxy(ProxyKatCP):
+        def setup_devices(self):
+            self.add_device(DeviceHandler(
+                'bench', '127.0.0.1', device.port.getHost().port))
+
+        def devices_scan_complete(self):
+            scanned.callback(None)
+
+    proxy = BenchProxy(0, '127.0.0.1')
+    proxy.start()
+    state = {}
+
+    def ready(_):
+        return tx_connect(proxy.port.getHost().port).addCallback(connected)
+
+    def connected(protocol):
+        state['client'] = protocol
+        d = tx_serial_requests(protocol, ('bench-watchdog',),
+                               options.requests)
+        return d.addCallback(forwarded)
+
+    def forwarded(results):
+        state['results'] = results
+        return tx_serial_requests(state['client'],
+                                  ('sensor-value', 'bench.bench.int'),
+                                  options.requests).addCallback(read)
+
+    def read(results):
+        metrics = dict(('forward_' + name, value)
+                       for name, value in state['results'].items())
+        metrics.update(('sensor_value_' + name, value)
+                       for name, value in results.items())
+        return metrics
+
+    def cleanup(result):
+        if 'client' in state:
+            state['client'].transport.loseConnection()
+        proxy.stop()
+        device.stop()
+        return result
+
+    return scanned.addCallback(ready).addBoth(cleanup)
+
+
+SCENARIOS = [
+    ('parser', bench_parser, False),
+    ('serialize', bench_serialize, False),
+    ('reactor', bench_reactor, False),
+    ('threaded-rtt', bench_threaded_rtt, False),
+    ('threaded-fanout', bench_threaded_fanout, False),
+    ('threaded-echo', bench_threaded_echo, False),
+    ('tx-reactor', bench_tx_reactor, True),
+    ('tx-rtt', bench_tx_rtt, True),
+    ('tx-fanout', bench_tx_fanout, True),
+    ('tx-echo', bench_tx_echo, True),
+    ('tx-proxy', bench_tx_proxy, True),
+]
+
+
+def run_tx_scenarios(scenarios, options, results):
+    """Run the twisted scenarios one after the other in a single reactor."""
+    from twisted.internet import reactor
+    pending = list(scenarios)
+
+    def next_scenario(_=None):
+        if not pending:
+            reactor.stop()
+            return
+        name, func = pending.pop(0)
+        report_start(name)
+        d = func(options)
+        d.addCallback(store, name)
+        d.addErrback(failed, name)
+        d.addCallback(lambda _: reactor.callLater(0.1, next_scenario))
+
+    def store(metrics, name):
+        results[name] = metrics
+        report(name, metrics)
+
+    def failed(failure, name):
+        print "  FAILED: %s" % failure.getErrorMessage()
+        results[name] = {'error': failure.getErrorMessage()}
+
+    reactor.callWhenRunning(next_scenario)
+    reactor.run()
+
+
+def report_start(name):
+    print "%s:" % name
+    sys.stdout.flush()
+
+
+def report(name, metrics):
+    for metric in sorted(metrics):
+        print "  %-32s %14.3f %s" % (metric, metrics[metric]['value'],
+                                     metrics[metric]['unit'])
+    sys.stdout.flush()
+
+
+# options that do not change the measured values
+COMPARE_IGNORED_OPTIONS = ('scenarios', 'threshold')
+
+
+def compare(output, baseline, threshold):
+    """Compare a run with a baseline run and return the regressions.
+
+    Both runs are dicts with the 'meta' and 'results' written by --output.
+    A metric regresses when it moved in its bad direction by more than
+    the threshold fraction of the baseline value. Differences in the
+    options of the two runs are reported first, since the metrics of runs
+    of different sizes are not comparable.
+    """
+    options = output['meta']['options']
+    baseline_options = baseline.get('meta', {}).get('options', {})
+    for key in sorted(set(options) | set(baseline_options)):
+        if key in COMPARE_IGNORED_OPTIONS:
+            continue
+        if options.get(key) != baseline_options.get(key):
+            print "WARNING: option %s is %r but was %r in the baseline" % (
+                key, options.get(key), baseline_options.get(key))
+    results = output['results']
+    baseline = baseline['results']
+    regressions = []
+    print "\nComparison with baseline (threshold %.0f%%):" % (100 * threshold)
+    for name in sorted(results):
+        for metric in sorted(results[name]):
+            new = results[name][metric]
+            old = baseline.get(name, {}).get(metric)
+            if not isinstance(new, dict) or not isinstance(old, dict):
+                continue
+            if not old['value']:
+                continue
+            change = (new['value'] - old['value']) / float(abs(old['value']))
+            worse = -change if new['better'] == HIGHER else change
+            flag = ''
+            if worse > threshold:
+                flag = 'REGRESSION'
+                regressions.append((name, metric, change))
+            elif -worse > threshold:
+                flag = 'improved'
+            print "  %-48s %+8.1f%% %s" % ('%s.%s' % (name, metric),
+                                           100 * change, flag)
+    return regressions
+
+
+# (full, --quick) defaults of the options which set the size of a run
+SIZE_DEFAULTS = {
+    'number': (100000, 2000),
+    'requests': (5000, 200),
+    'clients': (8, 2),
+    'updates': (5000, 200),
+    'strategies': ('10000,100000', '1000'),
+    'duration': (5.0, 1.0),
+    'echo_sizes': ('10,100,1k,16k,256k,1M,16M,64M', '10,1k,64k,1M'),
+    'echo_bytes': (64 * 2 ** 20, 4 * 2 ** 20),
+}
+
+
+def size_help(text, dest):
+    full, quick = SIZE_DEFAULTS[dest]
+    return '%s [%s; %s with --quick]' % (text, full, quick)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--scenarios', default=','.join(
+        name for name, _, _ in SCENARIOS),
+        help='comma separated scenarios to run [%default]')
+    parser.add_option('--quick', action='store_true', default=False,
+                      help='use small sizes, for smoke testing (sizes given '
+                      'explicitly are kept)')
+    parser.add_option('--number', type=int, help=size_help(
+        'iterations of the message level scenarios', 'number'))
+    parser.add_option('--requests', type=int, help=size_help(
+        'requests sent in the round trip scenarios', 'requests'))
+    parser.add_option('--clients', type=int, help=size_help(
+        'clients in the fan-out scenarios', 'clients'))
+    parser.add_option('--updates', type=int, help=size_help(
+        'sensor updates in the fan-out scenarios', 'updates'))
+    parser.add_option('--strategies', help=size_help(
+        'comma separated numbers of reactor strategies', 'strategies'))
+    parser.add_option('--period', type=float, default=1.0,
+                      help='period of the reactor strategies in seconds')
+    parser.add_option('--duration', type=float, help=size_help(
+        'seconds to run each reactor scenario for, rounded to whole periods',
+        'duration'))
+    parser.add_option('--echo-sizes', help=size_help(
+        'comma separated echo argument sizes, with an optional k or M '
+        'suffix', 'echo_sizes'))
+    parser.add_option('--echo-bytes', type=int, help=size_help(
+        'bytes to echo per argument size', 'echo_bytes'))
+    parser.add_option('--echo-min-requests', type=int, default=1,
+                      help='fewest echo requests per argument size')
+    parser.add_option('--output', help='write the results to this JSON file')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with an earlier JSON file')
+    parser.add_option('--threshold', type=float, default=0.1,
+                      help='fractional change counted as a regression')
+    options, args = parser.parse_args()
+    for dest, (full, quick) in SIZE_DEFAULTS.items():
+        if getattr(options, dest) is None:
+            setattr(options, dest, quick if options.quick else full)
+    options.echo_sizes = [parse_size(s) for s in options.echo_sizes.split(',')]
+    options.strategies = [int(s) for s in options.strategies.split(',')]
+
+    known = dict((name, (func, tx)) for name, func, tx in SCENARIOS)
+    selected = options.scenarios.split(',')
+    for name in selected:
+        if name not in known:
+            parser.error("Unknown scenario %r, choose from %s" %
+                         (name, ', '.join(sorted(known))))
+
+    results = {}
+    tx_scenarios = []
+    for name in selected:
+        func, tx = known[name]
+        if tx:
+            tx_scenarios.append((name, func))
+            continue
+        report_start(name)
+        try:
+            results[name] = func(options)
+        except Exception, e:
+            # recorded like a failed twisted scenario
+            print "  FAILED: %s" % e
+            results[name] = {'error': str(e)}
+        else:
+            report(name, results[name])
+    if tx_scenarios:
+        run_tx_scenarios(tx_scenarios, options, results)
+
+    output = {
+        'meta': {
+            'katcp': VERSION_STR,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'options': dict((key, value) for key, value
+                            in vars(options).items()
+                            if key not in ('output', 'compare')),
+        },
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if compare(output, baseline, options.threshold):
+            sys.exit(1)
+    if any('error' in metrics for metrics in results.values()):
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
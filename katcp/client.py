@@ -18,7 +18,9 @@ import logging
 import errno
 from .core import (DeviceMetaclass, MessageParser, Message, ExcepthookThread,
                    KatcpClientError, KatcpVersionError, ProtocolFlags,
+                   BlobReader,
                    SEC_TS_KATCP_MAJOR, FLOAT_TS_KATCP_MAJOR, SEC_TO_MS_FAC)
+from .instrumentation import ProfileHooks
 
 
 #logging.basicConfig(level=logging.DEBUG)
@@ -72,7 +74,8 @@ class DeviceClient(object):
         self._bindaddr = (host, port)
         self._tb_limit = tb_limit
         self._sock = None
-        self._waiting_chunk = ""
+        self._waiting_chunk = bytearray()
+        self._waiting_blobs = None
         self._running = threading.Event()
         self._connected = threading.Event()
         self._received_protocol_info = threading.Event()
@@ -88,6 +91,11 @@ class DeviceClient(object):
         # message id and lock
         self._last_msg_id = 0
         self._msg_id_lock = threading.Lock()
+        self._profile_hooks = ProfileHooks(self, {
+            "request": "handle_request",
+            "inform": "handle_inform",
+            "reply": "handle_reply",
+        })
 
     @property
     def protocol_flags(self):
@@ -98,8 +106,33 @@ class DeviceClient(object):
         self._protocol_flags = val
         self._server_supports_ids = self.protocol_flags.supports(
             ProtocolFlags.MESSAGE_IDS)
+        self._parser.bulk_data = self.protocol_flags.supports(
+            ProtocolFlags.BULK_DATA)
         self._received_protocol_info.set()
 
+    def add_profile_hook(self, hook):
+        """Call a profiling hook around message handling.
+
+        The hook is called around this client's handle_request,
+        handle_inform and handle_reply.
+
+        Parameters
+        ----------
+        hook : katcp.instrumentation.ProfileHook object
+            The hook to add.
+        """
+        self._profile_hooks.add(hook)
+
+    def remove_profile_hook(self, hook):
+        """Remove a profiling hook added by :meth:`add_profile_hook`.
+
+        Parameters
+        ----------
+        hook : katcp.instrumentation.ProfileHook object
+            The hook to remove.
+        """
+        self._profile_hooks.remove(hook)
+
     def convert_seconds(self, time_seconds):
         """Convert a time in seconds to the device timestamp units
 
@@ -281,9 +314,11 @@ class DeviceClient(object):
         """
         # TODO: should probably implement this as a queue of sockets and
         #       messages to send and have the queue processed in the main loop
-        data = str(msg) + "\n"
-        datalen = len(data)
-        totalsent = 0
+        if self._parser.bulk_data:
+            line, blobs = msg.bulk_parts()
+        else:
+            line, blobs = str(msg), []
+        data = line + "\n"
         sock = self._sock
 
         # Log all sent messages here so no one else has to.
@@ -297,26 +332,34 @@ class DeviceClient(object):
             if sock is None:
                 raise KatcpClientError("Client not connected")
 
-            while totalsent < datalen:
-                if timeout is not None and time.time() - t0 > timeout:
-                    self._logger.warn('Timeout sending message')
-                    send_failed = True
-                    break
-                try:
-                    sent = sock.send(data[totalsent:])
-                except socket.error, e:
-                    if len(e.args) == 2 and e.args[0] == errno.EAGAIN and \
-                            sock is self._sock:
-                        continue
-                    else:
+            # Partial sends are retried from memoryview slices so that the
+            # unsent data is not copied; blobs go out unescaped straight
+            # after the line
+            for data in [memoryview(part) for part in [data] + blobs]:
+                datalen = len(data)
+                totalsent = 0
+                while totalsent < datalen:
+                    if timeout is not None and time.time() - t0 > timeout:
+                        self._logger.warn('Timeout sending message')
+                        send_failed = True
+                        break
+                    try:
+                        sent = sock.send(data[totalsent:])
+                    except socket.error, e:
+                        if len(e.args) == 2 and e.args[0] == errno.EAGAIN \
+                                and sock is self._sock:
+                            continue
+                        else:
+                            send_failed = True
+                            break
+
+                    if sent == 0:
                         send_failed = True
                         break
 
-                if sent == 0:
-                    send_failed = True
+                    totalsent += sent
+                if send_failed:
                     break
-
-                totalsent += sent
         finally:
             self._send_lock.release()
 
@@ -357,7 +400,8 @@ class DeviceClient(object):
             return
 
         self._sock = sock
-        self._waiting_chunk = ""
+        self._waiting_chunk = bytearray()
+        self._waiting_blobs = None
         self._connected.set()
 
         try:
@@ -386,12 +430,36 @@ class DeviceClient(object):
         chunk : data
             The data string to process.
         """
+        while chunk:
+            reader = self._waiting_blobs
+            if reader is not None:
+                # raw bulk data following a message line
+                chunk = reader.feed(chunk)
+                if not reader.complete:
+                    return
+                self._waiting_blobs = None
+                self.handle_message(reader.msg)
+            else:
+                chunk = self._handle_lines(chunk)
+
+    def _handle_lines(self, chunk):
+        """Handle lines of data from the server.
+
+        Returns the remainder of the chunk following a message line that
+        references bulk-data blobs, or an empty string.
+        """
+        raw_chunk = chunk
         chunk = chunk.replace("\r", "\n")
         lines = chunk.split("\n")
+        position = 0
 
         for line in lines[:-1]:
-            full_line = self._waiting_chunk + line
-            self._waiting_chunk = ""
+            if self._waiting_chunk:
+                full_line = str(self._waiting_chunk) + line
+                del self._waiting_chunk[:]
+            else:
+                full_line = line
+            position += len(line) + 1
             if full_line:
                 try:
                     msg = self._parser.parse(full_line)
@@ -402,10 +470,19 @@ class DeviceClient(object):
                     reason = "\n".join(traceback.format_exception(
                         e_type, e_value, trace, self._tb_limit))
                     self._logger.error("BAD COMMAND: %s" % (reason,))
-                else:
-                    self.handle_message(msg)
+                    continue
+                if self._parser.bulk_data:
+                    # a \r\n line end is one terminator, not the start
+                    # of the blob data
+                    reader = BlobReader(
+                        msg, after_cr=raw_chunk[position - 1] == "\r")
+                    if not reader.complete:
+                        self._waiting_blobs = reader
+                        return raw_chunk[position:]
+                self.handle_message(msg)
 
         self._waiting_chunk += lines[-1]
+        return ""
 
     def handle_message(self, msg):
         """Handle a message from the server.
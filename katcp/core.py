@@ -13,6 +13,7 @@ import sys
 import re
 import time
 import warnings
+from array import array
 
 SEC_TO_MS_FAC = 1000
 MS_TO_SEC_FAC = 1./1000
@@ -51,7 +52,9 @@ class Message(object):
     name : str
         The message name.
     arguments : list of strings
-        The message arguments.
+        The message arguments. Arguments that are bytearray, buffer or
+        memoryview objects are kept as binary blobs (see
+        :meth:`bulk_parts`).
     mid : str, digits only
         The message identifier. Replies and informs that
         are part of the reply to a request should have the
@@ -110,6 +113,9 @@ class Message(object):
     ## @brief Regular expression matching all unescaped character.
     ESCAPE_RE = re.compile(r"[\\ \0\n\r\x1b\t]")
 
+    ## @brief Argument types that are sent as raw binary blobs.
+    BLOB_TYPES = (bytearray, buffer, memoryview)
+
     ## @var mtype
     # @brief Message type.
 
@@ -134,7 +140,9 @@ class Message(object):
         if arguments is None:
             self.arguments = []
         else:
-            self.arguments = [type(x) is float and repr(x) or str(x)
+            # blobs are kept as they are, even when empty
+            self.arguments = [x if isinstance(x, self.BLOB_TYPES) else
+                              type(x) is float and repr(x) or str(x)
                               for x in arguments]
 
         # check message type
@@ -178,10 +186,13 @@ class Message(object):
         msg : str
            The message encoded as a ASCII string.
         """
+        return self._serialize(False)
+
+    def _serialize(self, blob_refs):
+        """Serialize the message, optionally with references to blobs."""
         if self.arguments:
-            escaped_args = [self.ESCAPE_RE.sub(self._escape_match, x)
+            escaped_args = [self._escape_arg(x, blob_refs)
                             for x in self.arguments]
-            escaped_args = [x or "\\@" for x in escaped_args]
             arg_str = " " + " ".join(escaped_args)
         else:
             arg_str = ""
@@ -200,7 +211,9 @@ class Message(object):
         tp = self.TYPE_NAMES[self.mtype].lower()
         name = self.name
         if self.arguments:
-            escaped_args = [self.ESCAPE_RE.sub(self._escape_match, x)
+            escaped_args = [isinstance(x, self.BLOB_TYPES) and
+                            "<%d bytes>" % len(x) or
+                            self.ESCAPE_RE.sub(self._escape_match, x)
                             for x in self.arguments]
             for arg in escaped_args:
                 if len(arg) > 10:
@@ -221,6 +234,47 @@ class Message(object):
     def __ne__(self, other):
         return not self == other
 
+    def blobs(self):
+        """Return the binary blob arguments of the message.
+
+        Returns
+        -------
+        blobs : list
+            The arguments that are bytearray, buffer or memoryview objects,
+            in argument order.
+        """
+        return [x for x in self.arguments if isinstance(x, self.BLOB_TYPES)]
+
+    def bulk_parts(self):
+        """Return the message split into a line and raw binary blobs.
+
+        This is the serialization used when both ends support the
+        bulk-data extension (:attr:`ProtocolFlags.BULK_DATA`). Each blob
+        argument is replaced by a ``\\b<length>`` reference in the line
+        and the blobs follow the terminating newline, unescaped and in
+        argument order.
+
+        Returns
+        -------
+        line : str
+            The message line, without the terminating newline.
+        blobs : list
+            The raw blob arguments to send after the line.
+        """
+        blobs = self.blobs()
+        return self._serialize(bool(blobs)), blobs
+
+    def _escape_arg(self, arg, blob_refs):
+        """Escape a single argument for transmission."""
+        if isinstance(arg, self.BLOB_TYPES):
+            if blob_refs:
+                return "\\b%d" % (len(arg) * getattr(arg, 'itemsize', 1))
+            if isinstance(arg, memoryview):
+                arg = arg.tobytes()
+            else:
+                arg = str(arg)
+        return self.ESCAPE_RE.sub(self._escape_match, arg) or "\\@"
+
     def _escape_match(self, match):
         """Given a re.Match object, return the escape code for it."""
         return "\\" + self.REVERSE_ESCAPE_LOOKUP[match.group()]
@@ -333,9 +387,23 @@ class MessageParser(object):
     ## @brief Regular expression matching all escapes.
     UNESCAPE_RE = re.compile(r"\\(.?)")
 
+    ## @brief Regular expression matching a bulk-data blob reference.
+    BLOB_RE = re.compile(r"^\\b(?P<length>[0-9]+)$")
+
+    ## @brief Largest blob a bulk-data reference may announce.
+    MAX_BLOB_SIZE = 1 << 30
+
+    ## @brief Largest total of the blobs announced by one message. Only one
+    ## message at a time waits for its blobs on a connection, so this also
+    ## bounds the blob data buffered per connection.
+    MAX_MESSAGE_BLOB_SIZE = 1 << 30
+
     ## @brief Regular expresion matching KATCP whitespace (just space and tab)
     WHITESPACE_RE = re.compile(r"[ \t]+")
 
+    def __init__(self, bulk_data=False):
+        self.bulk_data = bulk_data
+
     ## @brief Regular expression matching name and ID
     NAME_RE = re.compile(
         r"^(?P<name>[a-zA-Z][a-zA-Z0-9\-]*)(\[(?P<id>[0-9]+)\])?$")
@@ -357,6 +425,23 @@ class MessageParser(object):
             raise KatcpSyntaxError("Unescaped special %r." % (match.group(),))
         return self.UNESCAPE_RE.sub(self._unescape_match, arg)
 
+    def _parse_bulk_arg(self, arg):
+        """Parse an argument that may be a bulk-data blob reference.
+
+        Blob references are returned as empty :class:`PendingBlob`
+        objects, to be filled in by a :class:`BlobReader` as the data
+        arrives.
+        """
+        match = self.BLOB_RE.match(arg)
+        if not match:
+            return self._parse_arg(arg)
+        length = int(match.group('length'))
+        if length > self.MAX_BLOB_SIZE:
+            raise KatcpSyntaxError("Blob of %d bytes exceeds maximum size"
+                                   " of %d bytes." % (length,
+                                                      self.MAX_BLOB_SIZE))
+        return PendingBlob(length)
+
     def parse(self, line):
         """Parse a line, return a Message.
 
@@ -389,7 +474,16 @@ class MessageParser(object):
             del parts[-1]
 
         name = parts[0][1:]
-        arguments = [self._parse_arg(x) for x in parts[1:]]
+        if self.bulk_data:
+            arguments = [self._parse_bulk_arg(x) for x in parts[1:]]
+            total = sum(arg.length for arg in arguments
+                        if isinstance(arg, PendingBlob))
+            if total > self.MAX_MESSAGE_BLOB_SIZE:
+                raise KatcpSyntaxError("Blobs of %d bytes in total exceed"
+                                       " maximum size of %d bytes." %
+                                       (total, self.MAX_MESSAGE_BLOB_SIZE))
+        else:
+            arguments = [self._parse_arg(x) for x in parts[1:]]
 
         # split out message id
         match = self.NAME_RE.match(name)
@@ -403,6 +497,96 @@ class MessageParser(object):
         return Message(mtype, name, arguments, mid)
 
 
+class PendingBlob(bytearray):
+    """A bulk-data blob that has been announced but not fully received.
+
+    It starts out empty and grows as a :class:`BlobReader` receives its
+    data, so that memory is only used for data that actually arrived.
+
+    Parameters
+    ----------
+    length : int
+        The announced length of the blob in bytes.
+    """
+
+    __slots__ = ["length"]
+
+    def __init__(self, length):
+        super(PendingBlob, self).__init__()
+        self.length = length
+
+
+class BlobReader(object):
+    """Collects the raw blobs that follow a bulk-data message line.
+
+    Parameters
+    ----------
+    msg : Message object
+        A message returned by a :class:`MessageParser` with bulk data
+        enabled. Its blob arguments are the :class:`PendingBlob` objects
+        created by the parser.
+    after_cr : bool
+        Whether the message line ended in a carriage return. A newline
+        straight after it is then part of the line terminator rather than
+        the first byte of blob data.
+
+    Attributes
+    ----------
+    msg : Message object
+        The message. Once :attr:`complete` is True each blob argument has
+        been replaced by a memoryview of the received data.
+    complete : bool
+        Whether all the blobs have been received.
+    """
+
+    def __init__(self, msg, after_cr=False):
+        self.msg = msg
+        self._pending = [i for i, arg in enumerate(msg.arguments)
+                         if isinstance(arg, PendingBlob)]
+        self._after_cr = after_cr
+        self.complete = False
+        self._advance()
+
+    def _advance(self):
+        """Skip over filled blobs, exposing them as memoryviews."""
+        arguments = self.msg.arguments
+        while self._pending:
+            index = self._pending[0]
+            if len(arguments[index]) < arguments[index].length:
+                return
+            arguments[index] = memoryview(arguments[index])
+            del self._pending[0]
+        self.complete = True
+
+    def feed(self, data):
+        """Copy raw data into the pending blobs.
+
+        Parameters
+        ----------
+        data : str
+            Data received after the message line.
+
+        Returns
+        -------
+        rest : str
+            The part of data left over once all the blobs are complete.
+        """
+        start = 0
+        end = len(data)
+        if self._after_cr and data:
+            self._after_cr = False
+            if data[0] == "\n":
+                start = 1
+        arguments = self.msg.arguments
+        while start < end and not self.complete:
+            blob = arguments[self._pending[0]]
+            count = min(blob.length - len(blob), end - start)
+            blob += buffer(data, start, count)
+            start += count
+            self._advance()
+        return data[start:]
+
+
 class ProtocolFlags(object):
     """Utility class for handling KATCP protocol flags.
 
@@ -414,6 +598,9 @@ class ProtocolFlags(object):
 
     * M - server supports multiple clients
     * I - server supports message identifiers
+    * B - server supports bulk-data blobs (raw binary arguments sent after
+      the message line, see :meth:`Message.bulk_parts`). The server only
+      sends blobs to clients that have asked for them with ``?bulk-data``.
 
     Parameters
     ----------
@@ -432,6 +619,9 @@ class ProtocolFlags(object):
     message_ids : bool
         Whether the server the version string came from supports
         message ids.
+    bulk_data : bool
+        Whether the server the version string came from supports
+        bulk-data blobs.
     """
 
     VERSION_RE = re.compile(r"^(?P<major>\d+)\.(?P<minor>\d+)"
@@ -441,6 +631,7 @@ class ProtocolFlags(object):
 
     MULTI_CLIENT = 'M'
     MESSAGE_IDS = 'I'
+    BULK_DATA = 'B'
 
     STRATEGIES_V4 = frozenset(['none', 'auto', 'period', 'event', 'differential'])
     STRATEGIES_V5 = STRATEGIES_V4 | frozenset(
@@ -457,6 +648,7 @@ class ProtocolFlags(object):
         self.flags = set(list(flags))
         self.multi_client = self.MULTI_CLIENT in self.flags
         self.message_ids = self.MESSAGE_IDS in self.flags
+        self.bulk_data = self.BULK_DATA in self.flags
         if self.message_ids and self.major < MID_KATCP_MAJOR:
             raise ValueError(
                 'MESSAGE_IDS is only supported in katcp v5 and newer')
@@ -639,6 +831,102 @@ class ExcepthookThread(threading.Thread):
 from .kattypes import Int, Float, Bool, Discrete, Lru, Str, Timestamp, Address
 
 
+class SensorHistory(object):
+    """A fixed-size ring buffer of sensor readings.
+
+    Timestamps and statuses are kept in preallocated arrays and values in a
+    preallocated list, so recording a reading does not allocate. Once the
+    buffer is full the oldest reading is overwritten.
+
+    Parameters
+    ----------
+    size : int
+        The maximum number of readings kept.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Sensor history size must be positive.")
+        self.size = size
+        self._timestamps = array('d', [0.0]) * size
+        self._statuses = array('B', [0]) * size
+        self._values = [None] * size
+        self._next = 0  # physical index of the next reading
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, timestamp, status, value):
+        """Record a reading, overwriting the oldest one if the buffer is full.
+        """
+        i = self._next
+        self._timestamps[i] = timestamp
+        self._statuses[i] = status
+        self._values[i] = value
+        self._next = (i + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def clear(self):
+        """Forget all readings."""
+        self._next = 0
+        self._count = 0
+        self._values = [None] * self.size
+
+    def _index(self, i):
+        """Physical index of the i-th oldest reading."""
+        return (self._next - self._count + i) % self.size
+
+    def _bisect(self, timestamp):
+        """Logical index of the first reading not older than timestamp.
+        Readings are assumed to be recorded in time order."""
+        lo, hi = 0, self._count
+        timestamps = self._timestamps
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if timestamps[self._index(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def samples(self, start=None, end=None, max_samples=None):
+        """Return readings, oldest first.
+
+        Parameters
+        ----------
+        start : float in seconds or None
+            Only return readings taken at or after this time.
+        end : float in seconds or None
+            Only return readings taken at or before this time.
+        max_samples : int or None
+            Return at most this many readings (the most recent ones).
+
+        Returns
+        -------
+        samples : list of (timestamp, status, value) tuples
+            The selected readings.
+        """
+        first = 0 if start is None else self._bisect(start)
+        if end is None:
+            last = self._count
+        else:
+            # first reading newer than end
+            last = self._bisect(end)
+            while (last < self._count and
+                   self._timestamps[self._index(last)] <= end):
+                last += 1
+        if max_samples is not None:
+            first = max(first, last - max_samples)
+        result = []
+        for i in xrange(first, last):
+            j = self._index(i)
+            result.append((self._timestamps[j], self._statuses[j],
+                           self._values[j]))
+        return result
+
+
 class Sensor(object):
     """Instantiate a new sensor object.
 
@@ -684,6 +972,13 @@ class Sensor(object):
     # is an abstract class used only outside this module
     # pylint: disable-msg = R0902
 
+    # Devices may create tens of thousands of sensors, so instances have no
+    # __dict__ (subclasses that do not define __slots__ still get one).
+    __slots__ = ('_sensor_type', '_observers', '_kattype', '_value_tuple',
+                 '_formatter', '_parser', 'stype', 'name', '_description',
+                 'units', '_params', '_formatted_params', 'history',
+                 '__weakref__')
+
     # Type names and formatters
     #
     # Formatters take the sensor object and the value to
@@ -817,15 +1112,52 @@ class Sensor(object):
         self.stype = self._kattype.name
 
         self.name = name
+        self._description = description
+        self.units = units
+        self.params = params
+        ## @brief SensorHistory of recent readings, or None if not recorded.
+        self.history = None
+
+    # The default description and the formatted params are only needed when
+    # the sensor is listed, so they are built on first use.
+
+    def _get_description(self):
+        description = self._description
         if description is None:
+            units = self.units
             description = '%(type)s sensor %(name)r %(unit_description)s' % dict(
                type=self.stype.capitalize(), name=self.name,
                unit_description=('in unit '+units if units else 'with no unit'))
+        return description
 
-        self.description = description
-        self.units = units
-        self.params = params
-        self.formatted_params = [self._formatter(p, True) for p in params]
+    def _set_description(self, description):
+        self._description = description
+
+    description = property(_get_description, _set_description)
+
+    def _get_params(self):
+        return self._params
+
+    def _set_params(self, params):
+        self._params = params
+        self._formatted_params = None
+
+    params = property(_get_params, _set_params)
+
+    def _get_formatted_params(self):
+        formatted_params = self._formatted_params
+        if formatted_params is None:
+            formatted_params = self._formatted_params = [
+                self._formatter(p, True) for p in self._params]
+        return formatted_params
+
+    def _set_formatted_params(self, formatted_params):
+        self._formatted_params = formatted_params
+
+    formatted_params = property(_get_formatted_params, _set_formatted_params)
+
+    del (_get_description, _set_description, _get_params, _set_params,
+         _get_formatted_params, _set_formatted_params)
 
     # support for legacy KATCP users that relied on being able to
     # read _timestamp, _status and _value. Such usage will be
@@ -1055,6 +1387,9 @@ class Sensor(object):
             sensor's type).
         """
         self._value_tuple = (timestamp, status, value)
+        history = self.history
+        if history is not None:
+            history.add(timestamp, status, value)
         self.notify()
 
     def set_formatted(self, raw_timestamp, raw_status, raw_value,
@@ -1097,11 +1432,46 @@ class Sensor(object):
         value : str
             KATCP formatted sensor value
         """
-        timestamp, status, value = self.read()
+        return self.format_reading(self.read(), major)
+
+    def format_reading(self, reading, major=DEFAULT_KATCP_MAJOR):
+        """Format a timestamp, status, value tuple read from this sensor.
+
+        Parameters
+        ----------
+        reading : tuple
+            A (timestamp, status, value) tuple as returned by .read().
+        major : int. Defaults to latest implemented KATCP version (5)
+            Major version of KATCP to use when interpreting types
+
+        Returns
+        -------
+        timestamp : str
+            KATCP formatted timestamp string
+        status : str
+            KATCP formatted sensor status string
+        value : str
+            KATCP formatted sensor value
+        """
+        timestamp, status, value = reading
         return (self.TIMESTAMP_TYPE.encode(timestamp, major),
                 self.STATUSES[status],
                 self._formatter(value, True, major))
 
+    def enable_history(self, size):
+        """Start recording the most recent readings of the sensor.
+
+        Parameters
+        ----------
+        size : int
+            The number of readings to keep.
+        """
+        self.history = SensorHistory(size)
+
+    def disable_history(self):
+        """Stop recording readings and discard the recorded ones."""
+        self.history = None
+
     def read(self):
         """Read the sensor and return a timestamp, status, value tuple.
 
@@ -1194,3 +1564,311 @@ class Sensor(object):
         else:
             kattype = typeclass()
         return [kattype.decode(x, major) for x in formatted_params]
+
+
+class SensorBank(object):
+    """A group of integer or float sensors stored in contiguous arrays.
+
+    The timestamps, statuses and values of all the sensors in the bank live
+    in three array columns indexed by slot, and the type, units and params
+    are shared by the whole bank. Sensor objects are only created on demand
+    as lightweight views onto a slot, so a large number of sensors costs a
+    few tens of bytes each until they are accessed individually.
+
+    Values of a contiguous run of sensors can be replaced in one operation
+    with .set_values(), which only notifies the views that have observers
+    or record a history. Observers attached to the bank itself are notified
+    once per update with the range of slots that changed, which lets them
+    evaluate many sensors together (see sampling.DifferentialGroup).
+
+    Unlike Sensor, reading a view is not atomic with respect to a concurrent
+    update of the same slot from another thread.
+
+    Parameters
+    ----------
+    sensor_type : Sensor type constant
+        Either Sensor.INTEGER or Sensor.FLOAT (or the int and float
+        shortcuts).
+    units : str
+        The units of the sensor values.
+    params : list
+        [min, max] -- minimum and maximum values of the sensors.
+    default : int or float
+        An initial value for the sensors.
+    """
+
+    ## @brief Array typecodes of the value column for each sensor type.
+    VALUE_TYPECODES = {
+        Sensor.INTEGER: 'l',
+        Sensor.FLOAT: 'd',
+    }
+
+    def __init__(self, sensor_type, units='', params=None, default=None):
+        if params is None:
+            params = []
+        sensor_type = Sensor.SENSOR_SHORTCUTS.get(sensor_type, sensor_type)
+        if sensor_type not in self.VALUE_TYPECODES:
+            raise ValueError("Sensor banks can only hold integer or float "
+                             "sensors.")
+        typeclass, default_value = Sensor.SENSOR_TYPES[sensor_type]
+        if len(params) == 2 and not params[0] <= default_value <= params[1]:
+            default_value = params[0]
+        if default is not None:
+            default_value = default
+
+        self.sensor_type = sensor_type
+        self.kattype = typeclass()
+        self.stype = self.kattype.name
+        self.units = units
+        self.params = params
+        self.formatted_params = [self.kattype.pack(p, True) for p in params]
+        self.default = default_value
+
+        self._typecode = self.VALUE_TYPECODES[sensor_type]
+        self._timestamps = array('d')
+        self._statuses = array('B')
+        self._values = array(self._typecode)
+        self._names = []
+        self._slots = {}
+        # only descriptions that differ from the generated default
+        self._descriptions = {}
+        # slot -> BankedSensor, for the views created so far
+        self._views = {}
+        # slots whose views have observers or a history
+        self._watched = set()
+        self._observers = set()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._slots
+
+    def __iter__(self):
+        """Iterate over sensor views in slot order."""
+        for name in self._names:
+            yield self[name]
+
+    def __getitem__(self, name):
+        """Return the sensor view for a name."""
+        slot = self._slots[name]
+        sensor = self._views.get(slot)
+        if sensor is None:
+            sensor = self._views[slot] = BankedSensor(self, slot, name)
+        return sensor
+
+    def add(self, name, description=None, default=None):
+        """Add a sensor to the bank.
+
+        Parameters
+        ----------
+        name : str
+            The name of the sensor.
+        description : str
+            A short description of the sensor. Generated from the name and
+            units if None.
+        default : int or float
+            An initial value for the sensor. Defaults to the bank default.
+
+        Returns
+        -------
+        slot : int
+            The slot of the new sensor. Index the bank with the name for a
+            view of it.
+        """
+        if name in self._slots:
+            raise ValueError("Sensor %r is already in the bank." % name)
+        if default is None:
+            default = self.default
+        self._slots[name] = len(self._names)
+        self._names.append(name)
+        if description is not None:
+            self._descriptions[name] = description
+        self._timestamps.append(time.time())
+        self._statuses.append(Sensor.UNKNOWN)
+        self._values.append(default)
+        return self._slots[name]
+
+    def attach(self, observer):
+        """Attach an observer to the whole bank.
+
+        Parameters
+        ----------
+        observer : object
+            Object with an .update_bank(bank, start, stop) method that will be
+            called after the sensors in slots start to stop - 1 are set.
+        """
+        self._observers.add(observer)
+
+    def detach(self, observer):
+        """Detach an observer from the bank."""
+        self._observers.discard(observer)
+
+    def observers(self):
+        """Return the observers attached to the bank."""
+        return list(self._observers)
+
+    def _notify(self, start, stop):
+        for o in list(self._observers):
+            o.update_bank(self, start, stop)
+
+    def names(self):
+        """Return the sensor names in slot order."""
+        return list(self._names)
+
+    def slot(self, name):
+        """Return the slot (column index) of a named sensor."""
+        return self._slots[name]
+
+    def description(self, name):
+        """Return the description of a named sensor."""
+        description = self._descriptions.get(name)
+        if description is None:
+            description = '%(type)s sensor %(name)r %(unit_description)s' % \
+                dict(type=self.stype.capitalize(), name=name,
+                     unit_description=('in unit ' + self.units if self.units
+                                       else 'with no unit'))
+        return description
+
+    def values(self, start=0, stop=None):
+        """Return a copy of the value column for a run of slots."""
+        return self._values[start:stop]
+
+    def columns(self):
+        """Return the timestamp, status and value columns.
+
+        The arrays are the live storage of the bank and must not be
+        modified or resized by the caller.
+        """
+        return self._timestamps, self._statuses, self._values
+
+    def set_values(self, values, status=Sensor.NOMINAL, timestamp=None,
+                   start=0):
+        """Set the values of a contiguous run of sensors.
+
+        The columns are updated with slice assignments. Only views with
+        observers are notified and only views with a history record the
+        new readings. Observers of the bank are notified once.
+
+        Parameters
+        ----------
+        values : sequence of int or float
+            The new values, for slots start to start + len(values).
+        status : Sensor status constant
+            The status given to all the new readings.
+        timestamp : float in seconds or None
+            The time given to all the new readings. Uses the current time
+            if None.
+        start : int
+            The slot of the first sensor to update.
+        """
+        count = len(values)
+        stop = start + count
+        if start < 0 or stop > len(self._names):
+            raise IndexError("Slots %d to %d are not all in the bank."
+                             % (start, stop - 1))
+        if timestamp is None:
+            timestamp = time.time()
+        if not (isinstance(values, array) and
+                values.typecode == self._typecode):
+            values = array(self._typecode, values)
+        self._values[start:stop] = values
+        self._timestamps[start:stop] = array('d', [timestamp]) * count
+        self._statuses[start:stop] = array('B', [status]) * count
+        for slot in sorted(self._watched):
+            if start <= slot < stop:
+                self._views[slot]._updated()
+        self._notify(start, stop)
+
+    def _read(self, slot):
+        return (self._timestamps[slot], self._statuses[slot],
+                self._values[slot])
+
+    def _write(self, slot, reading):
+        timestamp, status, value = reading
+        self._values[slot] = value
+        self._statuses[slot] = status
+        self._timestamps[slot] = timestamp
+
+    def _watch(self, sensor):
+        """Update whether bulk sets need to visit a view."""
+        if sensor._observers or sensor.history is not None:
+            self._watched.add(sensor._slot)
+        else:
+            self._watched.discard(sensor._slot)
+
+
+class BankedSensor(Sensor):
+    """A Sensor view onto one slot of a SensorBank.
+
+    Created by indexing a bank with a sensor name, never directly. The view
+    supports the full Sensor interface and can be added to a device server
+    like any other sensor.
+    """
+
+    __slots__ = ('_bank', '_slot')
+
+    def __init__(self, bank, slot, name):
+        self._bank = bank
+        self._slot = slot
+        self.name = name
+        # shared until the first observer is attached
+        self._observers = frozenset()
+        self.history = None
+
+    _sensor_type = property(lambda self: self._bank.sensor_type)
+    _kattype = property(lambda self: self._bank.kattype)
+    _formatter = property(lambda self: self._bank.kattype.pack)
+    _parser = property(lambda self: self._bank.kattype.unpack)
+    stype = property(lambda self: self._bank.stype)
+    units = property(lambda self: self._bank.units)
+    params = property(lambda self: self._bank.params)
+    formatted_params = property(lambda self: self._bank.formatted_params)
+    description = property(lambda self: self._bank.description(self.name))
+    bank = property(lambda self: self._bank, doc="The SensorBank holding the "
+                    "sensor.")
+    slot = property(lambda self: self._slot, doc="The slot of the sensor in "
+                    "its bank.")
+
+    def _get_value_tuple(self):
+        return self._bank._read(self._slot)
+
+    def _set_value_tuple(self, reading):
+        self._bank._write(self._slot, reading)
+
+    _value_tuple = property(_get_value_tuple, _set_value_tuple)
+
+    del _get_value_tuple, _set_value_tuple
+
+    def _updated(self):
+        """Record and announce a reading written directly to the bank.
+
+        Observers of the bank are notified by the bank itself.
+        """
+        history = self.history
+        if history is not None:
+            history.add(*self.read())
+        Sensor.notify(self)
+
+    def notify(self):
+        Sensor.notify(self)
+        self._bank._notify(self._slot, self._slot + 1)
+
+    def attach(self, observer):
+        if not isinstance(self._observers, set):
+            self._observers = set()
+        Sensor.attach(self, observer)
+        self._bank._watch(self)
+
+    def detach(self, observer):
+        if self._observers:
+            Sensor.detach(self, observer)
+        self._bank._watch(self)
+
+    def enable_history(self, size):
+        Sensor.enable_history(self, size)
+        self._bank._watch(self)
+
+    def disable_history(self):
+        Sensor.disable_history(self)
+        self._bank._watch(self)
@@ -0,0 +1,490 @@
+# instrumentation.py
+# -*- coding: utf8 -*-
+# vim:fileencoding=utf8 ai ts=4 sts=4 et sw=4
+# Copyright 2009 SKA South Africa (http://ska.ac.za/)
+# BSD license - see COPYING for details
+
+"""Performance counters for device servers.
+
+   A :class:`ServerStats` object collects per-request latency histograms,
+   per-connection message and byte counts, and gauges such as queue depths.
+   It is only created when a server enables it (see
+   :meth:`katcp.DeviceServer.enable_perf_stats`), so servers that do not
+   use it pay nothing more than a check for None.
+
+   The counters are updated without locking and may be slightly off when
+   several threads send to the same client at the same time.
+
+   :class:`ProfileHooks` wraps methods such as request dispatch and sensor
+   notification to call :class:`ProfileHook` objects before and after
+   them. The methods are only wrapped while hooks are installed.
+   """
+
+import time
+import socket
+import threading
+import weakref
+
+from bisect import bisect_left
+from types import MethodType
+from .core import Sensor
+
+
+class LatencyHistogram(object):
+    """Counts of durations in logarithmically spaced bins.
+
+    Bin i counts durations up to BIN_EDGES[i] seconds. The edges double
+    from 1 microsecond to about 16 seconds, and the last bin counts
+    everything longer.
+
+    Attributes
+    ----------
+    count : int
+        Number of durations recorded.
+    total : float
+        Sum of the durations recorded, in seconds.
+    max : float
+        Longest duration recorded, in seconds.
+    """
+
+    BIN_EDGES = [1e-6 * 2 ** i for i in range(25)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BIN_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        """Record a duration.
+
+        Parameters
+        ----------
+        duration : float
+            The duration in seconds. Negative durations count as zero.
+        """
+        if duration < 0.0:
+            duration = 0.0
+        self.counts[bisect_left(self.BIN_EDGES, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    @classmethod
+    def merged(cls, histograms):
+        """Return a histogram combining the counts of several histograms.
+
+        Parameters
+        ----------
+        histograms : iterable of LatencyHistogram objects
+            The histograms to combine.
+        """
+        merged = cls()
+        for histogram in histograms:
+            merged.counts = [a + b for a, b in
+                             zip(merged.counts, histogram.counts)]
+            merged.count += histogram.count
+            merged.total += histogram.total
+            merged.max = max(merged.max, histogram.max)
+        return merged
+
+    def mean(self):
+        """Return the mean duration, or 0.0 if nothing has been recorded."""
+        return self.count and self.total / self.count or 0.0
+
+    def percentile(self, fraction):
+        """Return an upper bound on the given fraction of the durations.
+
+        Parameters
+        ----------
+        fraction : float
+            Fraction of the durations, between 0 and 1.
+
+        Returns
+        -------
+        duration : float
+            The upper edge of the bin containing the requested fraction,
+            clipped to the longest duration recorded.
+        """
+        needed = fraction * self.count
+        seen = 0
+        for edge, count in zip(self.BIN_EDGES, self.counts):
+            seen += count
+            if seen and seen >= needed:
+                return min(edge, self.max)
+        return self.max
+
+
+class ConnectionStats(object):
+    """Message and byte counts for a single client connection."""
+
+    __slots__ = ('messages_in', 'bytes_in', 'messages_out', 'bytes_out')
+
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+
+
+class ServerStats(object):
+    """Performance counters for a device server.
+
+    Parameters
+    ----------
+    update_period : float
+        Minimum time between updates of the sensor values, in seconds.
+
+    Attributes
+    ----------
+    requests : dict
+        Map from request name to the LatencyHistogram of its handler.
+    connections : dict
+        Map from client socket to its ConnectionStats.
+    reactor_lateness : dict
+        Map from sampling strategy name to a LatencyHistogram of how late
+        the sample reactor fired its periodic samples.
+    """
+
+    def __init__(self, update_period=1.0):
+        self.update_period = update_period
+        self.requests = {}
+        self.connections = {}
+        self.reactor_lateness = {}
+        self._gauges = []
+        self._closed = ConnectionStats()
+        self._next_update = 0.0
+        self._sensors = dict((name, factory(
+            "perf.%s" % name, description, units)) for
+            name, factory, description, units in [
+                ("requests", Sensor.integer,
+                 "Number of requests handled.", ""),
+                ("request-latency", Sensor.float,
+                 "Mean request handler latency.", "s"),
+                ("messages-in", Sensor.integer,
+                 "Number of messages received from clients.", ""),
+                ("bytes-in", Sensor.integer,
+                 "Number of bytes received from clients.", "B"),
+                ("messages-out", Sensor.integer,
+                 "Number of messages sent to clients.", ""),
+                ("bytes-out", Sensor.integer,
+                 "Number of bytes sent to clients.", "B"),
+                ("reactor-lateness", Sensor.float,
+                 "Mean lateness of periodic sampling.", "s"),
+                ("reactor-lateness-p99", Sensor.float,
+                 "99th percentile lateness of periodic sampling.", "s"),
+            ])
+
+    def sensors(self):
+        """Return the sensors that report the counters.
+
+        Returns
+        -------
+        sensors : list of Sensor objects
+            The perf.* sensors, including those of added gauges.
+        """
+        return self._sensors.values()
+
+    def add_gauge(self, name, description, read):
+        """Add an integer sensor that reports a value read on each update.
+
+        Parameters
+        ----------
+        name : str
+            Name of the gauge. The sensor is called perf.<name>.
+        description : str
+            Description of the sensor.
+        read : callable
+            Function with no arguments returning the current value.
+        """
+        sensor = Sensor.integer("perf.%s" % name, description, "")
+        self._sensors[name] = sensor
+        self._gauges.append((name, read))
+        return sensor
+
+    def gauges(self):
+        """Return (name, value) pairs for the current gauge values."""
+        return [(name, read()) for name, read in self._gauges]
+
+    def request_handled(self, name, latency):
+        """Record that a request handler ran.
+
+        Parameters
+        ----------
+        name : str
+            The request name.
+        latency : float
+            Time the handler took, in seconds.
+        """
+        histogram = self.requests.get(name)
+        if histogram is None:
+            histogram = self.requests[name] = LatencyHistogram()
+        histogram.add(latency)
+
+    def received(self, sock, nbytes=0, nmessages=0):
+        """Record data received from a client."""
+        stats = self.connections.get(sock)
+        if stats is None:
+            stats = self.connections[sock] = ConnectionStats()
+        stats.bytes_in += nbytes
+        stats.messages_in += nmessages
+
+    def sent(self, sock, nbytes):
+        """Record a message sent to a client."""
+        stats = self.connections.get(sock)
+        if stats is None:
+            stats = self.connections[sock] = ConnectionStats()
+        stats.bytes_out += nbytes
+        stats.messages_out += 1
+
+    def remove_connection(self, sock):
+        """Fold the counts of a closed connection into the totals."""
+        stats = self.connections.pop(sock, None)
+        if stats is not None:
+            for name in ConnectionStats.__slots__:
+                setattr(self._closed, name,
+                        getattr(self._closed, name) + getattr(stats, name))
+
+    def totals(self):
+        """Return the ConnectionStats summed over all connections."""
+        totals = ConnectionStats()
+        for stats in self.connections.values() + [self._closed]:
+            for name in ConnectionStats.__slots__:
+                setattr(totals, name,
+                        getattr(totals, name) + getattr(stats, name))
+        return totals
+
+    def update_sensors(self, force=False):
+        """Set the sensor values if update_period has passed.
+
+        Parameters
+        ----------
+        force : bool
+            Update the sensors even if update_period has not passed.
+        """
+        now = time.time()
+        if not force and now < self._next_update:
+            return
+        self._next_update = now + self.update_period
+        count = sum(h.count for h in self.requests.values())
+        total = sum(h.total for h in self.requests.values())
+        totals = self.totals()
+        lateness = LatencyHistogram.merged(self.reactor_lateness.values())
+        values = [
+            ("requests", count),
+            ("request-latency", count and total / count or 0.0),
+            ("messages-in", totals.messages_in),
+            ("bytes-in", totals.bytes_in),
+            ("messages-out", totals.messages_out),
+            ("bytes-out", totals.bytes_out),
+            ("reactor-lateness", lateness.mean()),
+            ("reactor-lateness-p99", lateness.percentile(0.99)),
+        ] + self.gauges()
+        for name, value in values:
+            self._sensors[name].set(now, Sensor.NOMINAL, value)
+
+    def informs(self):
+        """Return the arguments of the #perf-stats informs.
+
+        Returns
+        -------
+        informs : list of tuples
+            One tuple of inform arguments per request name, connection,
+            gauge and sampling strategy the sample reactor ran.
+        """
+        informs = []
+        for name, h in sorted(self.requests.items()):
+            informs.append(("request", name, h.count, "%.6f" % h.mean(),
+                            "%.6f" % h.percentile(0.5),
+                            "%.6f" % h.percentile(0.99), "%.6f" % h.max))
+        for sock, stats in self.connections.items():
+            try:
+                peer = "%s:%d" % sock.getpeername()[:2]
+            except (socket.error, TypeError, AttributeError):
+                peer = "<disconnected client>"
+            informs.append(("connection", peer, stats.messages_in,
+                            stats.bytes_in, stats.messages_out,
+                            stats.bytes_out))
+        for name, value in self.gauges():
+            informs.append(("gauge", name, value))
+        for name, h in sorted(self.reactor_lateness.items()):
+            informs.append(("reactor", name, h.count, "%.6f" % h.mean(),
+                            "%.6f" % h.percentile(0.5),
+                            "%.6f" % h.percentile(0.99), "%.6f" % h.max))
+        return informs
+
+
+class ProfileHook(object):
+    """Base class for hooks called around profiled methods.
+
+    Subclasses override :meth:`before` and :meth:`after`, e.g. to enable
+    and disable a cProfile.Profile or to export trace spans.
+
+    The events are 'request', 'inform' and 'reply' around the
+    handle_request, handle_inform and handle_reply methods of a server or
+    client. A device server also calls its hooks on 'strategy-update'
+    around the update(sensor) calls through which Sensor.notify tells its
+    sampling strategies about a new reading, and on 'strategy-inform'
+    around the inform() calls of those strategies.
+    """
+
+    def before(self, event, args):
+        """Called before the profiled method.
+
+        Parameters
+        ----------
+        event : str
+            The name of the profiled event.
+        args : tuple
+            The positional arguments of the method call. For the strategy
+            events the first argument is the strategy.
+        """
+
+    def after(self, event, args, start, end):
+        """Called after the profiled method, even if it raised.
+
+        Parameters
+        ----------
+        event : str
+            The name of the profiled event.
+        args : tuple
+            The positional arguments of the method call.
+        start : float
+            Time the method was called, in seconds since the epoch.
+        end : float
+            Time the method returned, in seconds since the epoch.
+        """
+
+
+def profiled(event, method, hooks):
+    """Return method wrapped to call hooks before and after it.
+
+    Parameters
+    ----------
+    event : str
+        The event name passed to the hooks.
+    method : callable
+        The method to wrap.
+    hooks : list of ProfileHook objects
+        The hooks to call. The list is read on every call, so hooks added
+        to it later are called too.
+    """
+    _time = time.time
+
+    def profiled_method(*args, **kwargs):
+        # the list may change in another thread while the method runs
+        active = tuple(hooks)
+        for hook in active:
+            hook.before(event, args)
+        start = _time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            end = _time()
+            for hook in active:
+                hook.after(event, args, start, end)
+    profiled_method.__name__ = getattr(method, '__name__', event)
+    profiled_method.__doc__ = getattr(method, '__doc__', None)
+    return profiled_method
+
+
+class ProfileHooks(object):
+    """Hooks installed around methods of a set of objects or classes.
+
+    The methods are only wrapped while at least one hook is installed, so
+    there is no extra function call when profiling is not in use. Hooks
+    and targets may be added and removed from any thread.
+
+    Parameters
+    ----------
+    target : object or class or None
+        The first object or class whose methods are profiled, more can be
+        added with :meth:`add_target`. Wrapping an object's methods sets
+        instance attributes that hide the class's methods; wrapping a
+        class's methods affects all its instances.
+    methods : dict
+        Map from event name to method name.
+    pass_target : bool
+        Whether the hooks get the target as the first argument when an
+        object's methods are wrapped, as they do for a class's methods.
+    """
+
+    def __init__(self, target, methods, pass_target=False):
+        self._methods = methods
+        self._pass_target = pass_target
+        self._hooks = []
+        self._counts = {}
+        self._lock = threading.Lock()
+        # target -> map from method name to the target's own attribute
+        # that the wrapper replaced (None if it had none), empty while the
+        # methods are not wrapped
+        self._targets = weakref.WeakKeyDictionary()
+        if target is not None:
+            self.add_target(target)
+
+    def add_target(self, target):
+        """Profile the methods of another object or class."""
+        with self._lock:
+            if target in self._targets:
+                return
+            self._targets[target] = {}
+            if self._hooks:
+                self._wrap(target)
+
+    def remove_target(self, target):
+        """Stop profiling the methods of an object or class."""
+        with self._lock:
+            if target not in self._targets:
+                return
+            self._unwrap(target)
+            del self._targets[target]
+
+    def add(self, hook):
+        """Add a hook, wrapping the methods if it is the first one.
+
+        Adding a hook that is already installed only counts another use
+        of it; it is still called once per event.
+        """
+        with self._lock:
+            if hook in self._counts:
+                self._counts[hook] += 1
+                return
+            if not self._hooks:
+                for target in self._targets.keys():
+                    self._wrap(target)
+            self._counts[hook] = 1
+            self._hooks.append(hook)
+
+    def remove(self, hook):
+        """Remove a hook, unwrapping the methods if it was the last one."""
+        with self._lock:
+            self._counts[hook] -= 1
+            if self._counts[hook]:
+                return
+            del self._counts[hook]
+            self._hooks.remove(hook)
+            if not self._hooks:
+                for target in self._targets.keys():
+                    self._unwrap(target)
+
+    def _wrap(self, target):
+        originals = self._targets[target]
+        bind = self._pass_target and not isinstance(target, type)
+        for event, name in self._methods.items():
+            originals[name] = vars(target).get(name)
+            if bind:
+                wrapper = MethodType(profiled(
+                    event, getattr(type(target), name), self._hooks), target)
+            else:
+                wrapper = profiled(event, getattr(target, name), self._hooks)
+            setattr(target, name, wrapper)
+
+    def _unwrap(self, target):
+        originals = self._targets[target]
+        for name, original in originals.items():
+            if original is None:
+                delattr(target, name)
+            else:
+                setattr(target, name, original)
+        originals.clear()
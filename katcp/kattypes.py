@@ -8,6 +8,7 @@
    """
 
 import inspect
+from array import array
 from functools import partial
 import struct
 import re
@@ -124,6 +125,169 @@ class KatcpType(object):
             self.check(value, major)
         return value
 
+    def pack_many(self, values, nocheck=False, major=DEFAULT_KATCP_MAJOR):
+        """Pack a sequence of values.
+
+        Sub-classes may override this to process the whole sequence at
+        once. It is used for the extra values of a multiple parameter.
+
+        Parameters
+        ----------
+        values : sequence, e.g. list or array.array
+            The values to pack.
+        nocheck : bool
+            Whether to check that the values are valid before
+            packing them.
+        major : int. Defaults to latest implemented KATCP version (5)
+             Major version of KATCP to use when interpreting types
+
+        Returns
+        -------
+        packed_values : list of str
+            The unescaped KATCP strings representing the values.
+        """
+        return [self.pack(value, nocheck, major) for value in values]
+
+    def unpack_many(self, packed_values, major=DEFAULT_KATCP_MAJOR,
+                    typecode=None):
+        """Parse a sequence of KATCP parameters.
+
+        See :meth:`pack_many`.
+
+        Parameters
+        ----------
+        packed_values : sequence of str
+            The unescaped KATCP strings to parse.
+        major : int. Defaults to latest implemented KATCP version (5)
+             Major version of KATCP to use when interpreting types
+        typecode : str or None
+            If given, return the values in an array.array with this
+            typecode instead of a list.
+
+        Returns
+        -------
+        values : list or array.array
+            The values the KATCP strings represented.
+        """
+        unpack = self.unpacker(major)
+        values = [unpack(packed_value) for packed_value in packed_values]
+        return values if typecode is None else array(typecode, values)
+
+    def packer(self, major=DEFAULT_KATCP_MAJOR):
+        """Return a function that packs values like :meth:`pack`.
+
+        The request and reply decorators build their codecs from these
+        functions once, when the handler is decorated. Sub-classes may
+        return a specialised function.
+
+        Parameters
+        ----------
+        major : int. Defaults to latest implemented KATCP version (5)
+             Major version of KATCP to use when interpreting types
+
+        Returns
+        -------
+        pack : function
+            Function taking a value and returning the packed value.
+        """
+        return partial(self.pack, major=major)
+
+    def unpacker(self, major=DEFAULT_KATCP_MAJOR):
+        """Return a function that unpacks values like :meth:`unpack`.
+
+        See :meth:`packer`.
+
+        Parameters
+        ----------
+        major : int. Defaults to latest implemented KATCP version (5)
+             Major version of KATCP to use when interpreting types
+
+        Returns
+        -------
+        unpack : function
+            Function taking a packed value and returning the value.
+        """
+        return partial(self.unpack, major=major)
+
+    def _is_plain(self, cls):
+        """Whether this type codes values exactly like instances of cls.
+
+        Specialised packers and unpackers inline the code of cls, so they
+        may only be used if a sub-class has not overridden any of it.
+        """
+        kattype = type(self)
+        for name in ('encode', 'decode', 'check', 'pack', 'unpack',
+                     'get_default'):
+            if getattr(kattype, name).im_func is not \
+                    getattr(cls, name).im_func:
+                return False
+        return True
+
+
+def _range_packer(kattype, cls, encode, major):
+    """Packer for Int and Float that only calls check() on failure."""
+    generic = KatcpType.packer(kattype, major)
+    if not kattype._is_plain(cls):
+        return generic
+    check, min_, max_ = kattype.check, kattype._min, kattype._max
+
+    def pack(value):
+        if value is None:
+            return generic(value)
+        if (min_ is not None and value < min_) or \
+                (max_ is not None and value > max_):
+            check(value, major)
+        return encode % (value,)
+    return pack
+
+
+def _range_unpacker(kattype, cls, convert, major):
+    """Unpacker for Int and Float that fuses decode and check."""
+    generic = KatcpType.unpacker(kattype, major)
+    if not kattype._is_plain(cls):
+        return generic
+    check, min_, max_ = kattype.check, kattype._min, kattype._max
+
+    def unpack(packed_value):
+        if packed_value is None:
+            return generic(packed_value)
+        try:
+            value = convert(packed_value)
+        except Exception:
+            # let decode() raise its usual error
+            return generic(packed_value)
+        if (min_ is not None and value < min_) or \
+                (max_ is not None and value > max_):
+            check(value, major)
+        return value
+    return unpack
+
+
+def _check_range(kattype, values, major):
+    """Range check a sequence of Int or Float values in one pass."""
+    min_, max_ = kattype._min, kattype._max
+    # compare every value since min() and max() are confused by NaNs
+    if (min_ is not None and any(value < min_ for value in values)) or \
+            (max_ is not None and any(value > max_ for value in values)):
+        # find the offending value and raise the usual error
+        for value in values:
+            kattype.check(value, major)
+
+
+def _convert_many(kattype, cls, convert, packed_values, major, typecode):
+    """Bulk unpack_many for types whose decode() is a plain conversion.
+
+    Returns None if the values have to be unpacked one by one, either
+    because a sub-class changed the coding or to raise the usual error.
+    """
+    if not kattype._is_plain(cls) or None in packed_values:
+        return None
+    try:
+        values = map(convert, packed_values)
+    except Exception:
+        return None
+    return values if typecode is None else array(typecode, values)
+
 
 class Int(KatcpType):
     """The KATCP integer type.
@@ -163,6 +327,29 @@ class Int(KatcpType):
             raise ValueError("Integer %d is higher than maximum %d."
                 % (value, self._max))
 
+    def pack_many(self, values, nocheck=False, major=DEFAULT_KATCP_MAJOR):
+        if not self._is_plain(Int) or None in values:
+            return super(Int, self).pack_many(values, nocheck, major)
+        if not nocheck:
+            _check_range(self, values, major)
+        return map("%d".__mod__, values)
+
+    def unpack_many(self, packed_values, major=DEFAULT_KATCP_MAJOR,
+                    typecode=None):
+        values = _convert_many(self, Int, int, packed_values, major,
+                               typecode)
+        if values is None:
+            return super(Int, self).unpack_many(packed_values, major,
+                                                typecode)
+        _check_range(self, values, major)
+        return values
+
+    def packer(self, major=DEFAULT_KATCP_MAJOR):
+        return _range_packer(self, Int, "%d", major)
+
+    def unpacker(self, major=DEFAULT_KATCP_MAJOR):
+        return _range_unpacker(self, Int, int, major)
+
 
 class Float(KatcpType):
     """The KATCP float type.
@@ -201,6 +388,29 @@ class Float(KatcpType):
             raise ValueError("Float %g is higher than maximum %g."
                 % (value, self._max))
 
+    def pack_many(self, values, nocheck=False, major=DEFAULT_KATCP_MAJOR):
+        if not self._is_plain(Float) or None in values:
+            return super(Float, self).pack_many(values, nocheck, major)
+        if not nocheck:
+            _check_range(self, values, major)
+        return map("%.15g".__mod__, values)
+
+    def unpack_many(self, packed_values, major=DEFAULT_KATCP_MAJOR,
+                    typecode=None):
+        values = _convert_many(self, Float, float, packed_values, major,
+                               typecode)
+        if values is None:
+            return super(Float, self).unpack_many(packed_values, major,
+                                                  typecode)
+        _check_range(self, values, major)
+        return values
+
+    def packer(self, major=DEFAULT_KATCP_MAJOR):
+        return _range_packer(self, Float, "%.15g", major)
+
+    def unpacker(self, major=DEFAULT_KATCP_MAJOR):
+        return _range_unpacker(self, Float, float, major)
+
 
 class Bool(KatcpType):
     """The KATCP boolean type."""
@@ -214,6 +424,44 @@ class Bool(KatcpType):
             raise ValueError("Boolean value must be 0 or 1.")
         return value == "1"
 
+    def pack_many(self, values, nocheck=False, major=DEFAULT_KATCP_MAJOR):
+        if not self._is_plain(Bool) or None in values:
+            return super(Bool, self).pack_many(values, nocheck, major)
+        return [value and "1" or "0" for value in values]
+
+    def unpack_many(self, packed_values, major=DEFAULT_KATCP_MAJOR,
+                    typecode=None):
+        if not self._is_plain(Bool) or \
+                not set(packed_values) <= set(("0", "1")):
+            return super(Bool, self).unpack_many(packed_values, major,
+                                                 typecode)
+        values = [packed_value == "1" for packed_value in packed_values]
+        return values if typecode is None else array(typecode, values)
+
+    def packer(self, major=DEFAULT_KATCP_MAJOR):
+        generic = super(Bool, self).packer(major)
+        if not self._is_plain(Bool):
+            return generic
+
+        def pack(value):
+            if value is None:
+                return generic(value)
+            return value and "1" or "0"
+        return pack
+
+    def unpacker(self, major=DEFAULT_KATCP_MAJOR):
+        generic = super(Bool, self).unpacker(major)
+        if not self._is_plain(Bool):
+            return generic
+
+        def unpack(packed_value):
+            if packed_value == "1":
+                return True
+            if packed_value == "0":
+                return False
+            return generic(packed_value)
+        return unpack
+
 
 class Str(KatcpType):
     """The KATCP string type."""
@@ -262,6 +510,38 @@ class Discrete(Str):
             raise ValueError("Discrete value '%s' is not one of %s%s."
                 % (value, list(self._values), caseflag))
 
+    def _codec(self, generic, major):
+        """Packer or unpacker checking membership without calling check().
+        """
+        if not self._is_plain(Discrete):
+            return generic
+        check = self.check
+        if self._case_insensitive:
+            values = self._valid_values_lower
+
+            def code(value):
+                if value is None:
+                    return generic(value)
+                if value.lower() not in values:
+                    check(value, major)
+                return value
+        else:
+            values = self._valid_values
+
+            def code(value):
+                if value is None:
+                    return generic(value)
+                if value not in values:
+                    check(value, major)
+                return value
+        return code
+
+    def packer(self, major=DEFAULT_KATCP_MAJOR):
+        return self._codec(super(Discrete, self).packer(major), major)
+
+    def unpacker(self, major=DEFAULT_KATCP_MAJOR):
+        return self._codec(super(Discrete, self).unpacker(major), major)
+
 
 class Lru(KatcpType):
     """The KATCP lru type"""
@@ -359,6 +639,24 @@ class Timestamp(KatcpType):
             decoded = decoded * MS_TO_SEC_FAC
         return decoded
 
+    def pack_many(self, values, nocheck=False, major=DEFAULT_KATCP_MAJOR):
+        if not self._is_plain(Timestamp) or None in values:
+            return super(Timestamp, self).pack_many(values, nocheck, major)
+        if major >= SEC_TS_KATCP_MAJOR:
+            return map("%.6f".__mod__, map(float, values))
+        return ["%i" % int(float(value) * SEC_TO_MS_FAC) for value in values]
+
+    def unpack_many(self, packed_values, major=DEFAULT_KATCP_MAJOR,
+                    typecode=None):
+        values = _convert_many(self, Timestamp, float, packed_values, major,
+                               None)
+        if values is None:
+            return super(Timestamp, self).unpack_many(packed_values, major,
+                                                      typecode)
+        if major < SEC_TS_KATCP_MAJOR:
+            values = [value * MS_TO_SEC_FAC for value in values]
+        return values if typecode is None else array(typecode, values)
+
 
 class TimestampOrNow(Timestamp):
     """KatcpType representing either a Timestamp or the special value
@@ -650,18 +948,19 @@ def request(*types, **options):
             params_start += 1
         # Get other parameter names
         argnames = all_argnames[params_start:]
+        unpack = compile_unpacker(types, argnames, major)
 
         def raw_handler(self, *args):
             if has_req:
                 (req, msg) = args
-                new_args = unpack_types(types, msg.arguments, argnames, major)
+                new_args = unpack(msg.arguments)
                 if include_msg:
                     return handler(self, req, msg, *new_args)
                 else:
                     return handler(self, req, *new_args)
             else:
                 (msg,) = args
-                new_args = unpack_types(types, msg.arguments, argnames, major)
+                new_args = unpack(msg.arguments)
                 if include_msg:
                     return handler(self, msg, *new_args)
                 else:
@@ -768,10 +1067,11 @@ def return_reply(*types, **options):
             raise ValueError("This decorator can only be used on a katcp"
                              " request handler.")
         msgname = handler.__name__[8:].replace("_", "-")
+        reply = compile_reply_maker(types, major)
 
         def raw_handler(self, *args):
             reply_args = handler(self, *args)
-            return make_reply(msgname, types, reply_args, major)
+            return reply(msgname, reply_args)
         raw_handler.__name__ = handler.__name__
         raw_handler.__doc__ = handler.__doc__
 
@@ -825,11 +1125,13 @@ def send_reply(*types, **options):
         raise TypeError('send_reply does not take keyword argument(s) %r.'
                         % options.keys())
 
+    reply_maker = compile_reply_maker(types, major)
+
     def decorator(handler):
         def raw_handler(self, *args):
             reply_args = handler(self, *args)
             req = reply_args[0]
-            reply = make_reply(req.msg.name, types, reply_args[1:], major)
+            reply = reply_maker(req.msg.name, reply_args[1:])
             req.reply_with_message(reply)
         return raw_handler
 
@@ -850,14 +1152,37 @@ def make_reply(msgname, types, arguments, major):
     major : integer
         Major version of KATCP to use when packing types
     """
-    status = arguments[0]
-    if status == "fail":
-        return Message.reply(
-            msgname, *pack_types((Str(), Str()), arguments, major))
-    if status == "ok":
-        return Message.reply(
-            msgname, *pack_types((Str(),) + types, arguments, major))
-    raise ValueError("First returned value must be 'ok' or 'fail'.")
+    return compile_reply_maker(types, major)(msgname, arguments)
+
+
+def compile_reply_maker(types, major):
+    """Build a function that constructs replies like :func:`make_reply`.
+
+    Parameters
+    ----------
+    types : list of kattypes
+        The types of the reply message parameters (in order).
+    major : integer
+        Major version of KATCP to use when packing types
+
+    Returns
+    -------
+    make_reply : function
+        Function taking the reply name and the (unpacked) reply message
+        parameters and returning the reply message.
+    """
+    pack_ok = compile_packer((Str(),) + tuple(types), major)
+    pack_fail = compile_packer((Str(), Str()), major)
+    reply = Message.reply
+
+    def make_reply(msgname, arguments):
+        status = arguments[0]
+        if status == "fail":
+            return reply(msgname, *pack_fail(arguments))
+        if status == "ok":
+            return reply(msgname, *pack_ok(arguments))
+        raise ValueError("First returned value must be 'ok' or 'fail'.")
+    return make_reply
 
 
 def unpack_types(types, args, argnames, major):
@@ -874,29 +1199,65 @@ def unpack_types(types, args, argnames, major):
     major : integer
         Major version of KATCP to use when packing types
     """
-    if len(types) > 0:
-        multiple = types[-1]._multiple
-    else:
-        multiple = False
+    return compile_unpacker(types, argnames, major)(args)
 
-    if len(types) < len(args) and not multiple:
-        raise FailReply("Too many parameters given.")
 
-    # Wrap the types in parameter objects
-    params = []
-    for i, kattype in enumerate(types):
-        name = ""
-        if i < len(argnames):
-            name = argnames[i]
-        params.append(Parameter(i+1, name, kattype, major))
+def compile_unpacker(types, argnames, major):
+    """Build a function that parses arguments like :func:`unpack_types`.
 
+    The unpacker of each type and the names used in error messages are
+    looked up once, so parsing a message only calls one function per
+    argument.
 
-    if len(args) > len(types) and multiple:
-        for i in range(len(types), len(args)):
-            params.append(Parameter(i+1, name, kattype, major))
+    Parameters
+    ----------
+    types : list of kattypes
+        The types of the arguments (in order).
+    argnames : list of strings
+        The names of the arguments.
+    major : integer
+        Major version of KATCP to use when packing types
 
-    # if len(args) < len(types) this passes in None for missing args
-    return map(lambda param, arg: param.unpack(arg), params, args)
+    Returns
+    -------
+    unpack : function
+        Function taking the list of arguments and returning the list of
+        parsed values. Missing arguments are passed to the types as None.
+    """
+    types = tuple(types)
+    ntypes = len(types)
+    multiple = ntypes > 0 and types[-1]._multiple
+    unpackers = [kattype.unpacker(major) for kattype in types]
+    names = [argnames[i] if i < len(argnames) else "" for i in range(ntypes)]
+    last_unpacker = unpackers[-1] if multiple else None
+    unpack_tail = partial(types[-1].unpack_many, major=major) \
+                  if multiple else None
+
+    def unpack(args):
+        nargs = len(args)
+        if nargs > ntypes and not multiple:
+            raise FailReply("Too many parameters given.")
+        values = []
+        i = 0
+        try:
+            for i in xrange(ntypes):
+                values.append(unpackers[i](args[i] if i < nargs else None))
+            if nargs > ntypes:
+                i = ntypes
+                try:
+                    values.extend(unpack_tail(args[ntypes:]))
+                except ValueError:
+                    # unpack one by one to find the offending parameter
+                    for i in xrange(ntypes, nargs):
+                        last_unpacker(args[i])
+                    raise
+        except ValueError, message:
+            # Wrap errors in FailReplies with information identifying the
+            # parameter
+            raise FailReply("Error in parameter %s (%s): %s" %
+                            (i + 1, names[min(i, ntypes - 1)], message))
+        return values
+    return unpack
 
 def pack_types(types, args, major):
     """Pack arguments according the the types list.
@@ -910,23 +1271,42 @@ def pack_types(types, args, major):
     major : integer
         Major version of KATCP to use when packing types
     """
-    if len(types) > 0:
-        multiple = types[-1]._multiple
-    else:
-        multiple = False
+    return compile_packer(types, major)(args)
 
-    if len(types) < len(args) and not multiple:
-        raise ValueError("Too many arguments to pack.")
 
-    if len(args) < len(types):
-        # this passes in None for missing args
-        retvals = map(lambda ktype, arg: ktype.pack(arg, major=major), types, args)
-    else:
-        retvals = [ktype.pack(arg, major=major) for ktype, arg in zip(types, args)]
+def compile_packer(types, major):
+    """Build a function that packs arguments like :func:`pack_types`.
 
-    if len(args) > len(types) and multiple:
-        last_ktype = types[-1]
-        for arg in args[len(types):]:
-            retvals.append(last_ktype.pack(arg, major=major))
+    Parameters
+    ----------
+    types : list of kattypes
+        The types of the arguments (in order).
+    major : integer
+        Major version of KATCP to use when packing types
 
-    return retvals
+    Returns
+    -------
+    pack : function
+        Function taking the list of arguments and returning the list of
+        packed values. Missing arguments are passed to the types as None.
+    """
+    types = tuple(types)
+    ntypes = len(types)
+    multiple = ntypes > 0 and types[-1]._multiple
+    packers = [kattype.packer(major) for kattype in types]
+    pack_tail = partial(types[-1].pack_many, major=major) \
+                if multiple else None
+
+    def pack(args):
+        nargs = len(args)
+        if nargs > ntypes and not multiple:
+            raise ValueError("Too many arguments to pack.")
+        if nargs == ntypes:
+            return [packer(arg) for packer, arg in zip(packers, args)]
+        # this passes in None for missing args
+        retvals = [packers[i](args[i] if i < nargs else None)
+                   for i in xrange(ntypes)]
+        if nargs > ntypes:
+            retvals.extend(pack_tail(args[ntypes:]))
+        return retvals
+    return pack
@@ -15,8 +15,15 @@ import heapq
 import Queue
 import os
 
+from array import array
 from functools import partial
 from .core import Message, Sensor, ExcepthookThread, SEC_TO_MS_FAC, MS_TO_SEC_FAC
+from .instrumentation import LatencyHistogram
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 log = logging.getLogger("katcp.sampling")
@@ -253,6 +260,10 @@ class SampleDifferential(SampleStrategy):
     Sends updates only when the value has changed by more than some
     specified threshold, or the status changes.
     """
+
+    ## @brief DifferentialGroup evaluating this strategy, if any.
+    _group = None
+
     def __init__(self, inform_callback, sensor, *params):
         SampleStrategy.__init__(self, inform_callback, sensor, *params)
         if len(params) != 1:
@@ -289,14 +300,38 @@ class SampleDifferential(SampleStrategy):
                 abs(value - self._lastValue) > self._threshold:
             self._lastStatus = status
             self._lastValue = value
+            group = self._group  # may be removed in another thread
+            if group is not None:
+                group.sync(self)
             self.inform()
 
+    def group_state(self):
+        """Return the state a DifferentialGroup needs to filter updates.
+
+        Returns
+        -------
+        status : Sensor status constant
+            The last reported status.
+        value : int or float
+            The last reported value.
+        threshold : int or float
+            The change in value that triggers an update.
+        deadline : float in seconds
+            The time after which any update should be reported.
+        """
+        return self._lastStatus, self._lastValue, self._threshold, 1e99
+
     def get_sampling(self):
         return SampleStrategy.DIFFERENTIAL
 
     def attach(self):
         self.update(self._sensor)
-        super(SampleDifferential, self).attach()
+        if not DifferentialGroup.attach_strategy(self):
+            super(SampleDifferential, self).attach()
+
+    def detach(self):
+        if not DifferentialGroup.detach_strategy(self):
+            super(SampleDifferential, self).detach()
 
 class SamplePeriod(SampleStrategy):
     """Periodic sampling strategy.
@@ -429,6 +464,9 @@ class SampleDifferentialRate(SampleStrategy):
     implemented for float and integer sensors.
     """
 
+    ## @brief DifferentialGroup evaluating this strategy, if any.
+    _group = None
+
     def __init__(self, inform_callback, sensor, *params):
         SampleStrategy.__init__(self, inform_callback, sensor, *params)
         if len(params) != 3:
@@ -481,6 +519,9 @@ class SampleDifferentialRate(SampleStrategy):
         if past_longest or sensor_changed:
             self._not_before = now + self._shortest_period
             self._last_sv = (status, value)
+            group = self._group  # may be removed in another thread
+            if group is not None:
+                group.sync(self)
             self.inform()
 
     def periodic(self, timestamp):
@@ -490,14 +531,311 @@ class SampleDifferentialRate(SampleStrategy):
         # approximate age of the universe
         return np if np < 4.32329886e17 else None
 
+    def group_state(self):
+        """Return the state a DifferentialGroup needs to filter updates.
+
+        See :meth:`SampleDifferential.group_state`.
+        """
+        last_s, last_v = self._last_sv
+        return (last_s, last_v, self.difference,
+                self._not_before + self._not_after_delta)
+
     def get_sampling(self):
         return SampleStrategy.DIFFERENTIAL_RATE
 
     def attach(self):
         self.update(self._sensor)
-        super(SampleDifferentialRate, self).attach()
+        if not DifferentialGroup.attach_strategy(self):
+            super(SampleDifferentialRate, self).attach()
+
+    def detach(self):
+        if not DifferentialGroup.detach_strategy(self):
+            super(SampleDifferentialRate, self).detach()
+
+
+class DifferentialGroup(object):
+    """Evaluate the differential strategies on a SensorBank together.
+
+    Differential and differential-rate strategies on sensors that belong to
+    a SensorBank attach to the group of the bank instead of to the sensor.
+    When a run of sensors is updated with SensorBank.set_values() the group
+    compares the new values against the last reported values and thresholds
+    of the strategies on the updated slots only, and only calls .update() on
+    the strategies that may report. The comparison is done with NumPy masks
+    if NumPy is available and in a Python loop otherwise. Updates of a
+    single sensor go straight to the strategies of that sensor.
+
+    Strategies may be added, removed and updated from different threads.
+    The group only holds its lock while it touches its arrays, never while
+    it calls the strategies.
+
+    Parameters
+    ----------
+    bank : SensorBank object
+        The bank whose sensors are sampled.
+    """
+
+    def __init__(self, bank):
+        self._bank = bank
+        self._lock = threading.Lock()
+        self._strategies = []
+        # strategy -> position in the arrays below
+        self._positions = {}
+        # slot -> list of strategies
+        self._by_slot = {}
+        self._slots = array('l')
+        self._last_statuses = array('b')
+        self._last_values = array('d')
+        self._thresholds = array('d')
+        self._deadlines = array('d')
+        # positions sorted by slot and the sorted slots, as NumPy arrays,
+        # None until needed after strategies are added or removed
+        self._order = None
+        self._sorted_slots = None
+
+    def __len__(self):
+        return len(self._strategies)
+
+    @classmethod
+    def for_bank(cls, bank):
+        """Return the group of a bank, creating and attaching it if needed.
+        """
+        for observer in bank.observers():
+            if isinstance(observer, cls):
+                return observer
+        group = cls(bank)
+        bank.attach(group)
+        return group
 
-class SampleReactor(ExcepthookThread):
+    @classmethod
+    def attach_strategy(cls, strategy):
+        """Add a strategy to the group of its sensor's bank.
+
+        Returns
+        -------
+        grouped : bool
+            False if the sensor is not in a bank, in which case the strategy
+            should attach to the sensor as usual.
+        """
+        bank = getattr(strategy._sensor, 'bank', None)
+        if bank is None:
+            return False
+        cls.for_bank(bank).add(strategy)
+        return True
+
+    @classmethod
+    def detach_strategy(cls, strategy):
+        """Remove a strategy from its group, if it has one.
+
+        Returns
+        -------
+        grouped : bool
+            Whether the strategy was in a group.
+        """
+        group = strategy._group
+        if group is None:
+            return False
+        group.remove(strategy)
+        return True
+
+    def add(self, strategy):
+        """Start evaluating a strategy as part of the group."""
+        slot = strategy._sensor.slot
+        with self._lock:
+            self._positions[strategy] = len(self._strategies)
+            self._strategies.append(strategy)
+            self._by_slot.setdefault(slot, []).append(strategy)
+            self._slots.append(slot)
+            self._last_statuses.append(0)
+            self._last_values.append(0.0)
+            self._thresholds.append(0.0)
+            self._deadlines.append(0.0)
+            self._order = None
+            strategy._group = self
+        self.sync(strategy)
+
+    def remove(self, strategy):
+        """Stop evaluating a strategy, detaching from the bank if empty."""
+        with self._lock:
+            pos = self._positions.pop(strategy)
+            slot = self._slots[pos]
+            slot_strategies = self._by_slot[slot]
+            slot_strategies.remove(strategy)
+            if not slot_strategies:
+                del self._by_slot[slot]
+            # move the last strategy into the vacated position
+            last = len(self._strategies) - 1
+            if pos != last:
+                moved = self._strategies[pos] = self._strategies[last]
+                self._positions[moved] = pos
+                for column in (self._slots, self._last_statuses,
+                               self._last_values, self._thresholds,
+                               self._deadlines):
+                    column[pos] = column[last]
+            del self._strategies[last]
+            for column in (self._slots, self._last_statuses,
+                           self._last_values, self._thresholds,
+                           self._deadlines):
+                del column[last]
+            self._order = None
+            strategy._group = None
+            empty = not self._strategies
+        if empty:
+            self._bank.detach(self)
+
+    def sync(self, strategy):
+        """Copy the state of a strategy after it reported."""
+        status, value, threshold, deadline = strategy.group_state()
+        with self._lock:
+            pos = self._positions.get(strategy)
+            if pos is None:
+                return  # removed by another thread while it reported
+            self._last_statuses[pos] = -1 if status is None else status
+            self._last_values[pos] = 0.0 if value is None else value
+            self._thresholds[pos] = threshold
+            self._deadlines[pos] = deadline
+
+    def update_bank(self, bank, start, stop):
+        """Evaluate the strategies on sensors in slots start to stop - 1."""
+        if stop - start == 1:
+            with self._lock:
+                strategies = list(self._by_slot.get(start, ()))
+            if strategies:
+                sensor = strategies[0]._sensor
+                for strategy in strategies:
+                    strategy.update(sensor)
+            return
+        now = time.time()
+        _timestamps, statuses, values = bank.columns()
+        with self._lock:
+            if numpy is not None:
+                candidates = self._numpy_candidates(statuses, values,
+                                                    start, stop, now)
+            else:
+                candidates = self._candidates(statuses, values,
+                                              start, stop, now)
+        for strategy in candidates:
+            strategy.update(strategy._sensor)
+
+    def _candidates(self, statuses, values, start, stop, now):
+        """Return the strategies on slots start to stop - 1 that may report.
+
+        Must be called with the lock held.
+        """
+        by_slot = self._by_slot
+        if stop - start > len(by_slot):
+            slots = sorted(slot for slot in by_slot if start <= slot < stop)
+        else:
+            slots = xrange(start, stop)
+        positions = self._positions
+        last_statuses = self._last_statuses
+        last_values = self._last_values
+        thresholds = self._thresholds
+        deadlines = self._deadlines
+        candidates = []
+        for slot in slots:
+            slot_strategies = by_slot.get(slot)
+            if slot_strategies is None:
+                continue
+            status = statuses[slot]
+            value = values[slot]
+            for strategy in slot_strategies:
+                pos = positions[strategy]
+                if (status != last_statuses[pos] or
+                        abs(value - last_values[pos]) > thresholds[pos] or
+                        now >= deadlines[pos]):
+                    candidates.append(strategy)
+        return candidates
+
+    def _numpy_candidates(self, statuses, values, start, stop, now):
+        """Return the strategies on slots start to stop - 1 that may report.
+
+        Must be called with the lock held.
+        """
+        if self._order is None:
+            slots = numpy.frombuffer(self._slots, dtype=self._slots.typecode)
+            # stable, so strategies on a slot keep the order they were added
+            self._order = numpy.argsort(slots, kind='mergesort')
+            self._sorted_slots = slots[self._order]
+        low, high = numpy.searchsorted(self._sorted_slots, [start, stop])
+        if low == high:
+            return []
+        positions = self._order[low:high]
+        offsets = self._sorted_slots[low:high] - start
+        # copies of the updated part of the bank columns, which another
+        # thread may resize
+        new_statuses = numpy.frombuffer(statuses[start:stop],
+                                        dtype=statuses.typecode)[offsets]
+        new_values = numpy.frombuffer(values[start:stop],
+                                      dtype=values.typecode)[offsets]
+        last_statuses = numpy.frombuffer(
+            self._last_statuses, dtype=self._last_statuses.typecode)
+        last_values = numpy.frombuffer(self._last_values,
+                                       dtype=self._last_values.typecode)
+        thresholds = numpy.frombuffer(self._thresholds,
+                                      dtype=self._thresholds.typecode)
+        deadlines = numpy.frombuffer(self._deadlines,
+                                     dtype=self._deadlines.typecode)
+        report = ((new_statuses != last_statuses[positions]) |
+                  (numpy.abs(new_values - last_values[positions]) >
+                   thresholds[positions]) |
+                  (deadlines[positions] <= now))
+        strategies = self._strategies
+        return [strategies[pos] for pos in positions[report]]
+
+
+class LatenessMonitor(object):
+    """Mixin for sample reactors that track how late periodic samples fire.
+
+    Subclasses call :meth:`_init_lateness` from their constructor, must
+    provide a `_logger` attribute and call :meth:`_record_lateness` each time
+    a periodic sample fires.
+
+    Attributes
+    ----------
+    lateness : dict
+        Map from strategy name to a LatencyHistogram of how late its periodic
+        samples fired.
+    """
+    def _init_lateness(self, late_fraction, late_warning_interval):
+        self.lateness = {}
+        self.late_fraction = late_fraction
+        self.late_warning_interval = late_warning_interval
+        self._late_samples = 0  # late samples since the last warning
+        self._next_late_warning = 0.0
+
+    def _record_lateness(self, strategy, lateness, period):
+        """Record how late a periodic sample fired and warn if too late.
+
+        Parameters
+        ----------
+        strategy : SampleStrategy object
+            The strategy whose periodic sample fired.
+        lateness : float
+            Time between the scheduled and the actual firing, in seconds.
+        period : float
+            Time until the strategy's next scheduled sample, in seconds.
+        """
+        name = strategy.SAMPLING_LOOKUP.get(strategy.get_sampling())
+        histogram = self.lateness.get(name)
+        if histogram is None:
+            histogram = self.lateness[name] = LatencyHistogram()
+        histogram.add(lateness)
+
+        if period > 0 and lateness > self.late_fraction * period:
+            self._late_samples += 1
+            now = time.time()
+            if now >= self._next_late_warning:
+                self._logger.warn(
+                    "%d periodic sample(s) fired late, most recently %s "
+                    "sampling of %r %.6fs late for a %.6fs period" % (
+                        self._late_samples, name, strategy._sensor.name,
+                        lateness, period))
+                self._late_samples = 0
+                self._next_late_warning = now + self.late_warning_interval
+
+
+class SampleReactor(ExcepthookThread, LatenessMonitor):
     """SampleReactor manages sampling strategies.
 
     This class keeps track of all the sensors and what strategy
@@ -508,8 +846,20 @@ class SampleReactor(ExcepthookThread):
     ----------
     logger : logging.Logger object
         Python logger to write logs to.
+    late_fraction : float
+        Log a warning when a periodic sample fires later than this fraction
+        of the strategy's period.
+    late_warning_interval : float
+        Minimum time between lateness warnings, in seconds.
+
+    Attributes
+    ----------
+    lateness : dict
+        Map from strategy name to a LatencyHistogram of how late its periodic
+        samples fired. Only the reactor thread updates it.
     """
-    def __init__(self, logger=log):
+    def __init__(self, logger=log, late_fraction=0.5,
+                 late_warning_interval=10.0):
         super(SampleReactor, self).__init__()
         self._strategies = set()
         self._stopEvent = threading.Event()
@@ -518,6 +868,7 @@ class SampleReactor(ExcepthookThread):
         self._removal_events = Queue.Queue()
         self._adding_events = Queue.Queue()
         self._logger = logger
+        self._init_lateness(late_fraction, late_warning_interval)
         # set daemon True so that the app can stop even if the thread
         # is running
         self.setDaemon(True)
@@ -571,6 +922,10 @@ class SampleReactor(ExcepthookThread):
         self._stopEvent.set()
         self._wakeEvent.set()
 
+    def heap_size(self):
+        """Return the number of scheduled periodic sampling events."""
+        return len(self._heap)
+
     def run(self):
         """Run the sample reactor."""
         self._logger.debug("Starting thread %s" %
@@ -605,11 +960,15 @@ class SampleReactor(ExcepthookThread):
                 if wake.isSet():
                     _push(heap, (next_time, strategy))
                     continue
+                lateness = _time() - next_time
 
                 try:
+                    scheduled_time = next_time
                     next_time = strategy.periodic(next_time)
                     if next_time is not None:
                         _push(heap, (next_time, strategy))
+                        self._record_lateness(strategy, lateness,
+                                              next_time - scheduled_time)
                 except Exception, e:
                     self._logger.exception(e)
                     # push ten seconds into the future and hope whatever was
@@ -19,9 +19,19 @@
    further updates.
 
    The acyclic requirement on the graph structure is required to ensure
-   that the update chain eventually terminates. It is not enforced.
+   that the update chain eventually terminates. Adding a link that would
+   create a cycle raises a ValueError.
+
+   Updates made inside a batch (see :meth:`GenericSensorTree.batch`) only
+   mark the dependent sensors dirty. When the batch ends the dirty sensors
+   are recalculated once each, children before parents, so a bulk update of
+   many leaves recalculates every aggregate only once.
    """
 
+import heapq
+import itertools
+from contextlib import contextmanager
+
 
 class GenericSensorTree(object):
     """Holds a tree of boolean sensors.
@@ -30,17 +40,20 @@ class GenericSensorTree(object):
     of their child nodes.
     """
 
-    # TODO: consider adding detection of cycles.
-    #       Fastests method is probably maintaining a spanning tree
-    #       and checking for back edges. As always, deletions are likely
-    #       to be a bit of a pain and require tree shuffling.
-    #       Disconnected graphs will also make life a little more difficult
-
     def __init__(self):
         # map of child -> set of all parent sensors
         self._child_to_parents = {}
         # map of parent -> set of all child sensors
         self._parent_to_children = {}
+        # number of open batches
+        self._batch_depth = 0
+        # map of dirty parent -> set of child sensors updated in the batch
+        self._dirty = {}
+        # heap of (rank, count, parent) of dirty parents while flushing
+        self._flush_queue = None
+        self._flush_count = itertools.count()
+        # cache of sensor -> length of the longest path to a leaf
+        self._ranks = {}
 
     def update(self, sensor):
         """Update callback used by sensors to notify obervers of changes.
@@ -50,10 +63,126 @@ class GenericSensorTree(object):
         sensor : :class:`katcp.Sensor`
             The sensor whose value has changed.
         """
+        if self._batch_depth:
+            self._mark_dirty(sensor)
+            return
         parents = list(self._child_to_parents[sensor])
         for parent in parents:
             self.recalculate(parent, (sensor,))
 
+    def begin_batch(self):
+        """Start deferring recalculations until :meth:`end_batch`.
+
+        Batches may be nested; recalculation happens when the outermost
+        batch ends.
+        """
+        self._batch_depth += 1
+
+    def end_batch(self):
+        """End a batch, recalculating the sensors that became dirty."""
+        if not self._batch_depth:
+            raise RuntimeError("end_batch called without begin_batch.")
+        self._batch_depth -= 1
+        if not self._batch_depth and self._dirty:
+            self._flush()
+
+    @contextmanager
+    def batch(self):
+        """Context manager that groups sensor updates into one batch.
+
+        Examples
+        --------
+        >>> with tree.batch():
+        ...     for sensor, value in zip(leaves, values):
+        ...         sensor.set_value(value)
+        """
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
+
+    def _mark_dirty(self, sensor):
+        """Record that the parents of sensor need to be recalculated."""
+        for parent in self._child_to_parents[sensor]:
+            updates = self._dirty.get(parent)
+            if updates is None:
+                updates = self._dirty[parent] = set()
+                if self._flush_queue is not None:
+                    heapq.heappush(self._flush_queue, (
+                        self._rank(parent), next(self._flush_count), parent))
+            updates.add(sensor)
+
+    def _flush(self):
+        """Recalculate dirty parents once each, lowest rank first.
+
+        Parents updated by the recalculations are marked dirty in turn and
+        have a higher rank than the sensor that updated them, so each is
+        recalculated after all of its dirty children.
+        """
+        queue = self._flush_queue = [
+            (self._rank(parent), next(self._flush_count), parent)
+            for parent in self._dirty]
+        heapq.heapify(queue)
+        self._batch_depth += 1
+        try:
+            while queue:
+                _rank, _count, parent = heapq.heappop(queue)
+                updates = self._dirty.pop(parent)
+                if parent in self:
+                    self.recalculate(parent, tuple(updates))
+        finally:
+            self._batch_depth -= 1
+            self._flush_queue = None
+            self._dirty.clear()
+
+    def _rank(self, sensor):
+        """Length of the longest dependency path from sensor to a leaf."""
+        rank = self._ranks.get(sensor)
+        if rank is None:
+            children = self._parent_to_children.get(sensor)
+            if children:
+                rank = 1 + max(self._rank(child) for child in children)
+            else:
+                rank = 0
+            self._ranks[sensor] = rank
+        return rank
+
+    def _depends_on(self, sensor, other):
+        """Whether sensor depends on other, directly or indirectly."""
+        stack = [sensor]
+        seen = set()
+        while stack:
+            current = stack.pop()
+            if current is other:
+                return True
+            if current in seen:
+                continue
+            seen.add(current)
+            stack.extend(self._parent_to_children.get(current, ()))
+        return False
+
+    def check_links(self, parent, children):
+        """Check that links from parent to children would not form a cycle.
+
+        Parameters
+        ----------
+        parent : :class:`katcp.Sensor`
+            The sensor that would depend on children.
+        children : sequence of :class:`katcp.Sensor`
+            The sensors parent would depend on.
+
+        Raises
+        ------
+        ValueError
+            If parent is one of the children or any of the children already
+            depends on parent.
+        """
+        for child in children:
+            if self._depends_on(child, parent):
+                raise ValueError("Linking %r to child %r would create a"
+                                 " cycle." % (parent, child))
+
     def recalculate(self, parent, updates):
         """Re-calculate the value of parent sensor.
 
@@ -102,7 +231,8 @@ class GenericSensorTree(object):
         Any sensors not in the tree are added. After all dependency links have
         been created, the parent is recalculated and the tree attaches to any
         sensors it was not yet attached to. Links that already exist are
-        ignored.
+        ignored. Raises ValueError, without adding any links, if the new links
+        would create a cycle.
 
         Parameters
         ----------
@@ -111,6 +241,8 @@ class GenericSensorTree(object):
         children : sequence of :class:`katcp.Sensor`
             The sensors parent depends on.
         """
+        self.check_links(parent, children)
+        self._ranks.clear()
         new_sensors = []
         if parent not in self:
             self._add_sensor(parent)
@@ -141,6 +273,7 @@ class GenericSensorTree(object):
         children : list of :class:`katcp.Sensor`
             The sensors that parent used to depend on.
         """
+        self._ranks.clear()
         old_sensors = []
         if parent in self:
             for child in children:
@@ -367,6 +500,7 @@ class AggregateSensorTree(GenericSensorTree):
         if parent in self._aggregates or parent in self._incomplete_aggregates:
             raise ValueError("Sensor %r already has an aggregate rule"
                              " associated" % parent)
+        self.check_links(parent, children)
         self._aggregates[parent] = (rule_function, children)
         self.add_links(parent, children)
 
@@ -18,15 +18,19 @@ import sys
 import re
 import time
 from functools import partial
+from contextlib import contextmanager
+from collections import deque
 
 from .core import (DeviceMetaclass, ExcepthookThread, Message, MessageParser,
-                   FailReply, AsyncReply, ProtocolFlags)
+                   FailReply, AsyncReply, ProtocolFlags, Sensor,
+                   BlobReader)
 from .sampling import SampleReactor, SampleStrategy, SampleNone
 from .sampling import format_inform_v5, format_inform_v4
 from .core import (SEC_TO_MS_FAC, MS_TO_SEC_FAC, SEC_TS_KATCP_MAJOR,
                    VERSION_CONNECT_KATCP_MAJOR, DEFAULT_KATCP_MAJOR)
 from .version import VERSION, VERSION_STR
 from .kattypes import (request, return_reply)
+from .instrumentation import ServerStats, ProfileHooks
 
 log = logging.getLogger("katcp")
 
@@ -56,6 +60,110 @@ def construct_name_filter(pattern):
         return False, lambda name: name_re.search(name) is not None
     return True, lambda name: name == pattern
 
+def select_sensor_history(sensor, arguments, major=DEFAULT_KATCP_MAJOR):
+    """Select the readings requested by ?sensor-history from a sensor.
+
+    Parameters
+    ----------
+    sensor : Sensor object
+        The sensor whose history is requested.
+    arguments : list of str
+        The optional start time, end time and maximum number of readings
+        given in the request. Empty arguments leave that limit unset.
+    major : int
+        Major version of KATCP used to parse and format timestamps.
+
+    Returns
+    -------
+    samples : list of (timestamp, status, value) tuples of str
+        The selected readings formatted for the given KATCP version,
+        oldest first.
+    """
+    if getattr(sensor, 'history', None) is None:
+        raise FailReply("No history recorded for sensor %s." % sensor.name)
+    if len(arguments) > 3:
+        raise FailReply("Too many arguments.")
+    try:
+        times = [Sensor.TIMESTAMP_TYPE.decode(arg, major) if arg else None
+                 for arg in arguments[:2]]
+        start, end = times + [None] * (2 - len(times))
+        max_samples = (int(arguments[2]) if len(arguments) > 2
+                       and arguments[2] else None)
+    except ValueError, e:
+        raise FailReply(str(e))
+    if max_samples is not None and max_samples < 0:
+        raise FailReply("Maximum number of readings must not be negative.")
+    return [sensor.format_reading(reading, major) for reading in
+            sensor.history.samples(start, end, max_samples)]
+
+
+class _SendBatch(object):
+    """Messages waiting to be sent to a client socket as one send.
+
+    The lock guards the parts against the batch flusher thread. The deadline
+    is when the oldest waiting message must be sent, or None if no messages
+    are waiting.
+    """
+    __slots__ = ('parts', 'size', 'lock', 'deadline')
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.deadline = None
+
+
+class _SendBatchFlusher(object):
+    """Send batched messages that have waited past their deadline.
+
+    Batches are normally sent when the handler replies or returns. A slow
+    handler's informs are sent from a daemon thread instead, once they have
+    waited for the batch delay. The thread only runs while batches are
+    waiting.
+
+    Parameters
+    ----------
+    flush : function
+        Called as flush(sock, batch, deadline) once the deadline passes.
+    """
+    def __init__(self, flush):
+        self._flush = flush
+        self._lock = threading.Lock()
+        self._pending = deque()  # (deadline, sock, batch) in deadline order
+        self._thread = None
+
+    def schedule(self, deadline, sock, batch):
+        """Flush the messages of batch if they are still waiting at deadline."""
+        with self._lock:
+            self._pending.append((deadline, sock, batch))
+            if self._thread is None:
+                self._thread = ExcepthookThread(target=self._run,
+                                                name="SendBatchFlusher")
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _run(self):
+        # save globals so that the thread can run cleanly
+        # even while Python is setting module globals to
+        # None.
+        _time = time.time
+        _sleep = time.sleep
+        pending = self._pending
+        while True:
+            with self._lock:
+                if not pending:
+                    self._thread = None
+                    return
+                deadline, sock, batch = pending[0]
+                delay = deadline - _time()
+                if delay <= 0:
+                    pending.popleft()
+            if delay > 0:
+                _sleep(delay)
+            else:
+                self._flush(sock, batch, deadline)
+
+
 class ClientConnectionTCP(object):
     # XXX TODO We should factor the whole TCP select loop (or future twisted
     # implementation?) out of the server class and into a Connection class that
@@ -104,6 +212,9 @@ orig_req : Message object
     id is overridden with the id from orig_req before the
     reply is sent.
 """)
+        # whether the client asked for bulk-data blobs with ?bulk-data,
+        # messages to other clients carry blob arguments escaped inline
+        self.bulk_data = False
 
 
 class ClientRequestConnection(object):
@@ -174,6 +285,9 @@ class DeviceServerBase(object):
 
     __metaclass__ = DeviceMetaclass
     MAX_DEFERRED_QUEUE_SIZE = 100000      # Maximum size of deferred action queue
+    MAX_SEND_BATCH_SIZE = 65536   # Bytes of batched messages that force a send
+    MAX_SEND_BATCH_DELAY = 0.05   # Seconds a batched message may wait
+    MAX_LINE_LENGTH = 64 * (2 ** 20)  # Longest message line accepted, in bytes
 
     ## @brief Protocol versions and flags. Default to version 5, subclasses
     ## should override PROTOCOL_INFO
@@ -184,7 +298,7 @@ class DeviceServerBase(object):
 
 
     def __init__(self, host, port, tb_limit=20, logger=log):
-        self._parser = MessageParser()
+        self._parser = MessageParser(bulk_data=self.PROTOCOL_INFO.bulk_data)
         self._bindaddr = (host, port)
         self._tb_limit = tb_limit
         self._running = threading.Event()
@@ -198,7 +312,22 @@ class DeviceServerBase(object):
         self._data_lock = threading.Lock()
         self._socks = []  # list of client sockets
         self._waiting_chunks = {}  # map from client sockets to messages pieces
+        # client sockets whose input is discarded up to the next line end
+        # because the current line is longer than MAX_LINE_LENGTH
+        self._discarding = set()
+        # map from client sockets to BlobReaders for bulk-data messages
+        self._waiting_blobs = {}
         self._sock_locks = {}  # map from client sockets to sending locks
+        # per-thread map from client sockets to batched outgoing messages
+        self._send_batches = threading.local()
+        self._send_batch_flusher = _SendBatchFlusher(self._flush_late_batch)
+        # ServerStats object, or None if performance counters are disabled
+        self._perf_stats = None
+        self._profile_hooks = ProfileHooks(self, {
+            "request": "handle_request",
+            "inform": "handle_inform",
+            "reply": "handle_reply",
+        })
         # map from sockets to ClientConnectionTCP objects
         self._sock_connections = {}
 
@@ -245,7 +374,8 @@ class DeviceServerBase(object):
         """Add a client socket to the socket and chunk lists."""
         with self._data_lock:
             self._socks.append(sock)
-            self._waiting_chunks[sock] = ""
+            self._waiting_chunks[sock] = bytearray()
+            self._waiting_blobs[sock] = None
             self._sock_locks[sock] = threading.Lock()
             self._sock_connections[sock] = ClientConnectionTCP(self, sock)
 
@@ -257,11 +387,38 @@ class DeviceServerBase(object):
             if sock in self._socks:
                 self._socks.remove(sock)
                 del self._waiting_chunks[sock]
+                del self._waiting_blobs[sock]
+                self._discarding.discard(sock)
+                if self._perf_stats is not None:
+                    self._perf_stats.remove_connection(sock)
                 del self._sock_locks[sock]
                 del self._sock_connections[sock]
         finally:
             self._data_lock.release()
 
+    def add_profile_hook(self, hook):
+        """Call a profiling hook around message handling.
+
+        The hook is called around this server's handle_request,
+        handle_inform and handle_reply.
+
+        Parameters
+        ----------
+        hook : katcp.instrumentation.ProfileHook object
+            The hook to add.
+        """
+        self._profile_hooks.add(hook)
+
+    def remove_profile_hook(self, hook):
+        """Remove a profiling hook added by :meth:`add_profile_hook`.
+
+        Parameters
+        ----------
+        hook : katcp.instrumentation.ProfileHook object
+            The hook to remove.
+        """
+        self._profile_hooks.remove(hook)
+
     def get_sockets(self):
         """Return the complete list of current client socket.
 
@@ -274,16 +431,55 @@ class DeviceServerBase(object):
 
     def _handle_chunk(self, sock, chunk):
         """Handle a chunk of data for socket sock."""
+        if self._perf_stats is not None:
+            self._perf_stats.received(sock, len(chunk))
+        while chunk:
+            reader = self._waiting_blobs.get(sock)
+            if reader is not None:
+                # raw bulk data following a message line
+                chunk = reader.feed(chunk)
+                if not reader.complete:
+                    return
+                self._waiting_blobs[sock] = None
+                self._dispatch_message(sock, reader.msg)
+            else:
+                chunk = self._handle_lines(sock, chunk)
+
+    def _handle_lines(self, sock, chunk):
+        """Handle lines of data for socket sock.
+
+        Returns the remainder of the chunk following a message line that
+        references bulk-data blobs, or an empty string.
+        """
+        raw_chunk = chunk
         chunk = chunk.replace("\r", "\n")
         lines = chunk.split("\n")
 
-        waiting_chunk = self._waiting_chunks.get(sock, "")
+        # partial lines are collected in a bytearray so that long lines
+        # arriving in many chunks are not copied for every chunk
+        waiting_chunk = self._waiting_chunks.get(sock)
+        if waiting_chunk is None:
+            # the socket was removed, carry on with a throwaway buffer
+            waiting_chunk = bytearray()
+        discarding = sock in self._discarding
+        position = 0
 
         for line in lines[:-1]:
-            full_line = waiting_chunk + line
-            waiting_chunk = ""
+            position += len(line) + 1
+            if discarding:
+                # the end of a line that was too long
+                discarding = False
+                self._discarding.discard(sock)
+                continue
+            if waiting_chunk:
+                full_line = str(waiting_chunk) + line
+                del waiting_chunk[:]
+            else:
+                full_line = line
 
-            if full_line:
+            if len(full_line) > self.MAX_LINE_LENGTH:
+                self._line_too_long(sock, len(full_line))
+            elif full_line:
                 try:
                     msg = self._parser.parse(full_line)
                 # We do want to catch everything that inherits from Exception
@@ -295,19 +491,52 @@ class DeviceServerBase(object):
                     self._logger.error("BAD COMMAND: %s in line %r" % (
                         reason, full_line))
                     self.tcp_inform(sock, self._log_msg("error", reason, "root"))
-                else:
-                    try:
-                        client_conn = self._sock_connections[sock]
-                    except KeyError:
-                        self._logger.warn(
-                        'Client disconnected while handling received message: %r'
-                        % sock)
-                    else:
-                        self.handle_message(client_conn, msg)
-
-        with self._data_lock:
-            if sock in self._waiting_chunks:
-                self._waiting_chunks[sock] = waiting_chunk + lines[-1]
+                    continue
+                if self._parser.bulk_data:
+                    # a \r\n line end is one terminator, not the start
+                    # of the blob data
+                    reader = BlobReader(
+                        msg, after_cr=raw_chunk[position - 1] == "\r")
+                    if not reader.complete:
+                        with self._data_lock:
+                            if sock in self._waiting_chunks:
+                                self._waiting_blobs[sock] = reader
+                        return raw_chunk[position:]
+                self._dispatch_message(sock, msg)
+
+        if not discarding:
+            if len(waiting_chunk) + len(lines[-1]) > self.MAX_LINE_LENGTH:
+                self._line_too_long(sock, len(waiting_chunk) + len(lines[-1]))
+                del waiting_chunk[:]
+                with self._data_lock:
+                    if sock in self._waiting_chunks:
+                        self._discarding.add(sock)
+            else:
+                waiting_chunk += lines[-1]
+        return ""
+
+    def _line_too_long(self, sock, length):
+        """Report a line from socket sock that is too long to handle."""
+        reason = ("Message line of at least %d bytes is longer than the "
+                  "maximum of %d bytes, discarding it."
+                  % (length, self.MAX_LINE_LENGTH))
+        self._logger.error("BAD COMMAND: %s" % reason)
+        self.tcp_inform(sock, self._log_msg("error", reason, "root"))
+
+    def _dispatch_message(self, sock, msg):
+        """Pass a message received on socket sock to handle_message."""
+        try:
+            client_conn = self._sock_connections[sock]
+        except KeyError:
+            self._logger.warn(
+            'Client disconnected while handling received message: %r'
+            % sock)
+        else:
+            if self._perf_stats is not None:
+                self._perf_stats.received(sock, nmessages=1)
+            # replies and informs produced by the handler go out together
+            with self._batched_sends(sock):
+                self.handle_message(client_conn, msg)
 
     def handle_message(self, client_conn, msg):
         """Handle messages of all types from clients.
@@ -320,7 +549,7 @@ class DeviceServerBase(object):
             The message to process.
         """
         # log messages received so that no one else has to
-        self._logger.debug(str(msg))
+        self._logger.debug(msg)
 
         if msg.mtype == msg.REQUEST:
             self.handle_request(client_conn, msg)
@@ -348,6 +577,8 @@ class DeviceServerBase(object):
         # raise an error as needed.
         if msg.name in self._request_handlers:
             req_conn = ClientRequestConnection(connection, msg)
+            if self._perf_stats is not None:
+                t0 = time.time()
             try:
                 reply = self._request_handlers[msg.name](self, req_conn, msg)
                 assert (reply.mtype == Message.REPLY)
@@ -368,6 +599,8 @@ class DeviceServerBase(object):
                     e_type, e_value, trace, self._tb_limit))
                 self._logger.error("Request %s FAIL: %s" % (msg.name, reason))
                 reply = Message.reply(msg.name, "fail", reason)
+            if self._perf_stats is not None:
+                self._perf_stats.request_handled(msg.name, time.time() - t0)
         else:
             self._logger.error("%s INVALID: Unknown request." % (msg.name,))
             reply = Message.reply(msg.name, "invalid", "Unknown request.")
@@ -433,13 +666,98 @@ class DeviceServerBase(object):
         # TODO: should probably implement this as a queue of sockets and
         #       messages to send and have the queue processed in the main
         #       loop.
-        data = str(msg) + "\n"
-        datalen = len(data)
-        totalsent = 0
+        conn = self._sock_connections.get(sock)
+        if conn is not None and conn.bulk_data:
+            line, blobs = msg.bulk_parts()
+        else:
+            line, blobs = str(msg), []
+        data = line + "\n"
 
         # Log all sent messages here so no one else has to.
         self._logger.debug(data)
+        if self._perf_stats is not None:
+            self._perf_stats.sent(
+                sock, len(data) + sum(len(blob) for blob in blobs))
+
+        batch = getattr(self._send_batches, 'batches', {}).get(sock)
+        if batch is not None:
+            with batch.lock:
+                if not blobs:
+                    batch.parts.append(data)
+                    batch.size += len(data)
+                    if (msg.mtype == Message.REPLY or
+                            batch.size >= self.MAX_SEND_BATCH_SIZE):
+                        self._send_batch(sock, batch)
+                    elif batch.deadline is None:
+                        batch.deadline = (time.time() +
+                                          self.MAX_SEND_BATCH_DELAY)
+                        self._send_batch_flusher.schedule(
+                            batch.deadline, sock, batch)
+                    return
+                # keep the batched messages ahead of this one
+                self._send_batch(sock, batch)
+
+        self._send_data(sock, [data] + blobs)
+
+    @contextmanager
+    def _batched_sends(self, sock):
+        """Coalesce the messages this thread sends to sock into fewer sends.
+
+        Messages sent to sock by the current thread inside the with block
+        are accumulated and sent with a single socket send when a reply is
+        sent or the block exits. Waiting messages are also sent once
+        MAX_SEND_BATCH_SIZE bytes are waiting or the oldest has waited
+        MAX_SEND_BATCH_DELAY seconds, so that the informs of a slow handler
+        are not held back. Nested blocks for the same socket join the outer
+        batch.
+
+        Parameters
+        ----------
+        sock : socket.socket object
+            The socket to batch messages for.
+        """
+        batches = getattr(self._send_batches, 'batches', None)
+        if batches is None:
+            batches = self._send_batches.batches = {}
+        if sock in batches:
+            yield
+            return
+        batch = batches[sock] = _SendBatch()
+        try:
+            yield
+        finally:
+            with batch.lock:
+                self._send_batch(sock, batch)
+            del batches[sock]
+
+    def _flush_late_batch(self, sock, batch, deadline):
+        """Send the messages of batch if they were waiting at deadline."""
+        with batch.lock:
+            if batch.deadline is not None and batch.deadline <= deadline:
+                self._send_batch(sock, batch)
+
+    def _send_batch(self, sock, batch):
+        """Send the messages waiting in batch (its lock must be held)."""
+        if batch.parts:
+            data = "".join(batch.parts)
+            batch.parts = []
+            batch.size = 0
+            batch.deadline = None
+            self._send_data(sock, [data])
+
+    def _send_data(self, sock, parts):
+        """Send serialized message data to a particular client.
+
+        Note that failed sends disconnect the client sock and call
+        on_client_disconnect. They do not raise exceptions.
 
+        Parameters
+        ----------
+        sock : socket.socket object
+            The socket to send the data to.
+        parts : list of str or buffer objects
+            The data to send, in order.
+        """
         # sends are locked per-socket -- i.e. only one send per socket at
         # a time
         lock = self._sock_locks.get(sock)
@@ -458,27 +776,36 @@ class DeviceServerBase(object):
         lock.acquire()
         t0 = time.time()
         try:
-            while totalsent < datalen:
-                if time.time()-t0 > self.send_timeout:
-                    self._logger.error(
-                        'server._send_msg() timing out after %fs, sent %d/%d bytes'
-                        % (self.send_timeout, totalsent, datalen) )
-                    send_failed = True
-                    break
-                try:
-                    sent = sock.send(data[totalsent:])
-                except socket.error, e:
-                    if len(e.args) == 2 and e.args[0] == errno.EAGAIN:
-                        continue
-                    else:
+            # Partial sends are retried from memoryview slices so that the
+            # unsent data is not copied; blobs go out unescaped straight
+            # after the line
+            for data in [memoryview(part) for part in parts]:
+                datalen = len(data)
+                totalsent = 0
+                while totalsent < datalen:
+                    if time.time()-t0 > self.send_timeout:
+                        self._logger.error(
+                            'server._send_msg() timing out after %fs, '
+                            'sent %d/%d bytes'
+                            % (self.send_timeout, totalsent, datalen) )
+                        send_failed = True
+                        break
+                    try:
+                        sent = sock.send(data[totalsent:])
+                    except socket.error, e:
+                        if len(e.args) == 2 and e.args[0] == errno.EAGAIN:
+                            continue
+                        else:
+                            send_failed = True
+                            break
+
+                    if sent == 0:
                         send_failed = True
                         break
 
-                if sent == 0:
-                    send_failed = True
+                    totalsent += sent
+                if send_failed:
                     break
-
-                totalsent += sent
         finally:
             lock.release()
 
@@ -688,6 +1015,12 @@ class DeviceServerBase(object):
         self._running.set()
         while self._running.isSet():
             self._process_deferred_queue()
+            if self._perf_stats is not None:
+                try:
+                    self._perf_stats.update_sensors()
+                except Exception:
+                    # a broken gauge must not stop the server
+                    self._logger.exception("Updating perf stats failed")
             all_socks = self._socks + [self._sock]
             try:
                 readers, _writers, errors = _select(
@@ -899,6 +1232,7 @@ class DeviceServer(DeviceServerBase):
       * watchdog
       * version-list (only standard in KATCP v5 or later)
       * sensor-sampling-clear (non-standard)
+      * sensor-history (non-standard)
 
     .. [#restartf1] Restart relies on .set_restart_queue() being used to
       register a restart queue with the device. When the device needs to be
@@ -923,6 +1257,14 @@ class DeviceServer(DeviceServerBase):
 
     Subclasses must override the .setup_sensors() method. If they
     have no sensors to register, the method should just be a pass.
+
+    The sampling strategies of all clients are run by a sample reactor
+    that is created whenever the server starts. By default this is a
+    :class:`katcp.sampling.SampleReactor` running in its own thread, but
+    any callable returning an object with the same interface may be passed
+    as the `sample_reactor_factory` keyword argument (e.g.
+    :class:`katcp.tx.sampling.TwistedSampleReactor` for servers that run
+    alongside a twisted reactor).
     """
 
     # DeviceServer has a lot of methods because there is a method
@@ -949,6 +1291,8 @@ class DeviceServer(DeviceServerBase):
     # pylint: disable-msg = W0142
 
     def __init__(self, *args, **kwargs):
+        sample_reactor_factory = kwargs.pop('sample_reactor_factory',
+                                            SampleReactor)
         if self.PROTOCOL_INFO.major not in self.SUPPORTED_PROTOCOL_MAJOR_VERSIONS:
             raise ValueError(
         'Device server only supports katcp procotol versions %r, not '
@@ -962,14 +1306,50 @@ class DeviceServer(DeviceServerBase):
         self._restart_queue = None
         self._sensors = {}  # map names to sensor objects
         self._reactor = None  # created in run
+        self._sample_reactor_factory = sample_reactor_factory
+        # (compiled name pattern, size) pairs of sensors to record history of
+        self._history_patterns = []
         # map client sockets to map of sensors -> sampling strategies
         self._strategies = {}
         # strat lock (should be held for updates to _strategies)
         self._strat_lock = threading.Lock()
+        # profiling hooks around the sampling done by this server's
+        # strategies, which are added as they are created
+        self._strategy_profile_hooks = ProfileHooks(None, {
+            "strategy-update": "update",
+            "strategy-inform": "inform",
+        }, pass_target=True)
         self.setup_sensors()
 
     # pylint: enable-msg = W0142
 
+    def add_profile_hook(self, hook):
+        """Call a profiling hook around message handling and sampling.
+
+        The hook is called around this server's handle_request,
+        handle_inform and handle_reply, and around the update() and
+        inform() calls of the sampling strategies set up by its clients.
+        Other servers and clients in the process are not affected.
+
+        Parameters
+        ----------
+        hook : katcp.instrumentation.ProfileHook object
+            The hook to add.
+        """
+        super(DeviceServer, self).add_profile_hook(hook)
+        self._strategy_profile_hooks.add(hook)
+
+    def remove_profile_hook(self, hook):
+        """Remove a profiling hook added by :meth:`add_profile_hook`.
+
+        Parameters
+        ----------
+        hook : katcp.instrumentation.ProfileHook object
+            The hook to remove.
+        """
+        super(DeviceServer, self).remove_profile_hook(hook)
+        self._strategy_profile_hooks.remove(hook)
+
     def on_client_connect(self, client_conn):
         """Inform client of build state and version on connect.
 
@@ -1064,6 +1444,114 @@ class DeviceServer(DeviceServerBase):
             The sensor object to register with the device server.
         """
         self._sensors[sensor.name] = sensor
+        if sensor.history is None:
+            for name_re, size in self._history_patterns:
+                if name_re.search(sensor.name):
+                    sensor.enable_history(size)
+                    break
+
+    def enable_sensor_history(self, pattern, size):
+        """Record the history of sensors whose names match a pattern.
+
+        Applies to sensors already added and to sensors added later. The
+        recorded readings are returned by ?sensor-history.
+
+        Parameters
+        ----------
+        pattern : str
+            Regular expression searched for in the sensor names.
+        size : int
+            The number of readings kept per sensor.
+        """
+        name_re = re.compile(pattern)
+        self._history_patterns.append((name_re, size))
+        for name, sensor in self._sensors.iteritems():
+            if sensor.history is None and name_re.search(name):
+                sensor.enable_history(size)
+
+    def enable_perf_stats(self, update_period=1.0):
+        """Collect performance counters and add the ?perf-stats request.
+
+        Adds perf.* sensors reporting request counts and latencies, message
+        and byte counts, the deferred queue depth, the sample reactor heap
+        size and its lateness. The sensor values are updated at most every
+        update_period seconds. ?perf-stats reports the counters per request
+        name and per connection.
+
+        Parameters
+        ----------
+        update_period : float
+            Minimum time between updates of the sensor values, in seconds.
+
+        Returns
+        -------
+        stats : katcp.instrumentation.ServerStats object
+            The performance counters.
+        """
+        if self._perf_stats is not None:
+            return self._perf_stats
+        stats = ServerStats(update_period)
+        stats.add_gauge("deferred-queue", "Number of deferred actions waiting.",
+                        self._deferred_queue.qsize)
+        stats.add_gauge("reactor-heap",
+                        "Number of scheduled periodic sampling events.",
+                        self._reactor_heap_size)
+        for sensor in stats.sensors():
+            self.add_sensor(sensor)
+        stats.update_sensors(force=True)
+        self._request_handlers = dict(self._request_handlers)
+        self._request_handlers["perf-stats"] = DeviceServer._perf_stats_request
+        self._perf_stats = stats
+        if self._reactor is not None:
+            stats.reactor_lateness.update(self._reactor.lateness)
+            self._reactor.lateness = stats.reactor_lateness
+        return stats
+
+    def _reactor_heap_size(self):
+        """Return the number of events scheduled in the sample reactor."""
+        reactor = self._reactor
+        return reactor is not None and reactor.heap_size() or 0
+
+    def _perf_stats_request(self, req, msg):
+        """Report the performance counters.
+
+        Only available once the server has called enable_perf_stats().
+
+        Informs
+        -------
+        kind : {'request', 'connection', 'gauge', 'reactor'}
+            What the inform reports on. Request informs give the request
+            name, call count and mean, median, 99th percentile and maximum
+            handler latency in seconds. Connection informs give the client
+            address and the messages and bytes received and sent. Gauge
+            informs give a gauge name and its value. Reactor informs give a
+            sampling strategy name, the number of its periodic samples and
+            their mean, median, 99th percentile and maximum lateness in
+            seconds.
+
+        Returns
+        -------
+        success : {'ok'}
+            Whether sending the statistics succeeded.
+        informs : int
+            Number of #perf-stats inform messages sent.
+
+        Examples
+        --------
+        ::
+
+            ?perf-stats
+            #perf-stats request watchdog 3 0.000012 0.000016 0.000016 0.000014
+            #perf-stats connection 127.0.0.1:40302 4 52 9 334
+            #perf-stats gauge deferred-queue 0
+            #perf-stats gauge reactor-heap 1
+            #perf-stats reactor period 20 0.000104 0.000128 0.000256 0.000311
+            !perf-stats ok 5
+        """
+        informs = self._perf_stats.informs()
+        for arguments in informs:
+            req.inform(*arguments)
+        return req.make_reply("ok", str(len(informs)))
 
     def has_sensor(self, sensor_name):
         """Whether a sensor_name is known."""
@@ -1521,6 +2009,66 @@ class DeviceServer(DeviceServerBase):
             req.inform(timestamp, "1", name, status, value)
         return req.make_reply("ok", str(len(sensors)))
 
+    def request_sensor_history(self, req, msg):
+        """Request the recorded readings of a sensor.
+
+        The readings are sent as a sequence of #sensor-history informs, oldest
+        first. History has to be enabled for the sensor, either with
+        Sensor.enable_history() or DeviceServer.enable_sensor_history().
+
+        Parameters
+        ----------
+        name : str
+            Name of the sensor.
+        start : float, optional
+            Only send readings taken at or after this time, in seconds since
+            the Unix epoch (milliseconds for katcp versions <= 4).
+        end : float, optional
+            Only send readings taken at or before this time.
+        max : int, optional
+            Send at most this many readings (the most recent ones).
+
+        Informs
+        -------
+        timestamp : float
+            Timestamp of the reading.
+        count : {1}
+            Number of sensors described in this inform. Will always be one.
+            It exists to keep this inform compatible with #sensor-value.
+        name : str
+            Name of the sensor.
+        status : str
+            Status of the sensor at the time of the reading.
+        value : object
+            Value of the reading.
+
+        Returns
+        -------
+        success : {'ok', 'fail'}
+            Whether sending the readings succeeded.
+        informs : int
+            Number of #sensor-history inform messages sent.
+
+        Examples
+        --------
+        ::
+
+            ?sensor-history cpu.temp 1244631611.0 1244631612.0
+            #sensor-history 1244631611.415231 1 cpu.temp nominal 45.5
+            #sensor-history 1244631611.915231 1 cpu.temp nominal 46.0
+            !sensor-history ok 2
+        """
+        if not msg.arguments:
+            raise FailReply("No sensor name given.")
+        name = msg.arguments[0]
+        if name not in self._sensors:
+            raise FailReply("Unknown sensor name: %s." % name)
+        samples = select_sensor_history(self._sensors[name], msg.arguments[1:],
+                                        self.PROTOCOL_INFO.major)
+        for timestamp, status, value in samples:
+            req.inform(timestamp, "1", name, status, value)
+        return req.make_reply("ok", str(len(samples)))
+
     def request_sensor_sampling(self, req, msg):
         """Configure or query the way a sensor is sampled.
 
@@ -1613,6 +2161,7 @@ class DeviceServer(DeviceServerBase):
                 params = [float(params[0]) * MS_TO_SEC_FAC] + params[1:]
             new_strategy = SampleStrategy.get_strategy(
                 strategy, inform_callback, sensor, *params)
+            self._strategy_profile_hooks.add_target(new_strategy)
 
             with self._strat_lock:
                 old_strategy = self._strategies[client].get(sensor, None)
@@ -1660,6 +2209,30 @@ class DeviceServer(DeviceServerBase):
 
         return ["ok"]
 
+    @request()
+    @return_reply()
+    def request_bulk_data(self, req):
+        """Send blob arguments to this client as raw bulk data.
+
+        Only servers with the bulk-data protocol flag (B) accept this
+        request. Until a client makes it, blob arguments in the messages
+        sent to that client are escaped inline like other arguments.
+
+        Returns
+        -------
+        success : {'ok', 'fail'}
+            Whether bulk data is now sent to this client.
+
+        Examples
+        --------
+        ?bulk-data
+        !bulk-data ok
+        """
+        if not self.PROTOCOL_INFO.bulk_data:
+            raise FailReply("Bulk data is not supported by this server.")
+        req.client_connection.bulk_data = True
+        return ["ok"]
+
 
     def request_watchdog(self, req, msg):
         """Check that the server is still alive.
@@ -1685,7 +2258,9 @@ class DeviceServer(DeviceServerBase):
         """Override DeviceServerBase.run() to ensure that the reactor thread is
            running at the same time.
            """
-        self._reactor = SampleReactor()
+        self._reactor = self._sample_reactor_factory()
+        if self._perf_stats is not None:
+            self._reactor.lateness = self._perf_stats.reactor_lateness
         self._reactor.start()
         try:
             super(DeviceServer, self).run()
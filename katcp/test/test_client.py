@@ -22,7 +22,7 @@ from katcp.testutils import (TestLogHandler, DeviceTestServer, TestUtilMixin,
 log_handler = TestLogHandler()
 logging.getLogger("katcp").addHandler(log_handler)
 
-NO_HELP_MESSAGES = 16         # Number of requests on DeviceTestServer
+NO_HELP_MESSAGES = 18         # Number of requests on DeviceTestServer
 
 def remove_version_connect(msgs):
     """Remove #version-connect messages from a list of messages"""
@@ -10,7 +10,7 @@
 import unittest2 as unittest
 import logging
 import katcp
-from katcp.core import Sensor
+from katcp.core import Sensor, BlobReader, PendingBlob
 from katcp.testutils import TestLogHandler, DeviceTestSensor
 
 log_handler = TestLogHandler()
@@ -154,6 +154,59 @@ class TestMessageParser(unittest.TestCase):
         self.assertEqual(m.arguments, ["a", "b", "c"])
         self.assertEqual(m.mid, "1234")
 
+    def test_bulk_data(self):
+        """Test serializing and parsing messages with bulk-data blobs."""
+        blob = "\x00raw \\b3\n\r" * 3
+        m = katcp.Message.request("put", "a\\b1", bytearray(blob), "", mid=7)
+        self.assertEqual(m.blobs(), [bytearray(blob)])
+        # without the extension blobs are escaped into the line
+        self.assertEqual(self.p.parse(str(m)).arguments,
+                         ["a\\b1", blob, ""])
+        line, blobs = m.bulk_parts()
+        self.assertEqual(line, "?put[7] a\\\\b1 \\b30 \\@")
+        self.assertEqual(blobs, [bytearray(blob)])
+
+        p = katcp.MessageParser(bulk_data=True)
+        m = p.parse(line)
+        self.assertEqual(m.arguments, ["a\\b1", bytearray(), ""])
+        # blob buffers grow as the data arrives
+        self.assertTrue(isinstance(m.arguments[1], PendingBlob))
+        self.assertEqual(m.arguments[1].length, 30)
+        reader = BlobReader(m)
+        self.assertFalse(reader.complete)
+        self.assertEqual(reader.feed(blob[:10]), "")
+        self.assertEqual(reader.feed(blob[10:] + "?next"), "?next")
+        self.assertTrue(reader.complete)
+        self.assertTrue(isinstance(m.arguments[1], memoryview))
+        self.assertEqual(m.arguments[1].tobytes(), blob)
+
+        # two blobs, fed in one go
+        m = p.parse("#data \\b2 \\b3")
+        reader = BlobReader(m)
+        self.assertEqual(reader.feed("abcde\n"), "\n")
+        self.assertEqual([x.tobytes() for x in m.arguments], ["ab", "cde"])
+
+        # a newline completing a \r\n line end is not blob data
+        m = p.parse("#data \\b2")
+        reader = BlobReader(m, after_cr=True)
+        self.assertEqual(reader.feed("\n"), "")
+        self.assertEqual(reader.feed("\nx"), "")
+        self.assertEqual(m.arguments[0].tobytes(), "\nx")
+
+        # empty blobs stay blobs
+        m = katcp.Message.request("put", bytearray())
+        self.assertEqual(m.blobs(), [bytearray()])
+        self.assertEqual(m.bulk_parts(), ("?put \\b0", [bytearray()]))
+
+        # an oversized blob is a syntax error
+        self.assertRaises(katcp.KatcpSyntaxError, p.parse,
+                          "?put \\b%d" % (p.MAX_BLOB_SIZE + 1))
+        # and so are too many blobs in one message
+        self.assertRaises(katcp.KatcpSyntaxError, p.parse,
+                          "?put" + " \\b%d" % p.MAX_BLOB_SIZE * 2)
+        # references are only recognised with the extension enabled
+        self.assertRaises(katcp.KatcpSyntaxError, self.p.parse, "?put \\b3")
+
 
 class TestProtocolFlags(unittest.TestCase):
     def test_parse_version(self):
@@ -365,3 +418,116 @@ class TestSensor(unittest.TestCase):
         self.assertEqual(len(Sensor.STATUSES), len(valid_statuses))
         self.assertEqual(len(Sensor.STATUS_NAMES), len(valid_statuses))
 
+
+    def test_lazy_attributes(self):
+        """Test that descriptions and formatted params are built on demand."""
+        s = Sensor.float("a.float", unit="V", params=[-1.5, 1.5])
+        self.assertFalse(hasattr(s, "__dict__"))
+        self.assertEqual(s._formatted_params, None)
+        self.assertEqual(s.formatted_params, ["-1.5", "1.5"])
+        self.assertEqual(s.description, "Float sensor 'a.float' in unit V")
+        s.description = "A float."
+        self.assertEqual(s.description, "A float.")
+        s.params = [0.0, 2.0]
+        self.assertEqual(s.formatted_params, ["0", "2"])
+
+    def test_history(self):
+        """Test recording sensor readings in a history buffer."""
+        s = Sensor.integer("an.int", "An integer.", "count", [-4, 3])
+        self.assertEqual(s.history, None)
+        s.enable_history(3)
+        for i in range(5):
+            s.set(1000.0 + i, Sensor.NOMINAL, i - 2)
+
+        self.assertEqual(len(s.history), 3)
+        self.assertEqual(s.history.samples(), [
+            (1002.0, Sensor.NOMINAL, 0),
+            (1003.0, Sensor.NOMINAL, 1),
+            (1004.0, Sensor.NOMINAL, 2)])
+        self.assertEqual(s.history.samples(start=1003.0), [
+            (1003.0, Sensor.NOMINAL, 1),
+            (1004.0, Sensor.NOMINAL, 2)])
+        self.assertEqual(s.history.samples(end=1002.5), [
+            (1002.0, Sensor.NOMINAL, 0)])
+        self.assertEqual(s.history.samples(max_samples=1), [
+            (1004.0, Sensor.NOMINAL, 2)])
+        self.assertEqual(s.history.samples(start=2000.0), [])
+
+        s.disable_history()
+        self.assertEqual(s.history, None)
+        self.assertRaises(ValueError, s.enable_history, 0)
+
+
+class TestSensorBank(unittest.TestCase):
+
+    def setUp(self):
+        self.bank = katcp.SensorBank(Sensor.FLOAT, "V", [0.0, 5.0])
+        for i in range(4):
+            self.bank.add("psu%d.voltage" % i)
+
+    def test_lazy_views(self):
+        """Test that views are only created when sensors are indexed."""
+        for i in range(4, 1000):
+            self.bank.add("psu%d.voltage" % i)
+        self.assertEqual(self.bank._views, {})
+        s = self.bank["psu7.voltage"]
+        self.assertEqual(self.bank._views.keys(), [7])
+        observer = object()
+        self.assertFalse(isinstance(s._observers, set))
+        s.detach(observer)
+        s.attach(observer)
+        self.assertEqual(s._observers, set([observer]))
+        self.assertFalse(s._observers is self.bank["psu8.voltage"]._observers)
+
+    def test_views(self):
+        """Test that banked sensors behave like ordinary sensors."""
+        s = self.bank["psu1.voltage"]
+        self.assertTrue(s is self.bank["psu1.voltage"])
+        self.assertEqual(s.stype, "float")
+        self.assertEqual(s.units, "V")
+        self.assertEqual(s.formatted_params, ["0", "5"])
+        self.assertEqual(s.description,
+                         "Float sensor 'psu1.voltage' in unit V")
+        self.assertEqual(s.read()[1:], (Sensor.UNKNOWN, 0.0))
+
+        s.set_value(3.5, timestamp=12345.0)
+        self.assertEqual(s.read(), (12345.0, Sensor.NOMINAL, 3.5))
+        s.set_formatted('12346.1', 'warn', '4.5')
+        self.assertEqual(s.read_formatted(),
+                         ('12346.100000', 'warn', '4.5'))
+        self.assertEqual(self.bank["psu2.voltage"].value(), 0.0)
+        self.assertEqual([sensor.name for sensor in self.bank],
+                         self.bank.names())
+
+        self.assertRaises(ValueError, self.bank.add, "psu1.voltage")
+        self.assertRaises(ValueError, katcp.SensorBank, Sensor.STRING)
+        self.assertEqual(self.bank.add("psu9", "PSU 9", 4.0), 4)
+        self.assertEqual(self.bank["psu9"].read()[1:], (Sensor.UNKNOWN, 4.0))
+        self.assertEqual(self.bank["psu9"].description, "PSU 9")
+
+    def test_set_values(self):
+        """Test updating a run of sensors in one call."""
+        updates = []
+
+        class Observer(object):
+            def update(self, sensor):
+                updates.append((sensor.name, sensor.value()))
+
+        observer = Observer()
+        self.bank["psu0.voltage"].attach(observer)
+        self.bank["psu2.voltage"].attach(observer)
+        self.bank["psu3.voltage"].enable_history(5)
+
+        self.bank.set_values([1.0, 2.0, 3.0], timestamp=1000.0, start=1)
+        self.assertEqual(list(self.bank.values()), [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(self.bank["psu2.voltage"].read(),
+                         (1000.0, Sensor.NOMINAL, 2.0))
+        self.assertEqual(updates, [("psu2.voltage", 2.0)])
+        self.assertEqual(self.bank["psu3.voltage"].history.samples(),
+                         [(1000.0, Sensor.NOMINAL, 3.0)])
+
+        self.bank["psu2.voltage"].detach(observer)
+        self.bank.set_values([4.0, 4.0, 4.0, 4.0])
+        self.assertEqual(updates, [("psu2.voltage", 2.0),
+                                   ("psu0.voltage", 4.0)])
+        self.assertRaises(IndexError, self.bank.set_values, [1.0], start=4)
@@ -0,0 +1,205 @@
+# test_instrumentation.py
+# -*- coding: utf8 -*-
+# vim:fileencoding=utf8 ai ts=4 sts=4 et sw=4
+# Copyright 2009 SKA South Africa (http://ska.ac.za/)
+# BSD license - see COPYING for details
+
+"""Tests for the instrumentation module.
+   """
+
+import threading
+import unittest2 as unittest
+import mock
+
+from katcp.instrumentation import (LatencyHistogram, ServerStats,
+                                   ProfileHook, ProfileHooks)
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_add(self):
+        h = LatencyHistogram()
+        self.assertEqual((h.count, h.mean(), h.percentile(0.99)), (0, 0.0, 0.0))
+        for duration in [-1.0, 1e-6, 3e-6, 3e-6, 0.5]:
+            h.add(duration)
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.max, 0.5)
+        self.assertAlmostEqual(h.mean(), (7e-6 + 0.5) / 5)
+        self.assertEqual(sum(h.counts), 5)
+        self.assertEqual(h.counts[:3], [2, 0, 2])
+        self.assertEqual(h.percentile(0.5), 4e-6)
+        self.assertEqual(h.percentile(1.0), 0.5)
+        h.add(1000.0)
+        self.assertEqual(h.counts[-1], 1)
+        self.assertEqual(h.percentile(1.0), 1000.0)
+
+    def test_merged(self):
+        h1, h2 = LatencyHistogram(), LatencyHistogram()
+        h1.add(1e-6)
+        h2.add(3e-6)
+        h2.add(2.0)
+        h = LatencyHistogram.merged([h1, h2])
+        self.assertEqual((h.count, h.max), (3, 2.0))
+        self.assertAlmostEqual(h.total, 2.000004)
+        self.assertEqual(h.counts, [a + b for a, b in zip(h1.counts, h2.counts)])
+        self.assertEqual(LatencyHistogram.merged([]).count, 0)
+
+
+class TestServerStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = ServerStats(update_period=10.0)
+
+    def test_counters(self):
+        stats = self.stats
+        sock1, sock2 = mock.Mock(), mock.Mock()
+        sock1.getpeername.return_value = ('127.0.0.1', 1234)
+        stats.request_handled('watchdog', 0.001)
+        stats.request_handled('watchdog', 0.003)
+        stats.received(sock1, 10)
+        stats.received(sock1, nmessages=2)
+        stats.sent(sock1, 20)
+        stats.add_gauge('queue', 'A queue.', lambda: 7)
+        self.assertEqual(stats.informs(), [
+            ('request', 'watchdog', 2, '0.002000', '0.001024', '0.003000',
+             '0.003000'),
+            ('connection', '127.0.0.1:1234', 2, 10, 1, 20),
+            ('gauge', 'queue', 7)])
+
+        stats.sent(sock2, 5)
+        stats.remove_connection(sock1)
+        totals = stats.totals()
+        self.assertEqual((totals.messages_in, totals.bytes_in,
+                          totals.messages_out, totals.bytes_out),
+                         (2, 10, 2, 25))
+
+    def test_update_sensors(self):
+        stats = self.stats
+        sensors = dict((s.name, s) for s in stats.sensors())
+        stats.request_handled('help', 0.5)
+        stats.update_sensors()
+        self.assertEqual(sensors['perf.requests'].value(), 1)
+        self.assertEqual(sensors['perf.request-latency'].value(), 0.5)
+        # Updates are rate limited unless forced
+        stats.request_handled('help', 0.5)
+        stats.update_sensors()
+        self.assertEqual(sensors['perf.requests'].value(), 1)
+        stats.update_sensors(force=True)
+        self.assertEqual(sensors['perf.requests'].value(), 2)
+
+        period = stats.reactor_lateness['period'] = LatencyHistogram()
+        event_rate = stats.reactor_lateness['event-rate'] = LatencyHistogram()
+        period.add(0.001)
+        event_rate.add(0.003)
+        stats.update_sensors(force=True)
+        self.assertEqual(sensors['perf.reactor-lateness'].value(), 0.002)
+        self.assertEqual(sensors['perf.reactor-lateness-p99'].value(), 0.003)
+        self.assertEqual(stats.informs()[-2:], [
+            ('reactor', 'event-rate', 1, '0.003000', '0.003000', '0.003000',
+             '0.003000'),
+            ('reactor', 'period', 1, '0.001000', '0.001000', '0.001000',
+             '0.001000')])
+
+
+class RecordingHook(ProfileHook):
+    def __init__(self):
+        self.calls = []
+
+    def before(self, event, args):
+        self.calls.append(('before', event, args))
+
+    def after(self, event, args, start, end):
+        assert start <= end
+        self.calls.append(('after', event, args))
+
+
+class TestProfileHooks(unittest.TestCase):
+
+    class Target(object):
+        def handle(self, x):
+            if x is None:
+                raise ValueError(x)
+            return x + 1
+
+    def test_object_hooks(self):
+        target = self.Target()
+        hooks = ProfileHooks(target, {'handling': 'handle'})
+        hook1, hook2 = RecordingHook(), RecordingHook()
+        hooks.add(hook1)
+        hooks.add(hook2)
+        hooks.add(hook2)
+        self.assertEqual(target.handle(1), 2)
+        self.assertEqual(hook1.calls, [('before', 'handling', (1,)),
+                                       ('after', 'handling', (1,))])
+        self.assertEqual(hook2.calls, hook1.calls)
+        # hooks are called even if the method raises
+        self.assertRaises(ValueError, target.handle, None)
+        self.assertEqual(hook1.calls[-1], ('after', 'handling', (None,)))
+
+        hooks.remove(hook1)
+        hooks.remove(hook2)
+        self.assertIn('handle', vars(target))
+        hooks.remove(hook2)
+        # without hooks the class method is used directly
+        self.assertNotIn('handle', vars(target))
+        self.assertEqual(len(hook2.calls), 4)
+
+    def test_class_hooks(self):
+        original = vars(self.Target)['handle']
+        hooks = ProfileHooks(self.Target, {'handling': 'handle'})
+        hook = RecordingHook()
+        hooks.add(hook)
+        target = self.Target()
+        self.assertEqual(target.handle(2), 3)
+        self.assertEqual(hook.calls, [('before', 'handling', (target, 2)),
+                                      ('after', 'handling', (target, 2))])
+        hooks.remove(hook)
+        self.assertIs(vars(self.Target)['handle'], original)
+
+    def test_targets(self):
+        class SubTarget(self.Target):
+            def handle(self, x):
+                return x + 2
+        target, sub_target = self.Target(), SubTarget()
+        hooks = ProfileHooks(None, {'handling': 'handle'}, pass_target=True)
+        hooks.add_target(target)
+        hook = RecordingHook()
+        hooks.add(hook)
+        hooks.add_target(sub_target)
+        self.assertEqual(target.handle(1), 2)
+        self.assertEqual(sub_target.handle(1), 3)
+        # other instances are not profiled
+        self.assertEqual(self.Target().handle(1), 2)
+        self.assertEqual(hook.calls, [
+            ('before', 'handling', (target, 1)),
+            ('after', 'handling', (target, 1)),
+            ('before', 'handling', (sub_target, 1)),
+            ('after', 'handling', (sub_target, 1))])
+        hooks.remove_target(sub_target)
+        self.assertNotIn('handle', vars(sub_target))
+        hooks.remove(hook)
+        self.assertNotIn('handle', vars(target))
+
+    def test_concurrent_add_remove(self):
+        original = vars(self.Target)['handle']
+        hooks = ProfileHooks(self.Target, {'handling': 'handle'})
+        target = self.Target()
+        errors = []
+
+        def churn(hook):
+            try:
+                for i in range(500):
+                    hooks.add(hook)
+                    target.handle(i)
+                    hooks.remove(hook)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=churn, args=(ProfileHook(),))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIs(vars(self.Target)['handle'], original)
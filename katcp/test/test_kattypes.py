@@ -9,11 +9,13 @@
 
 import unittest2 as unittest
 import mock
+from array import array
 from katcp import Message, FailReply, AsyncReply
 from katcp.kattypes import request, inform, return_reply, send_reply,  \
                            Bool, Discrete, Float, Int, Lru, Timestamp, \
                            Str, Struct, Regex, DiscreteMulti, TimestampOrNow, \
-                           StrictTimestamp, Address
+                           StrictTimestamp, Address, compile_unpacker, \
+                           pack_types
 
 MS_TO_SEC_FAC = 1/1000.
 SEC_TO_MS_FAC = 1000
@@ -37,6 +39,42 @@ class TestType(unittest.TestCase):
             else:
                 self.assertEquals(t.unpack(value), result)
 
+    def test_pack_many(self):
+        for t, value, result in self._pack:
+            if type(result) is type and issubclass(result, Exception):
+                self.assertRaises(result, t.pack_many, [value])
+            else:
+                self.assertEquals(t.pack_many([value]), [result])
+        valid = [(value, result) for t, value, result in self._pack
+                 if not (type(result) is type and issubclass(result, Exception))
+                 and t is self._pack[0][0]]
+        if valid:
+            values, results = zip(*valid)
+            self.assertEquals(self._pack[0][0].pack_many(values), list(results))
+
+    def test_unpack_many(self):
+        for t, value, result in self._unpack:
+            if type(result) is type and issubclass(result, Exception):
+                self.assertRaises(result, t.unpack_many, [value])
+            else:
+                self.assertEquals(t.unpack_many([value]), [result])
+
+    def test_packer(self):
+        for t, value, result in self._pack:
+            pack = t.packer()
+            if type(result) is type and issubclass(result, Exception):
+                self.assertRaises(result, pack, value)
+            else:
+                self.assertEquals(pack(value), result)
+
+    def test_unpacker(self):
+        for t, value, result in self._unpack:
+            unpack = t.unpacker()
+            if type(result) is type and issubclass(result, Exception):
+                self.assertRaises(result, unpack, value)
+            else:
+                self.assertEquals(unpack(value), result)
+
 
 class TestInt(TestType):
 
@@ -76,6 +114,81 @@ class TestInt(TestType):
         ]
 
 
+class EvenInt(Int):
+    def check(self, value, major):
+        super(EvenInt, self).check(value, major)
+        if value % 2:
+            raise ValueError("Integer %d is odd." % value)
+
+
+class TestIntSubclass(TestType):
+
+    def setUp(self):
+        even = EvenInt(max=10)
+        self._pack = [
+            (even, 4, "4"),
+            (even, 5, ValueError),
+            (even, 12, ValueError),
+        ]
+        self._unpack = [
+            (even, "4", 4),
+            (even, "5", ValueError),
+            (even, "12", ValueError),
+        ]
+
+
+class TestManyValues(unittest.TestCase):
+
+    def test_arrays(self):
+        floats = Float(min=0.0, max=10.0)
+        values = floats.unpack_many(["1.5", "2", "9.75"], typecode='d')
+        self.assertEqual(values, array('d', [1.5, 2.0, 9.75]))
+        self.assertEqual(floats.pack_many(values), ["1.5", "2", "9.75"])
+        self.assertEqual(Int().pack_many(array('l', [1, -2])), ["1", "-2"])
+        self.assertEqual(Bool().unpack_many(["1", "0"], typecode='B'),
+                         array('B', [1, 0]))
+
+    def test_errors(self):
+        floats = Float(min=0.0, max=10.0)
+        self.assertRaises(ValueError, floats.unpack_many, ["1", "11"])
+        self.assertRaises(ValueError, floats.unpack_many, ["1", "x"])
+        self.assertRaises(ValueError, floats.pack_many, [1.0, -1.0])
+        self.assertEqual(floats.pack_many([1.0, -1.0], nocheck=True),
+                         ["1", "-1"])
+        self.assertRaises(ValueError, Bool().unpack_many, ["1", "2"])
+
+    def test_timestamps(self):
+        timestamps = Timestamp()
+        self.assertEqual(timestamps.pack_many([1.5, 2]),
+                         ["1.500000", "2.000000"])
+        self.assertEqual(timestamps.pack_many([1.5, 2], major=4),
+                         ["1500", "2000"])
+        self.assertEqual(timestamps.unpack_many(["1500", "2000"], major=4),
+                         [1.5, 2.0])
+
+    def test_multiple_tail(self):
+        unpack = compile_unpacker((Int(), Float(max=5.0, multiple=True)),
+                                  ["count", "values"], 5)
+        self.assertEqual(unpack(["3", "1", "2.5", "4"]), [3, 1.0, 2.5, 4.0])
+        with self.assertRaises(FailReply) as ex:
+            unpack(["3", "1", "2.5", "6", "4"])
+        self.assertEqual(
+            ex.exception.message,
+            "Error in parameter 4 (values): Float 6 is higher than maximum 5.")
+        self.assertEqual(pack_types((Int(), Int(multiple=True)),
+                                    [1, 2, 3], 5), ["1", "2", "3"])
+
+    def test_nan_range_check(self):
+        floats = Float(max=10.0, multiple=True)
+        nan = float('nan')
+        self.assertRaises(ValueError, floats.unpack_many, ["nan", "11"])
+        self.assertRaises(ValueError, floats.pack_many, [nan, 11.0])
+        unpack = compile_unpacker((floats,), ["values"], 5)
+        self.assertRaises(FailReply, unpack, ["1", "nan", "11"])
+        self.assertRaises(ValueError, pack_types, (floats,),
+                          [1.0, nan, 11.0], 5)
+
+
 class TestFloat(TestType):
 
     def setUp(self):
@@ -433,6 +433,26 @@ class TestReactorIntegration(unittest.TestCase):
         self.assertEqual(call_times,
                          [self.start_time + i*period
                           for i in range(no_periods + 1)])
+        # The samples fired on time
+        lateness = self.reactor.lateness['period']
+        self.assertEqual((lateness.count, lateness.max), (no_periods, 0.0))
+
+    def test_lateness_warning(self):
+        """Test that late periodic samples log rate-limited warnings."""
+        self.reactor._logger = logger = mock.Mock()
+        strat = sampling.SamplePeriod(self.inform, self.sensor, 10.)
+        for lateness in [1., 6., 7.]:
+            self.reactor._record_lateness(strat, lateness, 10.)
+        self.assertEqual(logger.warn.call_count, 1)
+        self.assertIn("1 periodic sample(s) fired late, most recently period "
+                      "sampling of 'an.int' 6.000000s late",
+                      logger.warn.call_args[0][0])
+        # After the warning interval the suppressed late samples are counted
+        self.time.return_value += self.reactor.late_warning_interval
+        self.reactor._record_lateness(strat, 8., 10.)
+        self.assertEqual(logger.warn.call_count, 2)
+        self.assertIn("2 periodic sample(s)", logger.warn.call_args[0][0])
+        self.assertEqual(self.reactor.lateness['period'].count, 4)
 
 
     def test_event_rate(self):
@@ -560,3 +580,156 @@ class TestReactorIntegration(unittest.TestCase):
         self.reactor.remove_strategy(differential_rate_strat)
 
 
+class TestDifferentialGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.bank = katcp.SensorBank(Sensor.FLOAT)
+        for i in range(4):
+            self.bank.add("an.float%d" % i, default=0.0)
+        self.bank.set_values([0.0] * 4, timestamp=1000.0)
+        self.calls = []
+
+        def inform(sensor_name, timestamp, status, value):
+            self.calls.append((sensor_name, value))
+
+        self.inform = inform
+
+    def test_differential(self):
+        """Test grouped evaluation of differential strategies."""
+        strategies = [sampling.SampleDifferential(self.inform, sensor, 0.5)
+                      for sensor in self.bank]
+        for strategy in strategies:
+            strategy.attach()
+        group = strategies[0]._group
+        self.assertEqual(len(group), 4)
+        self.assertEqual(self.bank.observers(), [group])
+        self.assertEqual(self.bank["an.float0"]._observers, set())
+        self.assertEqual(len(self.calls), 4)
+        del self.calls[:]
+
+        self.bank.set_values([0.1, 1.0, 0.3, -0.7])
+        self.assertEqual(self.calls, [("an.float1", "1"),
+                                      ("an.float3", "-0.7")])
+        del self.calls[:]
+        # changes are measured from the last reported value
+        self.bank.set_values([0.6, 1.2, 0.3, -0.7])
+        self.assertEqual(self.calls, [("an.float0", "0.6")])
+        del self.calls[:]
+        # status changes always report
+        self.bank.set_values([0.6], status=Sensor.WARN, start=2)
+        self.assertEqual(self.calls, [("an.float2", "0.6")])
+        del self.calls[:]
+        # single sensor updates go to the strategies of that sensor
+        self.bank["an.float1"].set_value(3.0)
+        self.assertEqual(self.calls, [("an.float1", "3")])
+        del self.calls[:]
+
+        strategies[1].detach()
+        self.assertEqual(len(group), 3)
+        self.bank.set_values([5.0, 5.0, 5.0, 5.0])
+        self.assertEqual(sorted(self.calls), [
+            ("an.float0", "5"), ("an.float2", "5"), ("an.float3", "5")])
+        for strategy in strategies[0:1] + strategies[2:]:
+            strategy.detach()
+        self.assertEqual(self.bank.observers(), [])
+
+    def test_partial_update(self):
+        """Test that only the strategies on updated slots are evaluated."""
+        for i in range(4, 100):
+            self.bank.add("an.float%d" % i, default=0.0)
+        strategies = [sampling.SampleDifferential(self.inform,
+                                                  self.bank[name], 0.5)
+                      for name in ["an.float90", "an.float1", "an.float50",
+                                   "an.float1"]]
+        for strategy in strategies:
+            strategy.attach()
+        del self.calls[:]
+        self.bank.set_values([1.0] * 99, start=1)
+        self.assertEqual(self.calls, [("an.float1", "1"), ("an.float1", "1"),
+                                      ("an.float50", "1"),
+                                      ("an.float90", "1")])
+        del self.calls[:]
+        self.bank.set_values([2.0] * 40, start=20)
+        self.assertEqual(self.calls, [("an.float50", "2")])
+        del self.calls[:]
+        self.bank.set_values([3.0] * 10, start=60)
+        self.assertEqual(self.calls, [])
+        strategies[2].detach()
+        self.bank.set_values([4.0] * 100)
+        self.assertEqual(self.calls, [("an.float1", "4"), ("an.float1", "4"),
+                                      ("an.float90", "4")])
+        for strategy in strategies[:2] + strategies[3:]:
+            strategy.detach()
+
+    def test_concurrent_changes(self):
+        """Test removing strategies while another thread updates the bank."""
+        keep = sampling.SampleDifferential(self.inform, self.bank["an.float0"],
+                                           0.5)
+        keep.attach()
+        errors = []
+
+        def churn():
+            try:
+                for i in range(300):
+                    strategies = [sampling.SampleDifferential(
+                        lambda *args: None, sensor, 0.5)
+                        for sensor in self.bank]
+                    for strategy in strategies:
+                        strategy.attach()
+                    for strategy in strategies:
+                        strategy.detach()
+            except Exception, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=churn)
+        thread.start()
+        value = 0.0
+        while thread.is_alive():
+            value += 1.0
+            self.bank.set_values([value] * 4)
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(keep._group), 1)
+        keep.detach()
+        self.assertEqual(self.bank.observers(), [])
+
+    def test_differential_rate(self):
+        """Test grouped evaluation of differential-rate strategies."""
+        patcher = mock.patch('katcp.sampling.time')
+        mtime = patcher.start()
+        self.addCleanup(patcher.stop)
+        mtime.time.return_value = 0
+        strategies = [sampling.SampleDifferentialRate(
+                          self.inform, sensor, 0.5, 10, 20)
+                      for sensor in self.bank]
+        new_period = mock.Mock()
+        for strategy in strategies:
+            strategy.set_new_period_callback(new_period)
+            strategy.attach()
+        del self.calls[:]
+
+        # changed, but too soon
+        self.bank.set_values([1.0, 0.0, 0.0, 0.0])
+        self.assertEqual(self.calls, [])
+        new_period.assert_called_once_with(strategies[0], 10)
+
+        mtime.time.return_value = 12
+        self.bank.set_values([1.0, 2.0, 0.2, 0.0])
+        self.assertEqual(self.calls, [("an.float0", "1"), ("an.float1", "2")])
+        del self.calls[:]
+
+        # past the longest period since the last report, updates report
+        # even if the value did not change enough
+        mtime.time.return_value = 25
+        self.bank.set_values([1.0, 2.0, 0.0, 0.0])
+        self.assertEqual(self.calls, [("an.float2", "0"), ("an.float3", "0")])
+
+
+class TestDifferentialGroupWithoutNumpy(TestDifferentialGroup):
+    """Run the group tests with the pure Python evaluation."""
+
+    def setUp(self):
+        super(TestDifferentialGroupWithoutNumpy, self).setUp()
+        patcher = mock.patch('katcp.sampling.numpy', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
@@ -86,6 +86,41 @@ class TestGenericSensorTree(BaseTreeTest):
                          set([self.sensor1, self.sensor3]))
 
 
+    def test_cycles(self):
+        self.tree.add_links(self.sensor1, [self.sensor2])
+        self.tree.add_links(self.sensor2, [self.sensor3])
+        self.assertRaises(ValueError, self.tree.add_links,
+                          self.sensor3, [self.sensor1])
+        self.assertRaises(ValueError, self.tree.add_links,
+                          self.sensor2, [self.sensor2])
+        self.assertEqual(self.tree.parents(self.sensor1), set())
+        self.assertEqual(self.tree.children(self.sensor3), set())
+
+    def test_batch(self):
+        leaves = [katcp.Sensor(int, "leaf%d" % i, "Leaf", "", [0, 100])
+                  for i in range(4)]
+        self.tree.add_links(self.sensor2, leaves[:2])
+        self.tree.add_links(self.sensor3, leaves[2:])
+        self.tree.add_links(self.sensor1, [self.sensor2, self.sensor3])
+        # sensor1 also depends on a leaf directly
+        self.tree.add_links(self.sensor1, leaves[:1])
+        del self.calls[:]
+
+        with self.tree.batch():
+            for leaf in leaves:
+                leaf.set_value(1)
+            self.assertEqual(self.calls, [])
+        parents = [parent for parent, _updates in self.calls]
+        self.assertEqual(sorted(parents[:2]), sorted([self.sensor2,
+                                                      self.sensor3]))
+        self.assertEqual(parents[2:], [self.sensor1])
+        updates = dict(self.calls)
+        self.assertEqual(set(updates[self.sensor2]), set(leaves[:2]))
+        self.assertEqual(set(updates[self.sensor1]),
+                         set([self.sensor2, self.sensor3, leaves[0]]))
+        self.assertRaises(RuntimeError, self.tree.end_batch)
+
+
 class TestBooleanSensorTree(BaseTreeTest):
 
     def test_basic(self):
@@ -243,3 +278,27 @@ class TestAggregateSensorTree(BaseTreeTest):
 
         tree.register_sensor(s1)
         self.assertSensorValues(sensors, (3, 3, 1, 2))
+
+    def test_batch(self):
+        tree = katcp.AggregateSensorTree()
+        s0, s1, s2, s3, s4 = sensors = self.make_sensors(
+            5, katcp.Sensor.INTEGER, params=[-100, 100])
+        calls = []
+
+        def counting_rule(parent, children):
+            calls.append(parent)
+            self._add_rule(parent, children)
+
+        tree.add(s0, counting_rule, (s1, s2))
+        tree.add(s1, counting_rule, (s3, s4))
+        tree.add(s2, counting_rule, (s3, s4))
+        self.assertRaises(ValueError, tree.add, s3, counting_rule, (s0,))
+        self.assertRaises(KeyError, tree.fetch, s3)
+        del calls[:]
+
+        with tree.batch():
+            s3.set_value(1)
+            s4.set_value(2)
+        self.assertSensorValues(sensors, (6, 3, 3, 1, 2))
+        self.assertEqual(sorted(calls[:2]), sorted([s1, s2]))
+        self.assertEqual(calls[2:], [s0])
@@ -24,11 +24,12 @@ from katcp.testutils import (
     TestLogHandler, BlockingTestClient, DeviceTestServer, TestUtilMixin,
     start_thread_with_cleanup, WaitingMock, ClientConnectionTest, mock_req)
 from katcp.core import FailReply
+from katcp.instrumentation import ProfileHook
 
 log_handler = TestLogHandler()
 logging.getLogger("katcp").addHandler(log_handler)
 
-NO_HELP_MESSAGES = 16       # Number of requests on DeviceTestServer
+NO_HELP_MESSAGES = 18       # Number of requests on DeviceTestServer
 
 class test_ClientConnectionTCP(unittest.TestCase):
     def test_init(self):
@@ -240,11 +241,231 @@ class test_DeviceServer(unittest.TestCase, TestUtilMixin):
             '!sensor-sampling-clear ok'])
         self.server.clear_strategies.assert_called_once_with(client_connection)
 
+    def test_request_sensor_history(self):
+        self.server.add_sensor(katcp.Sensor.integer('an.int', 'An int', '', [0, 10]))
+        self.server.enable_sensor_history(r'^an\.', 10)
+        sensor = self.server.get_sensor('an.int')
+        for i in range(3):
+            sensor.set(1000.0 + i, katcp.Sensor.NOMINAL, i)
+        # Sensors added after enabling the history also record readings
+        self.server.add_sensor(katcp.Sensor.boolean('an.bool', 'A bool'))
+        self.assertNotEqual(self.server.get_sensor('an.bool').history, None)
+
+        client_connection = ClientConnectionTest()
+        self.server.handle_message(client_connection, katcp.Message.request(
+            'sensor-history', 'an.int', '1001', '', '1'))
+        self.server.handle_message(client_connection, katcp.Message.request(
+            'sensor-history', 'an.int', '1000.5'))
+        self.server.handle_message(client_connection, katcp.Message.request(
+            'sensor-history', 'an.unknown'))
+        self._assert_msgs_equal(client_connection.messages, [
+            '#sensor-history 1002.000000 1 an.int nominal 2',
+            '!sensor-history ok 1',
+            '#sensor-history 1001.000000 1 an.int nominal 1',
+            '#sensor-history 1002.000000 1 an.int nominal 2',
+            '!sensor-history ok 2',
+            '!sensor-history fail Unknown\\_sensor\\_name:\\_an.unknown.'])
+
+    def test_partial_sends(self):
+        sent = []
+        def send(data):
+            # Partial sends must be retried without copying the rest
+            self.assertIsInstance(data, memoryview)
+            sent.append(data[:7].tobytes())
+            return len(sent[-1])
+        sock = mock.Mock()
+        sock.send.side_effect = send
+        self.server._add_socket(sock)
+        msg = katcp.Message.inform('sensor-list', 'x' * 20, 'a description')
+        self.server._send_message(sock, msg)
+        self.assertEqual(''.join(sent), str(msg) + '\n')
+        self.assertEqual(len(sent), 7)
+
+    def test_batched_sends(self):
+        sock = mock.Mock()
+        sock.send.side_effect = len
+        self.server._add_socket(sock)
+        # a slow test machine must not trigger the late batch flusher
+        self.server.MAX_SEND_BATCH_DELAY = 60.0
+        # The informs and reply of a request go out in one send
+        self.server._dispatch_message(sock, katcp.Message.request('help'))
+        self.assertEqual(sock.send.call_count, 1)
+        (data,), _ = sock.send.call_args
+        lines = data.tobytes().splitlines()
+        self.assertEqual(len(lines), NO_HELP_MESSAGES + 1)
+        self.assertEqual(lines[-1], '!help ok %d' % NO_HELP_MESSAGES)
+        # Messages sent outside a handler are not delayed
+        self.server._send_message(sock, katcp.Message.inform('foo'))
+        self.assertEqual(sock.send.call_count, 2)
+        # Large batches are flushed as they grow
+        sock.send.reset_mock()
+        self.server.MAX_SEND_BATCH_SIZE = 200
+        self.server._dispatch_message(sock, katcp.Message.request('help'))
+        self.assertGreater(sock.send.call_count, 1)
+        data = ''.join(args[0].tobytes() for args, _ in
+                       sock.send.call_args_list)
+        self.assertEqual(data.splitlines(), lines)
+
+    def test_batched_sends_slow_handler(self):
+        sent = []
+        inform_sent = threading.Event()
+        def send(data):
+            sent.append(data.tobytes())
+            if '#slow started' in sent[-1]:
+                inform_sent.set()
+            return len(data)
+
+        class SlowServer(DeviceTestServer):
+            def request_slow(self, req, msg):
+                """A request that informs before a slow step."""
+                req.inform("started")
+                inform_sent.wait(1)
+                return req.make_reply("ok", str(inform_sent.isSet()))
+
+        server = SlowServer('', 0)
+        server.MAX_SEND_BATCH_DELAY = 0.01
+        sock = mock.Mock()
+        sock.send.side_effect = send
+        server._add_socket(sock)
+        server._dispatch_message(sock, katcp.Message.request('slow'))
+        # The inform reached the socket while the handler was still waiting
+        self.assertEqual(sent, ['#slow started\n', '!slow ok True\n'])
+        # A reply flushes the batch straight away
+        sent[:] = []
+        with server._batched_sends(sock):
+            server._send_message(sock, katcp.Message.inform('foo'))
+            server._send_message(sock, katcp.Message.reply('foo', 'ok'))
+            self.assertEqual(sent, ['#foo\n!foo ok\n'])
+
+    def test_max_line_length(self):
+        sock = mock.Mock()
+        sock.send.side_effect = len
+        self.server._add_socket(sock)
+        self.server.MAX_LINE_LENGTH = 20
+        too_long = (r"#log error",
+                    r"root Message\_line\_of\_at\_least\_%d\_bytes\_is\_longer"
+                    r"\_than\_the\_maximum\_of\_20\_bytes,\_discarding\_it.")
+        # Lines within the limit may arrive in pieces
+        self.server._handle_chunk(sock, '?watch')
+        self.server._handle_chunk(sock, 'dog\n?echo ' + 'x' * 20 + '\n')
+        # A partial line over the limit is dropped up to its line end
+        self.server._handle_chunk(sock, '?watchdog ' + 'x' * 20)
+        self.server._handle_chunk(sock, 'x' * 10)
+        self.server._handle_chunk(sock, 'x\n?watchdog\n')
+        data = ''.join(args[0].tobytes() for args, _ in
+                       sock.send.call_args_list)
+        self._assert_msgs_like(data.splitlines(), [
+            (r"!watchdog ok", ""),
+            (too_long[0], too_long[1] % 26),
+            (too_long[0], too_long[1] % 30),
+            (r"!watchdog ok", "")])
+
+    def test_perf_stats(self):
+        # ?perf-stats is only available once enabled
+        self.assertNotIn('perf-stats', self.server._request_handlers)
+        stats = self.server.enable_perf_stats()
+        self.assertIs(self.server.enable_perf_stats(), stats)
+        self.assertNotIn('perf-stats', type(self.server)._request_handlers)
+        self.assertTrue(self.server.has_sensor('perf.bytes-out'))
+        self.assertTrue(self.server.has_sensor('perf.reactor-heap'))
+
+        sock = mock.Mock()
+        sock.send.side_effect = len
+        sock.getpeername.return_value = ('127.0.0.1', 1234)
+        self.server._add_socket(sock)
+        self.server._handle_chunk(sock, '?watchdog\n?perf-stats\n')
+        (data,), _ = sock.send.call_args
+        self._assert_msgs_equal(data.tobytes().splitlines(), [
+            r'#perf-stats request watchdog 1 %s %s %s %s' % (
+                ('%.6f' % stats.requests['watchdog'].mean(),) * 4),
+            r'#perf-stats connection 127.0.0.1:1234 2 22 1 13',
+            r'#perf-stats gauge deferred-queue 0',
+            r'#perf-stats gauge reactor-heap 0',
+            r'!perf-stats ok 4'])
+
+        stats.update_sensors(force=True)
+        self.assertEqual(self.server.get_sensor('perf.requests').value(), 2)
+        self.assertEqual(self.server.get_sensor('perf.bytes-in').value(), 22)
+
+    def test_profile_hooks(self):
+        events = []
+        class Hook(ProfileHook):
+            def after(self, event, args, start, end):
+                events.append((event, args[:1], start <= end))
+        hook = Hook()
+        self.server._reactor = mock.Mock()
+        conn = ClientConnectionTest()
+        self.server.on_client_connect(conn)
+        sensor = katcp.Sensor.integer('a.profiled', 'An int', '', [0, 10])
+        self.server.add_sensor(sensor)
+        self.server.handle_message(conn, katcp.Message.request(
+            'sensor-sampling', 'a.profiled', 'event'))
+        strategy = self.server._strategies[conn][sensor]
+        strategy.attach()
+        other = katcp.sampling.SampleEvent(mock.Mock(), sensor)
+        other.attach()
+
+        self.server.add_profile_hook(hook)
+        self.addCleanup(self.server.remove_profile_hook, hook)
+        self.server.handle_message(conn, katcp.Message.request('watchdog'))
+        self.server.handle_message(conn, katcp.Message.reply('watchdog', 'ok'))
+        sensor.set_value(3)
+        # strategies of other servers and clients are not profiled
+        self.assertNotIn('update', vars(other))
+        self.assertEqual(events, [('request', (conn,), True),
+                                  ('reply', (conn,), True),
+                                  ('strategy-inform', (strategy,), True),
+                                  ('strategy-update', (strategy,), True)])
+        self.assertEqual(conn.informs[-1].arguments[2:], ['a.profiled',
+                                                          'nominal', '3'])
+        other.detach()
+        strategy.detach()
+
+        self.server.remove_profile_hook(hook)
+        self.server.add_profile_hook(hook)
+        self.server.remove_profile_hook(hook)
+        # Without hooks nothing is wrapped
+        self.assertNotIn('handle_request', vars(self.server))
+        self.assertNotIn('update', vars(strategy))
+        self.assertNotIn('inform', vars(strategy))
+        self.server.add_profile_hook(hook)
+
     def test_has_sensor(self):
         self.assertFalse(self.server.has_sensor('blaah'))
         self.server.add_sensor(katcp.Sensor.boolean('blaah', 'blaah sens'))
         self.assertTrue(self.server.has_sensor('blaah'))
 
+    def test_sample_reactor_factory(self):
+        factory = mock.Mock()
+        server = DeviceTestServer('', 0, sample_reactor_factory=factory)
+        server.start(timeout=1)
+        factory.assert_called_once_with()
+        factory.return_value.start.assert_called_once_with()
+        server.stop()
+        server.join(timeout=1)
+        factory.return_value.stop.assert_called_once_with()
+
+    def test_perf_stats_twisted_reactor(self):
+        from twisted.internet.task import Clock
+        from katcp.tx.sampling import TwistedSampleReactor
+
+        class LoopClock(Clock):
+            def callFromThread(self, f, *args, **kwargs):
+                f(*args, **kwargs)
+
+        clock = LoopClock()
+        server = DeviceTestServer('', 0, sample_reactor_factory=partial(
+            TwistedSampleReactor, reactor=clock))
+        start_thread_with_cleanup(self, server, start_timeout=1)
+        stats = server.enable_perf_stats()
+        sensor = server.get_sensor('an.int')
+        server._reactor.add_strategy(katcp.sampling.SamplePeriod(
+            lambda *args: None, sensor, 10))
+        clock.advance(10)
+        stats.update_sensors(force=True)
+        self.assertEqual(server.get_sensor('perf.reactor-heap').value(), 1)
+        self.assertEqual(stats.reactor_lateness['period'].count, 1)
+
 
 class TestDeviceServerClientIntegrated(unittest.TestCase, TestUtilMixin):
 
@@ -403,6 +624,7 @@ class TestDeviceServerClientIntegrated(unittest.TestCase, TestUtilMixin):
             (r"!log-level ok warn", ""),
             (r"!log-level ok trace", ""),
             (r"!log-level fail Unknown\_logging\_level\_name\_'unknown'", ""),
+            (r"#help bulk-data", ""),
             (r"#help cancel-slow-command Cancel\_slow\_command\_request,\_"
              "resulting\_in\_it\_replying\_immediately", ""),
             (r"#help client-list", ""),
@@ -413,6 +635,7 @@ class TestDeviceServerClientIntegrated(unittest.TestCase, TestUtilMixin):
             (r"#help raise-exception", ""),
             (r"#help raise-fail", ""),
             (r"#help restart", ""),
+            (r"#help sensor-history", ""),
             (r"#help sensor-list", ""),
             (r"#help sensor-sampling", ""),
             (r"#help sensor-sampling-clear", ""),
@@ -516,6 +739,7 @@ class TestDeviceServerClientIntegrated(unittest.TestCase, TestUtilMixin):
             (r"!log-level[4] ok trace", ""),
             (r"!log-level[5] fail Unknown\_logging\_level\_name\_'unknown'",
              ""),
+            (r"#help[6] bulk-data", ""),
             (r"#help[6] cancel-slow-command Cancel\_slow\_command\_request,\_"
              "resulting\_in\_it\_replying\_immediately", ""),
             (r"#help[6] client-list", ""),
@@ -526,6 +750,7 @@ class TestDeviceServerClientIntegrated(unittest.TestCase, TestUtilMixin):
             (r"#help[6] raise-exception", ""),
             (r"#help[6] raise-fail", ""),
             (r"#help[6] restart", ""),
+            (r"#help[6] sensor-history", ""),
             (r"#help[6] sensor-list", ""),
             (r"#help[6] sensor-sampling", ""),
             (r"#help[6] sensor-sampling-clear", ""),
@@ -832,3 +1057,73 @@ class TestDeviceServerClientIntegrated(unittest.TestCase, TestUtilMixin):
         self.server.remove_sensor(an_int)
         self.server.add_sensor(an_int)
         self.test_sampling()
+
+
+class TestBulkData(unittest.TestCase):
+
+    class BulkDataServer(DeviceTestServer):
+        PROTOCOL_INFO = katcp.ProtocolFlags(5, 0, set([
+            katcp.ProtocolFlags.MULTI_CLIENT,
+            katcp.ProtocolFlags.MESSAGE_IDS,
+            katcp.ProtocolFlags.BULK_DATA,
+            ]))
+
+        def request_reverse(self, req, msg):
+            """Reply with a blob reversed."""
+            blob = msg.arguments[0]
+            return req.make_reply("ok", type(blob).__name__,
+                                  bytearray(blob)[::-1])
+
+    def setUp(self):
+        self.server = self.BulkDataServer('', 0)
+        start_thread_with_cleanup(self, self.server, start_timeout=1)
+        host, port = self.server._sock.getsockname()
+        self.client = katcp.BlockingClient(host, port)
+        start_thread_with_cleanup(self, self.client, start_timeout=1)
+        self.assertTrue(self.client.wait_protocol(timeout=1))
+        reply, informs = self.client.blocking_request(
+            katcp.Message.request("bulk-data"))
+        self.assertTrue(reply.reply_ok())
+
+    def test_not_opted_in(self):
+        host, port = self.server._sock.getsockname()
+        client = katcp.BlockingClient(host, port)
+        start_thread_with_cleanup(self, client, start_timeout=1)
+        self.assertTrue(client.wait_protocol(timeout=1))
+        # the client sends bulk data but has not asked to receive it, so
+        # the blob in the reply is escaped inline
+        reply, informs = client.blocking_request(
+            katcp.Message.request("reverse", bytearray("a b\n")))
+        self.assertEqual(reply.arguments, ["ok", "memoryview", "\nb a"])
+        # the connection is still in step
+        reply, informs = client.blocking_request(
+            katcp.Message.request("watchdog"))
+        self.assertTrue(reply.reply_ok())
+
+    def test_round_trip(self):
+        self.assertTrue(self.client.protocol_flags.bulk_data)
+        blob = "".join(chr(i % 256) for i in range(100000))
+        for data in [blob, "\n\r\\ ", ""]:
+            reply, informs = self.client.blocking_request(
+                katcp.Message.request("reverse", bytearray(data)))
+            self.assertEqual(reply.arguments[:2], ["ok", "memoryview"])
+            self.assertEqual(reply.arguments[2].tobytes(), data[::-1])
+
+    def test_pipelined(self):
+        msgs = []
+        self.client.handle_reply = mock.Mock(side_effect=msgs.append)
+        self.client.send_message(katcp.Message.request(
+            "reverse", bytearray("ab"), mid=1))
+        self.client.send_message(katcp.Message.request(
+            "reverse", bytearray("cde"), mid=2))
+        self.client._sock.sendall("?watchdog[3]\n")
+        # a \r\n line end is not part of the blob, even when split
+        self.client._sock.sendall("?reverse[4] \\b2\r")
+        time.sleep(0.05)
+        self.client._sock.sendall("\n\nf")
+        deadline = time.time() + 1
+        while len(msgs) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([(m.mid, m.arguments[-1]) for m in msgs],
+                         [("1", memoryview("ba")), ("2", memoryview("edc")),
+                          ("3", "ok"), ("4", memoryview("f\n"))])
@@ -7,3 +7,4 @@ from katcp.tx.core import (DeviceServer, DeviceProtocol, ClientKatCPProtocol,
                            KatCPServer, KatCP, ServerKatCPProtocol, run_client,
                            KatCPClientFactory)
 from katcp.tx.proxy import DeviceHandler, ProxyProtocol, ProxyKatCP
+from katcp.tx.sampling import TwistedSampleReactor
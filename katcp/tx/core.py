@@ -9,18 +9,21 @@ from twisted.python import log
 from twisted.internet.interfaces import IPushProducer
 import logging
 
-from katcp import MessageParser, Message, AsyncReply
+from katcp import MessageParser, Message, AsyncReply, Sensor
 from katcp.core import FailReply, ProtocolFlags
 from katcp.core import (SEC_TO_MS_FAC, MS_TO_SEC_FAC, SEC_TS_KATCP_MAJOR,
                         VERSION_CONNECT_KATCP_MAJOR, DEFAULT_KATCP_MAJOR)
-from katcp.server import DeviceLogger, construct_name_filter
+from katcp.server import (DeviceLogger, construct_name_filter,
+                          select_sensor_history)
 from katcp.version import VERSION, VERSION_STR
 from katcp.tx.sampling import (DifferentialStrategy, AutoStrategy,
     EventStrategy, NoStrategy, PeriodicStrategy, EventRateStrategy)
 
+import re
 import sys
 import traceback
 import time
+from collections import deque
 
 
 class UnhandledMessage(Exception):
@@ -42,6 +45,10 @@ class DeviceNotConnected(Exception):
 class ShouldReturnMessage(Exception):
     pass
 
+
+class RequestTimeout(Exception):
+    pass
+
 TB_LIMIT = 20
 
 
@@ -78,20 +85,96 @@ class KatCP(LineReceiver):
     delimiter = '\n'
     MAX_LENGTH = 64 * (2 ** 20)  # 64 MB should be fine
     producing = True
+    # default timeout in seconds for send_request, None means wait forever
+    default_request_timeout = None
+    # maximum number of messages queued while the transport is not
+    # accepting data, None means no limit
+    MAX_QUEUED = 10000
+    # what to do with a message that does not fit in the queue, either 'drop'
+    # it or 'disconnect' the peer
+    QUEUE_OVERFLOW = 'drop'
 
     def __init__(self):
         self.parser = MessageParser()
-        self.queries = []
-        self.queue = []
-
-    def send_request(self, name, *args):
+        # outstanding requests sent with a message id, map mid -> (name,
+        # deferred, list of informs, callback called with each inform)
+        self.queries = {}
+        # outstanding requests sent without a message id (katcp v4 peers or
+        # peers whose protocol flags are not known yet), in the order sent
+        self.fifo_queries = deque()
+        # outbound messages waiting for the transport to resume, #sensor-status
+        # informs are queued by sensor name, the latest one is kept in
+        # queued_status
+        self.queue = deque()
+        self.queued_status = {}
+        self.protocol_flags = None
+        self._last_msg_id = 0
+        # number of requests that timed out, kept across reconnects
+        self.timeouts = 0
+        # number of outbound messages dropped or replaced by a newer value
+        # while the transport was paused
+        self.dropped = 0
+        self.coalesced = 0
+        self.overflowed = False
+
+    def _next_id(self):
+        """Return the next available message id."""
+        self._last_msg_id += 1
+        return str(self._last_msg_id)
+
+    def send_request(self, name, *args, **kwargs):
+        """ Send a request, returning a deferred that fires with an
+        (informs, reply) tuple. The deferred errbacks with RequestTimeout if
+        no reply arrives within the timeout keyword argument (in seconds,
+        defaults to default_request_timeout). If an inform_callback keyword
+        argument is given, it is called with each inform as it arrives and
+        the informs are not collected.
+        """
+        timeout = kwargs.pop('timeout', self.default_request_timeout)
+        inform_callback = kwargs.pop('inform_callback', None)
+        if kwargs:
+            raise TypeError('Invalid keyword argument(s): %r' % kwargs)
         if not self.transport.connected:
             raise DeviceNotConnected()
         d = Deferred()
-        self.send_message(Message.request(name, *args))
-        self.queries.append((name, d, []))
+        informs = []
+        if inform_callback is None:
+            inform_callback = informs.append
+        mid = None
+        if (self.protocol_flags is not None and
+            self.protocol_flags.supports(ProtocolFlags.MESSAGE_IDS)):
+            mid = self._next_id()
+            self.queries[mid] = (name, d, informs, inform_callback)
+            self.send_message(Message.request(name, mid=mid, *args))
+        else:
+            self.send_message(Message.request(name, *args))
+            self.fifo_queries.append((name, d, informs, inform_callback))
+        if timeout is not None:
+            call = reactor.callLater(timeout, self._request_timed_out,
+                                     name, d, mid, timeout)
+            d.addBoth(self._cancel_request_timeout, call)
         return d
 
+    def _cancel_request_timeout(self, result, call):
+        if call.active():
+            call.cancel()
+        return result
+
+    def _request_timed_out(self, name, d, mid, timeout):
+        if mid is not None:
+            del self.queries[mid]
+        else:
+            # leave a placeholder so that a late reply is still matched
+            # to this request rather than the next one in the queue
+            for i, (qname, qd, informs, callback) in enumerate(
+                    self.fifo_queries):
+                if qd is d:
+                    self.fifo_queries[i] = (qname, None, informs, callback)
+                    break
+        self.timeouts += 1
+        d.errback(RequestTimeout("Request %s timed out after %s seconds."
+                                 % (name, timeout)))
+
     def dataReceived(self, data):
         # translate '\r' into '\n'
         return LineReceiver.dataReceived(self, data.replace('\r', '\n'))
@@ -122,6 +205,9 @@ class KatCP(LineReceiver):
     def inform_version_connect(self, msg):
         if len(msg.arguments) < 2:
             return
+        if msg.arguments[0] == 'katcp-protocol':
+            self.protocol_flags = ProtocolFlags.parse_version(msg.arguments[1])
+            return
         if  msg.arguments[0] == 'katcp-device':
             self.version = msg.arguments[1]
         if len(msg.arguments) >= 3:
@@ -136,18 +222,25 @@ class KatCP(LineReceiver):
     def handle_inform(self, msg):
         # if we have a request being processed, store all the informs
         # in a list of stuff to process
+        if msg.mid is not None and msg.mid in self.queries:
+            name, d, informs, inform_callback = self.queries[msg.mid]
+            if name == msg.name:
+                inform_callback(msg)
+                return
         name = msg.name
         name = name.replace('-', '_')
         meth = getattr(self, 'inform_' + name, None)
         if meth is not None:
             meth(msg)
-        elif self.queries:
-            name, d, queue = self.queries[0]
+        elif self.fifo_queries:
+            name, d, informs, inform_callback = self.fifo_queries[0]
             if name != msg.name:
                 return  # instead of raising WrongQueryOrder, we discard
                         # informs that we don't know about
-            queue.append(msg)  # unespace?
+            inform_callback(msg)  # unespace?
         else:
+            # nothing claims it, whether or not replies to requests with
+            # message ids are outstanding
             raise UnhandledMessage(msg)
 
     def handle_request(self, msg):
@@ -173,14 +266,31 @@ class KatCP(LineReceiver):
             self.send_reply(Message.reply(msg.name, "fail", reason), msg)
 
     def handle_reply(self, msg):
-        if not self.queries:
+        if msg.mid is not None:
+            if msg.mid not in self.queries:
+                log.msg("Discarding reply to unknown or timed out request %r"
+                        % msg, logLevel=logging.DEBUG)
+                return
+            name, d, informs, _ = self.queries.pop(msg.mid)
+            if name != msg.name:
+                d.errback(UnhandledMessage(msg))
+                return
+            d.callback((informs, msg))
+            return
+        fifo_queries = self.fifo_queries
+        # drop timed out requests whose replies are evidently not coming
+        while (fifo_queries and fifo_queries[0][1] is None and
+               fifo_queries[0][0] != msg.name):
+            fifo_queries.popleft()
+        if not fifo_queries:
             raise NoQuerriesProcessed()
-        name, d, queue = self.queries[0]
+        name, d, informs, _ = fifo_queries[0]
         if name != msg.name:
             d.errback("Wrong request order")
             return
-        self.queries.pop(0)  # hopefully it's not large
-        d.callback((queue, msg))
+        fifo_queries.popleft()
+        if d is not None:
+            d.callback((informs, msg))
 
     # IPushProducer interface
     implements(IPushProducer)
@@ -190,10 +300,14 @@ class KatCP(LineReceiver):
     stopProducing = pauseProducing
 
     def resumeProducing(self):
-        for msg in self.queue:
-            self.transport.write(str(msg) + self.delimiter)
-        self.queue = []
         self.producing = True
+        queue = self.queue
+        # the transport calls pauseProducing as soon as its buffer is full
+        while queue and self.producing:
+            msg = queue.popleft()
+            if not isinstance(msg, Message):
+                msg = self.queued_status.pop(msg)
+            self.transport.write(str(msg) + self.delimiter)
 
     def send_reply(self, reply, orig_req):
         """Send a reply, setting the message id from the original request."""
@@ -211,16 +325,62 @@ class KatCP(LineReceiver):
         # just serialize a message
         if self.producing:
             self.transport.write(str(msg) + self.delimiter)
+        elif not self.overflowed:
+            self._queue_message(msg)
+        # otherwise we're unable to carry it, drop on the floor
+
+    def _queue_message(self, msg):
+        args = msg.arguments
+        if (msg.name == 'sensor-status' and msg.mtype == Message.INFORM and
+            len(args) >= 3 and args[1] == '1'):
+            # only the latest status of each sensor is of interest
+            sensor_name = args[2]
+            if sensor_name in self.queued_status:
+                self.queued_status[sensor_name] = msg
+                self.coalesced += 1
+                self.queue_event('coalesced')
+                return
         else:
+            sensor_name = None
+        if self.MAX_QUEUED is not None and len(self.queue) >= self.MAX_QUEUED:
+            self.dropped += 1
+            if self.QUEUE_OVERFLOW == 'disconnect':
+                log.msg("Outbound queue full, disconnecting %s" %
+                        (self.transport.getPeer(),))
+                self.overflowed = True
+                self.queue.clear()
+                self.queued_status.clear()
+                self.queue_event('disconnected')
+                abort = getattr(self.transport, 'abortConnection',
+                                self.transport.loseConnection)
+                abort()
+            else:
+                self.queue_event('dropped')
+            return
+        if sensor_name is None:
             self.queue.append(msg)
-        # otherwise we're unable to carry it, drop on the floor
+        else:
+            self.queued_status[sensor_name] = msg
+            self.queue.append(sensor_name)
+
+    def queue_event(self, event):
+        """ Called whenever an outbound message is coalesced, dropped or
+        the peer is disconnected because the queue is full, override to keep
+        statistics
+        """
+        pass
 
     def connectionLost(self, failure):
         # errback all waiting queries
         self.connection_lost = True
-        for _, d, _ in self.queries:
-            d.errback(failure)
-        self.queries = []
+        queries = list(self.fifo_queries) + self.queries.values()
+        self.fifo_queries = deque()
+        self.queries = {}
+        self.queue.clear()
+        self.queued_status.clear()
+        for _, d, _, _ in queries:
+            if d is not None:
+                d.errback(failure)
 
     def _request_unknown(self, msg):
         return Message.reply(msg.name, "invalid", "Unknown request.")
@@ -403,6 +563,11 @@ class DeviceProtocol(ServerKatCPProtocol):
         self.factory.deregister_client(self.transport.client)
         for strat in self.strategies.values():
             strat.cancel()
+        self.queue.clear()
+        self.queued_status.clear()
+
+    def queue_event(self, event):
+        self.factory.queue_event(event)
 
     def read_formatted_from_sensor(self, sensor, callback, fail,
                                    lst_of_deferreds=None):
@@ -579,6 +744,66 @@ class DeviceProtocol(ServerKatCPProtocol):
                                              *sensor.formatted_params), msg)
         return Message.reply(msg.name, "ok", len(sensors))
 
+    def request_sensor_history(self, msg):
+        """Request the recorded readings of a sensor.
+
+        The readings are sent as a sequence of #sensor-history informs, oldest
+        first. History has to be enabled for the sensor, either with
+        Sensor.enable_history() or DeviceServer.enable_sensor_history().
+
+        Parameters
+        ----------
+        name : str
+            Name of the sensor.
+        start : float, optional
+            Only send readings taken at or after this time, in seconds since
+            the Unix epoch.
+        end : float, optional
+            Only send readings taken at or before this time.
+        max : int, optional
+            Send at most this many readings (the most recent ones).
+
+        Informs
+        -------
+        timestamp : float
+            Timestamp of the reading.
+        count : {1}
+            Number of sensors described in this inform. Will always be one.
+        name : str
+            Name of the sensor.
+        status : str
+            Status of the sensor at the time of the reading.
+        value : object
+            Value of the reading.
+
+        Returns
+        -------
+        success : {'ok', 'fail'}
+            Whether sending the readings succeeded.
+        informs : int
+            Number of #sensor-history inform messages sent.
+
+        Examples
+        --------
+        ::
+
+            ?sensor-history cpu.temp 1244631611.0 1244631612.0
+            #sensor-history 1244631611.415231 1 cpu.temp nominal 45.5
+            !sensor-history ok 1
+        """
+        if not msg.arguments:
+            return Message.reply(msg.name, "fail", "No sensor name given.")
+        name = msg.arguments[0]
+        sensor = self.factory.sensors.get(name, None)
+        if sensor is None:
+            return Message.reply(msg.name, "fail", "Unknown sensor name.")
+        samples = select_sensor_history(sensor, msg.arguments[1:],
+                                        self.PROTOCOL_INFO.major)
+        for timestamp, status, value in samples:
+            self.send_reply_inform(Message.inform(msg.name, timestamp, "1",
+                                                  name, status, value), msg)
+        return Message.reply(msg.name, "ok", str(len(samples)))
+
     def request_sensor_sampling(self, msg):
         """Configure or query the way a sensor is sampled.
 
@@ -698,6 +923,18 @@ class DeviceProtocol(ServerKatCPProtocol):
         """
         return Message.reply("watchdog", "ok")
 
+    def request_bulk_data(self, msg):
+        """Send blob arguments to this client as raw bulk data.
+
+        The twisted server does not support bulk-data blobs, so this always
+        fails and blob arguments are escaped inline.
+
+        Returns
+        -------
+        success : {'fail'}
+        """
+        raise FailReply("Bulk data is not supported by this server.")
+
     def request_restart(self, msg):
         """Restart the device server.
 
@@ -840,17 +1077,58 @@ class DeviceServer(KatCPServer):
     """ This is a device server listening on a given port and address
     """
     protocol = DeviceProtocol
+    # add sensors counting outbound messages dropped or coalesced and
+    # clients disconnected because their outbound queue was full
+    QUEUE_SENSORS = False
 
     def add_sensor(self, sensor):
         self.sensors[sensor.name] = sensor
+        for name_re, size in self._history_patterns:
+            if name_re.search(sensor.name):
+                # sensor-like objects need not support history
+                if getattr(sensor, 'history', True) is None:
+                    sensor.enable_history(size)
+                break
+
+    def enable_sensor_history(self, pattern, size):
+        """ Record the history of sensors whose names match the pattern,
+        see katcp.DeviceServer.enable_sensor_history
+        """
+        name_re = re.compile(pattern)
+        self._history_patterns.append((name_re, size))
+        for name, sensor in self.sensors.iteritems():
+            if (getattr(sensor, 'history', True) is None and
+                name_re.search(name)):
+                sensor.enable_history(size)
 
     def setup_sensors(self):
         pass  # override to provide some sensors
 
+    def setup_queue_sensors(self):
+        for event, description in [
+            ('dropped', 'Number of messages dropped because a client '
+             'outbound queue was full'),
+            ('coalesced', 'Number of queued sensor-status informs replaced '
+             'by a newer value'),
+            ('disconnected', 'Number of clients disconnected because their '
+             'outbound queue was full')]:
+            self.add_sensor(Sensor.integer('outbound-' + event, description,
+                                           '', default=0))
+
+    def queue_event(self, event):
+        """ Called by the client protocols, see KatCP.queue_event
+        """
+        sensor = self.sensors.get('outbound-' + event)
+        if sensor is not None:
+            sensor.set_value(sensor.value() + 1)
+
     def __init__(self, port, host):
         self.log = DeviceLogger(self)  # python logger is None
         KatCPServer.__init__(self, port, host)
         self.sensors = {}
+        self._history_patterns = []
+        if self.QUEUE_SENSORS:
+            self.setup_queue_sensors()
         self.setup_sensors()
 
     def _log_msg(self, level_name, msg, name, timestamp=None):
@@ -1,12 +1,17 @@
 
-from katcp.tx.core import DeviceServer, ClientKatCPProtocol, DeviceProtocol
-from twisted.internet.defer import DeferredList
+from katcp.tx.core import (DeviceServer, ClientKatCPProtocol, DeviceProtocol,
+                            RequestTimeout)
+from twisted.internet.defer import DeferredList, DeferredSemaphore
 from twisted.internet import reactor
 from twisted.internet.protocol import ClientFactory
 from twisted.python import log
+from bisect import bisect_left
+from functools import partial
 from katcp import Message, AsyncReply, Sensor
 from katcp.kattypes import request, return_reply, Int
 
+import json
+import os
 import re
 import time
 
@@ -21,21 +26,233 @@ def value_only_formatted(func):
     return new_func
 
 
+def tightest_strategy(strategies):
+    """ Return the upstream sampling strategy which delivers every update
+    needed by all of the given strategies (tuples of strategy name and
+    parameters)
+    """
+    names = set(strategy[0] for strategy in strategies)
+    if 'auto' in names:
+        return ('auto',)
+    if names & set(['event', 'differential', 'event-rate']):
+        return ('event',)
+    periods = [strategy[1] for strategy in strategies
+               if strategy[0] == 'period']
+    if periods:
+        return ('period', min(periods, key=float))
+    return ('none',)
+
+
+def literal_prefix(pattern):
+    """ Return the literal text at the start of a regular expression, which
+    every string matched by it (with re.match) has to start with
+    """
+    if '|' in pattern:
+        return ''
+    special = '.^$*+?{}[]|()'
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break  # character class like \d or a back reference
+            char = pattern[i + 1]
+            i += 2
+        elif char in special:
+            break
+        else:
+            i += 1
+        if i < len(pattern) and pattern[i] in '*?{':
+            break  # the character is optional
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class SensorIndex(object):
+    """ A sorted index of sensor names. Patterns are matched against the
+    range of names sharing their literal prefix only, so the cost of a
+    lookup depends on the size of the result rather than on the number of
+    sensors.
+    """
+    MAX_PATTERNS = 100
+
+    def __init__(self):
+        self._names = set()
+        self._sorted = []
+        self._added = []
+        self._removed = False
+        self._patterns = {}
+
+    def add(self, name):
+        if name not in self._names:
+            self._names.add(name)
+            self._added.append(name)
+
+    def remove(self, name):
+        if name in self._names:
+            self._names.remove(name)
+            self._removed = True
+
+    def names(self):
+        """ Return a sorted list of all the names """
+        if self._removed:
+            self._sorted = sorted(self._names)
+            self._added = []
+            self._removed = False
+        elif self._added:
+            # sorting two sorted runs is a linear merge
+            self._added.sort()
+            self._sorted = sorted(self._sorted + self._added)
+            self._added = []
+        return self._sorted
+
+    def remove_prefix(self, prefix):
+        """ Remove the names starting with prefix and return them sorted,
+        touching only that range of the index
+        """
+        names = self.names()
+        start = end = bisect_left(names, prefix)
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        removed = names[start:end]
+        del names[start:end]
+        self._names.difference_update(removed)
+        return removed
+
+    def compile(self, pattern):
+        """ Return the compiled regular expression for the pattern """
+        try:
+            return self._patterns[pattern]
+        except KeyError:
+            if len(self._patterns) >= self.MAX_PATTERNS:
+                self._patterns.clear()
+            compiled = self._patterns[pattern] = re.compile(pattern)
+            return compiled
+
+    def _scan(self, prefix, matcher):
+        names = self.names()
+        if not prefix:
+            return [name for name in names if matcher(name)]
+        result = []
+        for i in xrange(bisect_left(names, prefix), len(names)):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            if matcher(name):
+                result.append(name)
+        return result
+
+    def match(self, pattern):
+        """ Return the sorted names matching the start of the pattern, as
+        re.match does
+        """
+        prefix = literal_prefix(pattern[1:] if pattern.startswith('^')
+                                else pattern)
+        return self._scan(prefix, self.compile(pattern).match)
+
+    def search(self, pattern):
+        """ Return the sorted names containing the pattern, as re.search
+        does
+        """
+        prefix = ''
+        if pattern.startswith('^'):
+            prefix = literal_prefix(pattern[1:])
+        return self._scan(prefix, self.compile(pattern).search)
+
+
+class SyncCache(object):
+    """ An on-disk cache of the ?help and ?sensor-list informs of devices,
+    keyed by the build state the device reports on connection. A device
+    whose build state has not changed does not need to be introspected again.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _filename(self, name):
+        return os.path.join(self.directory, name + '.json')
+
+    def get(self, name, build_state):
+        """ Return the (help, sensor_list) lists of inform arguments stored
+        for the device, or None if there is nothing stored for this build
+        state
+        """
+        try:
+            with open(self._filename(name)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry.get('build_state') != build_state:
+            return None
+        # json gives back unicode, the arguments of parsed messages are str
+        return ([[arg.encode('utf-8') for arg in args]
+                 for args in entry['help']],
+                [[arg.encode('utf-8') for arg in args]
+                 for args in entry['sensor_list']])
+
+    def put(self, name, build_state, help_args, sensor_list_args):
+        filename = self._filename(name)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(filename + '.tmp', 'w') as f:
+                json.dump({'build_state': build_state, 'help': help_args,
+                           'sensor_list': sensor_list_args}, f)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError), e:
+            log.msg("Could not store sync cache for %s: %s" % (name, e))
+
+
 class ProxiedSensor(Sensor):
     """ A sensor which is a proxy for other sensor on the remote device.
-    Returns a deferred on read
+
+    Values received from the device are cached together with the time they
+    arrived. While the device reports the sensor through a sampling
+    subscription, or if the reading is younger than
+    proxy.SENSOR_CACHE_MAX_AGE, reads are answered from the cache, otherwise
+    a deferred from a live ?sensor-value is returned.
     """
     def __init__(self, name, description, units, stype, device, proxy,
                  *formatted_params):
         self.basename = name
         self.device = device
+        self.proxy = proxy
         stype = Sensor.parse_type(stype)
         params = Sensor.parse_params(stype, formatted_params)
         Sensor.__init__(self, stype, device.name + '.' + name, description,
                         units, params=params)
+        self.invalidate_cache()
+
+    def set_formatted(self, raw_timestamp, raw_status, raw_value, *args):
+        Sensor.set_formatted(self, raw_timestamp, raw_status, raw_value,
+                             *args)
+        self.cached_formatted = (raw_timestamp, raw_status, raw_value)
+        self.cached_at = time.time()
+
+    def invalidate_cache(self):
+        self.cached_formatted = None
+        self.cached_at = None
+
+    def cache_fresh(self):
+        if self.cached_at is None:
+            return False
+        if self.basename in self.device.subscribed:
+            return True
+        max_age = self.proxy.SENSOR_CACHE_MAX_AGE
+        return (max_age is not None and
+                time.time() - self.cached_at <= max_age)
+
+    def _update_cache(self, (informs, reply)):
+        if informs and len(informs[0].arguments) >= 5:
+            args = informs[0].arguments
+            self.set_formatted(args[0], args[3], args[4])
+        return informs, reply
 
     def read_formatted(self):
-        return self.device.send_request('sensor-value', self.basename)
+        if self.cache_fresh():
+            return self.cached_formatted
+        d = self.device.send_request('sensor-value', self.basename)
+        return d.addCallback(self._update_cache)
 
 
 class StateSensor(object):
@@ -55,6 +272,23 @@ class StateSensor(object):
         return DeviceHandler.STATE_NAMES[self.device.state]
 
 
+class TimeoutsSensor(object):
+    """ A count of the requests to a device which timed out
+    """
+    description = 'number of requests which timed out'
+    stype = 'integer'
+    formatted_params = ('0', '2147483647')
+    units = ''
+
+    def __init__(self, name, device):
+        self.device = device
+        self.name = name
+
+    @value_only_formatted
+    def read_formatted(self):
+        return str(self.device.timeouts)
+
+
 class DeviceHandler(ClientKatCPProtocol):
     SYNCING, SYNCED, UNSYNCED = range(3)
     STATE_NAMES = ['syncing', 'synced', 'unsynced']
@@ -75,13 +309,112 @@ class DeviceHandler(ClientKatCPProtocol):
         self.requests = []
         self.sensors = {}
         self.state = self.UNSYNCED
+        # sampling strategies requested by proxy clients, map sensor name ->
+        # {client protocol: strategy tuple}
+        self.downstream_sampling = {}
+        # strategies requested from the device and the sensors for which
+        # the device accepted a strategy other than none
+        self.upstream_sampling = {}
+        self.subscribed = set()
+        self.build_state = None
+        self.sync_started = None
+        # seconds it took to sync the device and whether the sync cache was
+        # used, after the last sync
+        self.sync_time = None
+        self.sync_cached = False
+        self._holding_sync = False
+        self._help_args = []
+        self._sensor_list_args = []
+        self.request_docs = {}
+
+    def _start_sync(self, _):
+        self._holding_sync = True
+        if self.state != self.SYNCING:
+            # connection was lost while waiting for our turn
+            self._release_sync()
+            return
+        if self.proxy.sync_cache is None:
+            self._introspect()
+        else:
+            # informs sent by the device on connection, including its build
+            # state, arrive before the reply
+            d = self.send_request('watchdog',
+                                  timeout=self.proxy.SYNC_REQUEST_TIMEOUT)
+            d.addCallbacks(self._check_sync_cache, self._sync_failed)
+
+    def _check_sync_cache(self, _):
+        cached = None
+        if self.build_state is not None:
+            cached = self.proxy.sync_cache.get(self.name, self.build_state)
+        if cached is None:
+            self._introspect()
+            return
+        help_args, sensor_list_args = cached
+        self.sync_cached = True
+        self._got_help(([Message.inform('help', *args)
+                         for args in help_args], None))
+        self._got_sensor_list(([Message.inform('sensor-list', *args)
+                                for args in sensor_list_args], None))
+
+    def _introspect(self):
+        self.sync_cached = False
+        # no need to wait for one reply before sending the next request
+        timeout = self.proxy.SYNC_REQUEST_TIMEOUT
+        d = self.send_request('help', timeout=timeout)
+        d.addCallbacks(self._got_help, self._sync_failed)
+        d = self.send_request('sensor-list', timeout=timeout)
+        d.addCallbacks(self._got_sensor_list, self._sync_failed)
+
+    def _store_sync_cache(self):
+        if self.proxy.sync_cache is not None and self.build_state is not None:
+            self.proxy.sync_cache.put(self.name, self.build_state,
+                                      self._help_args, self._sensor_list_args)
+
+    def inform_interface_changed(self, msg):
+        """ The requests of the device changed, fetch them again to update
+        the routing of proxied requests
+        """
+        def got_help(result):
+            self._got_help(result)
+            self._store_sync_cache()
+
+        if self.state != self.SYNCED:
+            return  # the sync in progress will pick up the changes
+        if msg.arguments and msg.arguments[0] != 'request':
+            return
+        d = self.send_request('help')
+        d.addCallbacks(got_help, self._sync_failed)
+
+    def _sync_failed(self, failure):
+        if self._holding_sync:
+            log.msg("Syncing %s failed: %s" % (self.name,
+                                               failure.getErrorMessage()))
+            self._release_sync()
+            if failure.check(RequestTimeout):
+                # let other devices sync and try again after reconnecting
+                self.transport.loseConnection()
+
+    def _release_sync(self):
+        if self._holding_sync:
+            self._holding_sync = False
+            self.proxy.sync_semaphore.release()
 
     def _got_help(self, (informs, reply)):
-        for inform in informs:
-            self.requests.append(inform.arguments[0])
-        self.send_request('sensor-list').addCallback(self._got_sensor_list)
+        self.requests = [inform.arguments[0] for inform in informs]
+        self.request_docs = dict((inform.arguments[0],
+                                  ' '.join(inform.arguments[1:]))
+                                 for inform in informs)
+        self._help_args = [inform.arguments for inform in informs]
+        self.proxy.update_routes(self)
 
     def _got_sensor_list(self, (informs, reply)):
+        if not self._holding_sync:
+            return  # sync was abandoned
+        self._sensor_list_args = [inform.arguments for inform in informs]
+        if not self.sync_cached:
+            self._store_sync_cache()
+        self._release_sync()
+        self.sync_time = time.time() - self.sync_started
         self.state = self.SYNCED
         for inform in informs:
             name, description, units, stype = inform.arguments[:4]
@@ -91,9 +424,79 @@ class DeviceHandler(ClientKatCPProtocol):
                                       self, self.proxy, *formatted_arguments)
             self.sensors[name] = sensor
             self.proxy.add_proxied_sensor(self, sensor)
+        self.subscribe_sensors()
         self.device_ready()
         self.proxy.device_ready(self)
 
+    def subscribe_sensors(self):
+        """ Set up the sampling of every sensor on the device. If the sensor
+        cache is enabled, every change is reported and all the current
+        values are read, so that the cached sensor values stay current
+        """
+        def got_values((informs, reply)):
+            for inform in informs:
+                args = inform.arguments
+                if len(args) >= 5 and args[2] in self.sensors:
+                    self.sensors[args[2]].set_formatted(args[0], args[3],
+                                                        args[4])
+
+        def failed(failure):
+            log.msg("Reading sensors of %s failed: %s" % (
+                self.name, failure.getErrorMessage()))
+
+        for name in sorted(self.sensors):
+            self.update_sampling(name)
+        if self.proxy.SENSOR_CACHE_MAX_AGE is not None:
+            # not every device reports the current value when subscribing,
+            # so seed the cache explicitly
+            d = self.send_request('sensor-value')
+            d.addCallbacks(got_values, failed)
+
+    def set_downstream_sampling(self, name, client, strategy):
+        """ Record the sampling strategy a proxy client set on a sensor of
+        this device and adjust the upstream subscription to match
+        """
+        clients = self.downstream_sampling.setdefault(name, {})
+        if strategy[0] == 'none':
+            clients.pop(client, None)
+            if not clients:
+                del self.downstream_sampling[name]
+        else:
+            clients[client] = strategy
+        if self.state == self.SYNCED:
+            self.update_sampling(name)
+
+    def update_sampling(self, name):
+        """ Request the tightest strategy needed by the proxy clients (and
+        by the sensor cache) from the device, unless it is already in place.
+        All #sensor-status informs are fanned out locally through the
+        cached sensor value.
+        """
+        def done((informs, reply)):
+            if self.upstream_sampling.get(name) != strategy:
+                return  # superseded by a later request
+            if reply.arguments[0] == 'ok' and strategy[0] != 'none':
+                self.subscribed.add(name)
+            else:
+                self.subscribed.discard(name)
+
+        def failed(failure):
+            # reads of the sensor fall back to live ?sensor-value requests
+            self.subscribed.discard(name)
+            log.msg("Subscribing to %s.%s failed: %s" % (
+                self.name, name, failure.getErrorMessage()))
+
+        strategies = self.downstream_sampling.get(name, {}).values()
+        if self.proxy.SENSOR_CACHE_MAX_AGE is not None:
+            strategies.append(('event',))
+        strategy = tightest_strategy(strategies)
+        if strategy == self.upstream_sampling.get(name, ('none',)):
+            return
+        self.upstream_sampling[name] = strategy
+        self.subscribed.discard(name)
+        d = self.send_request('sensor-sampling', name, *strategy)
+        d.addCallbacks(done, failed)
+
     def device_ready(self):
         """ Another hook that can be overloaded if you want to execute
         code just after device has been synced
@@ -105,18 +508,28 @@ class DeviceHandler(ClientKatCPProtocol):
         about it's capabilities
         """
         self.state = self.SYNCING
-        self.send_request('help').addCallback(self._got_help)
         self._conn_counter = 0
+        self.sync_started = time.time()
+        # at most proxy.SYNC_CONCURRENCY devices are introspected at once
+        self.proxy.sync_semaphore.acquire().addCallback(self._start_sync)
 
     def add_proxy(self, proxy):
         self.proxy = proxy
         proxy.add_sensor(StateSensor(self.name + '-' + 'state', self))
+        proxy.add_sensor(TimeoutsSensor(self.name + '-' + 'request-timeouts',
+                                        self))
 
     def schedule_resyncing(self):
         reactor.connectTCP(self.host, self.port, self.proxy.client_factory)
 
     def connectionLost(self, failure):
         self.state = self.UNSYNCED
+        self.build_state = None
+        self._release_sync()
+        for sensor in self.sensors.itervalues():
+            sensor.invalidate_cache()
+        self.upstream_sampling.clear()
+        self.subscribed.clear()
         ClientKatCPProtocol.connectionLost(self, failure)
         if not self.stopping:
             reactor.callLater(self.proxy.CONN_DELAY_TIMEOUT,
@@ -230,16 +643,115 @@ class ProxyProtocol(DeviceProtocol):
             return DeviceProtocol.request_sensor_list(self, msg)
 
         # handle regex
-        name_re = re.compile(msg.arguments[0][1:-1])
-        sensors = dict([(name, sensor) for name, sensor in
-            self.factory.sensors.iteritems() if name_re.search(name)])
-
-        for name, sensor in sorted(sensors.items(), key=lambda x: x[0]):
+        names = self.factory.sensor_index.search(msg.arguments[0][1:-1])
+        for name in names:
+            sensor = self.factory.sensors[name]
             self.send_reply_inform(Message.inform("sensor-list",
                 name, sensor.description, sensor.units, sensor.stype,
                 *sensor.formatted_params), msg)
 
-        return Message.reply(msg.name, "ok", len(sensors))
+        return Message.reply(msg.name, "ok", len(names))
+
+    def request_help(self, msg):
+        """Return help on the available requests.
+
+        Return a description of the available requests using a sequence of
+        #help informs. Requests of the proxied devices are listed after the
+        requests of the proxy itself, as <device>-<request>.
+
+        Parameters
+        ----------
+        request : str, optional
+            The name of the request to return help for (the default is to
+            return help for all requests).
+
+        Informs
+        -------
+        request : str
+            The name of a request.
+        description : str
+            Documentation for the named request.
+
+        Returns
+        -------
+        success : {'ok', 'fail'}
+            Whether sending the help succeeded.
+        informs : int
+            Number of #help inform messages sent.
+
+        Examples
+        --------
+        ?help antenna-stow
+        #help antenna-stow ...description...
+        !help ok 1
+        """
+        routes = self.factory.routes
+        if msg.arguments:
+            name = msg.arguments[0]
+            if name not in routes:
+                return DeviceProtocol.request_help(self, msg)
+            names = [name]
+            count = 0
+        else:
+            reply = DeviceProtocol.request_help(self, msg)
+            names = sorted(routes)
+            count = int(reply.arguments[1])
+        for name in names:
+            device, req_name = routes[name]
+            self.send_reply_inform(Message.inform('help', name,
+                device.request_docs.get(req_name, '')), msg)
+            count += 1
+        return Message.reply(msg.name, "ok", str(count))
+
+    def request_sensor_sampling(self, msg):
+        """Configure or query the way a sensor is sampled.
+
+        Sampled values are reported asynchronously using the #sensor-status
+        message. For sensors of proxied devices a single subscription with
+        the tightest strategy requested by any client is kept on the device,
+        and its reports are fanned out to the clients by the proxy.
+
+        Parameters
+        ----------
+        name : str
+            Name of the sensor whose sampling strategy to query or configure.
+        strategy : {'none', 'auto', 'event', 'differential', \
+                    'period'}, optional
+            Type of strategy to use to report the sensor value.
+        params : list of str, optional
+            Additional strategy parameters (dependent on the strategy type).
+
+        Returns
+        -------
+        success : {'ok', 'fail'}
+            Whether the sensor-sampling request succeeded.
+        name : str
+            Name of the sensor queried or configured.
+        strategy : {'none', 'auto', 'event', 'differential', 'period'}
+            Name of the new or current sampling strategy for the sensor.
+        params : list of str
+            Additional strategy parameters (see description under Parameters).
+
+        Examples
+        --------
+        ?sensor-sampling device.power.on period 5
+        !sensor-sampling ok device.power.on period 5
+        """
+        reply = DeviceProtocol.request_sensor_sampling(self, msg)
+        if reply.arguments[0] == 'ok':
+            sensor = self.factory.sensors[msg.arguments[0]]
+            if isinstance(sensor, ProxiedSensor):
+                sensor.device.set_downstream_sampling(sensor.basename, self,
+                                                      tuple(msg.arguments[1:]))
+        return reply
+
+    def connectionLost(self, failure):
+        for strategy in self.strategies.values():
+            sensor = strategy.sensor
+            if isinstance(sensor, ProxiedSensor):
+                sensor.device.set_downstream_sampling(sensor.basename, self,
+                                                      ('none',))
+        DeviceProtocol.connectionLost(self, failure)
 
     def _send_all_sensors(self, reqmsg, filter=None):
         """ Sends all sensor values with given filter (None = all)
@@ -248,38 +760,58 @@ class ProxyProtocol(DeviceProtocol):
         # python lexical scoping rules (we could not write count += 1
         # in a function)
 
-        def device_ok((informs, reply), device):
-            for inform in informs:
-                inform.arguments[2] = device.name + '.' + \
-                                      inform.arguments[2]
-                if filter is None or re.match(filter, inform.arguments[2]):
-                    self.send_reply_inform(inform, reqmsg)
-                    counter[0] += 1
+        index = self.factory.sensor_index
+        if filter is None:
+            names = index.names()
+            matcher = None
+        else:
+            names = index.match(filter)
+            matcher = index.compile(filter).match
+
+        def device_inform(inform, device):
+            # forwarded as soon as it arrives, nothing is buffered
+            inform.arguments[2] = device.name + '.' + inform.arguments[2]
+            if matcher is None or matcher(inform.arguments[2]):
+                self.send_reply_inform(inform, reqmsg)
+                counter[0] += 1
 
         def all_ok(_):
             self.send_reply(Message.reply('sensor-value', 'ok',
                                           str(counter[0])),
                             reqmsg)
 
+        # local sensors go first, proxied ones are grouped by device
+        by_device = {}
+        for name in names:
+            sensor = self.factory.sensors[name]
+            if isinstance(sensor, ProxiedSensor):
+                by_device.setdefault(sensor.device.name, []).append(sensor)
+                continue
+            timestamp_ms, status, value = sensor.read_formatted()
+            counter[0] += 1
+            self.send_reply_inform(Message.inform('sensor-value',
+                                                  timestamp_ms, "1",
+                                                  name, status,
+                                                  value),
+                                   reqmsg)
         wait_for = []
-        for device in self.factory.devices.itervalues():
-            if device.state == device.SYNCED:
-                d = device.send_request('sensor-value')
-                d.addCallback(device_ok, device)
-                wait_for.append(d)
-            # otherwise we don't have the list of sensors, so we don't
-            # send the message
+        for dev_name, sensors in sorted(by_device.iteritems()):
+            device = sensors[0].device
+            if device.state != device.SYNCED:
+                # otherwise we don't have the list of sensors, so we don't
+                # send the message
+                continue
+            if not all(sensor.cache_fresh() for sensor in sensors):
+                wait_for.append(device.send_request('sensor-value',
+                    inform_callback=partial(device_inform, device=device)))
+                continue
+            for sensor in sensors:
+                timestamp_ms, status, value = sensor.cached_formatted
+                self.send_reply_inform(Message.inform('sensor-value',
+                            timestamp_ms, "1", sensor.name, status,
+                            value), reqmsg)
+                counter[0] += 1
         DeferredList(wait_for).addCallback(all_ok)
-        for name, sensor in self.factory.sensors.iteritems():
-            if not isinstance(sensor, ProxiedSensor):
-                if filter is None or re.match(filter, name):
-                    timestamp_ms, status, value = sensor.read_formatted()
-                    counter[0] += 1
-                    self.send_reply_inform(Message.inform('sensor-value',
-                                                          timestamp_ms, "1",
-                                                          name, status,
-                                                          value),
-                                           reqmsg)
 
     def request_sensor_value(self, msg):
         """Poll a sensor value or value(s).
@@ -363,43 +895,35 @@ class ProxyProtocol(DeviceProtocol):
             device.send_request('halt').addCallback(got_halt)
             raise AsyncReply()
 
-    def __getattr__(self, attr):
-        # TODO: It would be cleaner if a new request method / callback
-        # wasn't created for every proxied request.
-        # TODO: These proxied methods should appear in the ?help for the proxy
-        # but currently don't.
-
-        def request_returned((informs, reply), reqmsg):
-            assert informs == []  # for now
-            # we *could* in theory just change message name, but let's copy
-            # just in case
-            self.send_reply(Message.reply(dev_name + "-" + req_name,
-                                          *reply.arguments), reqmsg)
-
-        def request_failed(failure, reqmsg):
-            self.send_reply(Message.reply(dev_name + '-' + req_name,
-                                          "fail", failure.getErrorMessage()),
-                            reqmsg)
-
-        def callback(msg):
-            if device.state is device.UNSYNCED:
-                return Message.reply(dev_name + "-" + req_name, "fail",
-                                     "Device not synced")
-            d = device.send_request(req_name, *msg.arguments)
-            d.addCallbacks(request_returned, request_failed,
-                           callbackArgs=(msg,), errbackArgs=(msg,))
-            raise AsyncReply()
+    def _request_unknown(self, msg):
+        """ Requests the proxy does not implement itself are forwarded to the
+        device they are routed to
+        """
+        route = self.factory.routes.get(msg.name)
+        if route is None:
+            dev_name = msg.name.split('-', 1)[0]
+            device = self.factory.devices.get(dev_name)
+            if device is not None and device.state != device.SYNCED:
+                return Message.reply(msg.name, "fail", "Device not synced")
+            return DeviceProtocol._request_unknown(self, msg)
+        device, req_name = route
+        if device.state != device.SYNCED:
+            return Message.reply(msg.name, "fail", "Device not synced")
+        d = device.send_request(req_name, *msg.arguments)
+        d.addCallbacks(self._forwarded_request_returned,
+                       self._forwarded_request_failed,
+                       callbackArgs=(msg,), errbackArgs=(msg,))
+        raise AsyncReply()
+
+    def _forwarded_request_returned(self, (informs, reply), reqmsg):
+        for inform in informs:
+            self.send_reply_inform(Message.inform(reqmsg.name,
+                                                  *inform.arguments), reqmsg)
+        self.send_reply(Message.reply(reqmsg.name, *reply.arguments), reqmsg)
 
-        if not attr.startswith('request_'):
-            return object.__getattribute__(self, attr)
-        lst = attr.split('_', 2)
-        if len(lst) < 3:
-            return object.__getattribute__(self, attr)
-        dev_name, req_name = lst[1], lst[2]
-        device = self.factory.devices.get(dev_name, None)
-        if device is None:
-            return object.__getattribute__(self, attr)
-        return callback
+    def _forwarded_request_failed(self, failure, reqmsg):
+        self.send_reply(Message.reply(reqmsg.name, "fail",
+                                      failure.getErrorMessage()), reqmsg)
 
 
 class ClientDeviceFactory(ClientFactory):
@@ -434,8 +958,28 @@ class ProxyKatCP(DeviceServer):
 
     MAX_RECONNECTS = 10
     CONN_DELAY_TIMEOUT = 1
+    # maximum age in seconds of a cached proxied sensor value before a live
+    # read is done instead, None disables the cache and the event
+    # subscriptions that feed it
+    SENSOR_CACHE_MAX_AGE = 5
+    # maximum number of devices introspected at the same time
+    SYNC_CONCURRENCY = 20
+    # seconds to wait for each reply while syncing a device before giving
+    # up its turn and reconnecting to it
+    SYNC_REQUEST_TIMEOUT = 30
+    # directory in which the ?help and ?sensor-list of devices are cached
+    # between runs, None disables the cache
+    SYNC_CACHE_DIR = None
 
     def __init__(self, *args, **kwds):
+        self.sensor_index = SensorIndex()
+        self.startup_started = time.time()
+        # seconds from creating the proxy until all devices were synced
+        self.startup_time = None
+        self.sync_semaphore = DeferredSemaphore(self.SYNC_CONCURRENCY)
+        self.sync_cache = None
+        if self.SYNC_CACHE_DIR is not None:
+            self.sync_cache = SyncCache(self.SYNC_CACHE_DIR)
         DeviceServer.__init__(self, *args, **kwds)
         self.addr_mapping = {}
         self.client_factory = ClientDeviceFactory(self.addr_mapping,
@@ -444,6 +988,9 @@ class ProxyKatCP(DeviceServer):
                                                   self)
         self.ready_devices = 0
         self.devices = {}
+        # map proxied request name -> (device, request name on the device)
+        self.routes = {}
+        self._device_routes = {}
         self.setup_devices()
         self.scan_called = False
 
@@ -451,6 +998,11 @@ class ProxyKatCP(DeviceServer):
         self.ready_devices += 1
         if self.ready_devices == len(self.devices) and not self.scan_called:
             self.scan_called = True  # one shot only
+            self.startup_time = time.time() - self.startup_started
+            cached = len([d for d in self.devices.itervalues()
+                          if d.sync_cached])
+            log.msg("Synced %d devices (%d from cache) in %.3f seconds" %
+                    (len(self.devices), cached, self.startup_time))
             self.devices_scan_complete()
 
     def add_device(self, device):
@@ -465,8 +1017,29 @@ class ProxyKatCP(DeviceServer):
 
         reactor.resolve(device.host).addCallback(really_add_device)
 
+    def update_routes(self, device):
+        """ Route <device>-<request> to the device for every request it
+        currently has
+        """
+        self.remove_routes(device.name)
+        names = []
+        for req_name in device.requests:
+            name = device.name + '-' + req_name
+            self.routes[name] = (device, req_name)
+            names.append(name)
+        self._device_routes[device.name] = names
+
+    def remove_routes(self, dev_name):
+        for name in self._device_routes.pop(dev_name, []):
+            del self.routes[name]
+
+    def add_sensor(self, sensor):
+        DeviceServer.add_sensor(self, sensor)
+        self.sensor_index.add(sensor.name)
+
     def add_proxied_sensor(self, device, sensor):
         self.sensors[sensor.name] = sensor
+        self.sensor_index.add(sensor.name)
 
     def devices_scan_complete(self):
         """ A callback called when devices are properly set up and read.
@@ -494,8 +1067,8 @@ class ProxyKatCP(DeviceServer):
     def unregister_device(self, dev_name):
         device = self.devices[dev_name]
         device.stopping = True
-        for name in self.sensors.keys():
-            if (name.startswith(dev_name + '.') or
-                name.startswith(dev_name + '-')):
+        for prefix in (dev_name + '.', dev_name + '-'):
+            for name in self.sensor_index.remove_prefix(prefix):
                 del self.sensors[name]
+        self.remove_routes(dev_name)
         del self.devices[dev_name]
@@ -1,7 +1,12 @@
 
 from twisted.internet import reactor
+from katcp.sampling import LatenessMonitor
+from twisted.python import threadable
+import logging
 import time
 
+log = logging.getLogger("katcp.sampling")
+
 
 class SamplingStrategy(object):
     """ Base class for all sampling strategies
@@ -116,3 +121,160 @@ class DifferentialStrategy(ObserverStrategy):
             self.protocol.send_sensor_status(sensor)
             self.status = newstatus
             self.value = newval
+
+
+class TwistedSampleReactor(LatenessMonitor):
+    """A sample reactor that schedules strategies on the twisted reactor.
+
+    A drop-in alternative to :class:`katcp.sampling.SampleReactor` for
+    device servers that are deployed alongside a running twisted reactor.
+    Rather than running a dedicated thread with its own heap, periodic
+    sampling is scheduled with the event loop's own timers (one delayed call
+    per strategy) and :meth:`SampleStrategy.periodic` is called from the
+    event loop thread. Strategies are attached, detached and scheduled from
+    the event loop thread too, whichever thread adds or removes them, so the
+    first sample of a new strategy may follow the reply that requested it.
+    Strategy updates triggered by sensor changes are still delivered in the
+    thread that sets the sensor, as with the threaded reactor, since
+    strategies read the sensor value when they are updated.
+
+    Pass it to :class:`katcp.DeviceServer` using the `sample_reactor_factory`
+    keyword argument.
+
+    Parameters
+    ----------
+    logger : logging.Logger object
+        Python logger to write logs to.
+    reactor : twisted reactor object
+        The reactor to schedule periodic samples on (defaults to the global
+        twisted reactor).
+    late_fraction : float
+        Log a warning when a periodic sample fires later than this fraction
+        of the strategy's period.
+    late_warning_interval : float
+        Minimum time between lateness warnings, in seconds.
+
+    Attributes
+    ----------
+    lateness : dict
+        Map from strategy name to a LatencyHistogram of how late its periodic
+        samples fired. Only the event loop thread updates it.
+    """
+
+    def __init__(self, logger=log, reactor=reactor, late_fraction=0.5,
+                 late_warning_interval=10.0):
+        self._logger = logger
+        self._reactor = reactor
+        self._time = reactor.seconds
+        # the strategies and the map strategy -> (IDelayedCall, scheduled
+        # time) are only touched in the reactor thread
+        self._strategies = set()
+        self._calls = {}
+        self._init_lateness(late_fraction, late_warning_interval)
+
+    def _call_in_loop(self, func, *args):
+        if threadable.isInIOThread():
+            func(*args)
+        else:
+            self._reactor.callFromThread(func, *args)
+
+    def start(self):
+        """Start the reactor (a no-op, scheduling is done by twisted)."""
+        pass
+
+    def stop(self):
+        """Cancel all outstanding periodic samples."""
+        self._call_in_loop(self._cancel_all)
+
+    def join(self, timeout=None):
+        """Join the reactor (a no-op, there is no thread to wait for)."""
+        pass
+
+    def heap_size(self):
+        """Return the number of scheduled periodic sampling events."""
+        return len(self._calls)
+
+    def add_strategy(self, strategy):
+        """Add a sensor strategy to the reactor.
+
+        The strategy is attached to its sensor and sampled for the first time
+        in the event loop thread.
+
+        Parameters
+        ----------
+        strategy : SampleStrategy object
+            The sampling strategy to add to the reactor.
+        """
+        self._call_in_loop(self._add, strategy)
+
+    def adjust_strategy_update_time(self, strategy, next_time):
+        """Called by a strategy if it needs to have a periodic update time adjusted"""
+        if next_time is not None:
+            self._call_in_loop(self._schedule, strategy, next_time)
+
+    def remove_strategy(self, strategy):
+        """Remove a strategy from the reactor.
+
+        The strategy is detached from its sensor in the event loop thread.
+
+        Parameters
+        ----------
+        strategy : SampleStrategy object
+            The sampling strategy to remove from the reactor.
+        """
+        self._call_in_loop(self._remove, strategy)
+
+    def _add(self, strategy):
+        self._strategies.add(strategy)
+        strategy.set_new_period_callback(self.adjust_strategy_update_time)
+        strategy.attach()
+        next_time = strategy.periodic(self._time())
+        if next_time is not None:
+            self._schedule(strategy, next_time)
+
+    def _remove(self, strategy):
+        strategy.detach()
+        self._strategies.remove(strategy)
+        self._cancel(strategy)
+
+    def _schedule(self, strategy, next_time):
+        if strategy not in self._strategies:
+            return
+        delay = max(0, next_time - self._time())
+        pending = self._calls.get(strategy)
+        if pending is None:
+            call = self._reactor.callLater(delay, self._fire, strategy)
+            self._calls[strategy] = (call, next_time)
+        elif next_time < pending[1]:
+            # Strategies suppress spurious updates themselves, so a single
+            # pending call at the earliest requested time is sufficient
+            call = pending[0]
+            call.reset(delay)
+            self._calls[strategy] = (call, next_time)
+
+    def _fire(self, strategy):
+        _call, timestamp = self._calls.pop(strategy)
+        if strategy not in self._strategies:
+            return
+        lateness = self._time() - timestamp
+        try:
+            next_time = strategy.periodic(timestamp)
+            if next_time is not None:
+                self._record_lateness(strategy, lateness,
+                                      next_time - timestamp)
+        except Exception, e:
+            self._logger.exception(e)
+            # try again in ten seconds and hope whatever was wrong sorts
+            # itself out
+            next_time = timestamp + 10.0
+        if next_time is not None:
+            self._schedule(strategy, next_time)
+
+    def _cancel(self, strategy):
+        pending = self._calls.pop(strategy, None)
+        if pending is not None:
+            pending[0].cancel()
+
+    def _cancel_all(self):
+        for strategy in list(self._calls):
+            self._cancel(strategy)
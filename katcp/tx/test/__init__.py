@@ -25,8 +25,10 @@ def suite():
     import unittest
     import test_core
     import test_proxy
+    import test_sampling
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     suite.addTests(loader.loadTestsFromModule(test_core))
     suite.addTests(loader.loadTestsFromModule(test_proxy))
+    suite.addTests(loader.loadTestsFromModule(test_sampling))
     return suite
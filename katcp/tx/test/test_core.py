@@ -1,17 +1,22 @@
 from katcp.tx.core import (ClientKatCPProtocol, DeviceServer, DeviceProtocol,
-                           KatCPClientFactory)
+                           KatCPClientFactory, RequestTimeout,
+                           UnhandledMessage)
 from katcp import Message, Sensor
 from katcp.tx.test.testserver import run_subprocess
 from twisted.trial.unittest import TestCase, SkipTest
 from twisted.internet import reactor
+from twisted.internet.task import Clock
 from twisted.internet.defer import Deferred, DeferredList
 from twisted.internet.protocol import ClientCreator
+from twisted.internet.error import ConnectionDone
+from twisted.test.proto_helpers import StringTransport
 from twisted.python import log
 
 from katcp.core import FailReply
 from katcp.testutils import TestLogHandler
 
 import logging
+import katcp.tx.core
 
 #DelayedCall.debug = True
 #Deferred.debug = True
@@ -58,7 +63,7 @@ class TestKatCP(PythonLoggingTestCase):
 
     def test_help(self):
         def received_help((msgs, reply_msg), protocol):
-            assert len(msgs) == 11
+            assert len(msgs) == 13
             requests = set(msg.arguments[0] for msg in msgs)
             assert 'help' in requests
             assert 'sensor-list' in requests
@@ -634,6 +639,202 @@ class TestClient(TestCase):
         return res
 
 
+class TestQueryMatching(TestCase):
+    def _connect(self, version_str=None):
+        protocol = ClientKatCPProtocol()
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        if version_str is not None:
+            protocol.dataReceived(
+                '#version-connect katcp-protocol %s\n' % version_str)
+        return protocol, transport
+
+    def _collect(self, d):
+        results = []
+        d.addCallback(results.append)
+        return results
+
+    def test_out_of_order_replies_with_ids(self):
+        protocol, transport = self._connect('5.0-IM')
+        first = self._collect(protocol.send_request('watchdog'))
+        second = self._collect(protocol.send_request('sensor-value', 'foo'))
+        self.assertEqual(transport.value(),
+                         '?watchdog[1]\n?sensor-value[2] foo\n')
+        protocol.dataReceived('#sensor-value[2] 0 1 foo nominal 3\n'
+                              '!sensor-value[2] ok 1\n')
+        self.assertEqual(first, [])
+        informs, reply = second[0]
+        self.assertEqual(reply, Message.reply('sensor-value', 'ok', '1',
+                                              mid='2'))
+        self.assertEqual([str(m) for m in informs],
+                         ['#sensor-value[2] 0 1 foo nominal 3'])
+        protocol.dataReceived('!watchdog[1] ok\n')
+        self.assertEqual(first[0][1], Message.reply('watchdog', 'ok', mid='1'))
+        self.assertEqual(protocol.queries, {})
+
+    def test_unclaimed_inform_with_ids(self):
+        protocol, transport = self._connect('5.0-IM')
+        result = self._collect(protocol.send_request('watchdog'))
+        self.assertRaises(UnhandledMessage, protocol.lineReceived,
+                          '#mystery 1')
+        self.assertRaises(UnhandledMessage, protocol.lineReceived,
+                          '#mystery[1] 1')
+        protocol.dataReceived('!watchdog[1] ok\n')
+        self.assertEqual(result[0], ([], Message.reply('watchdog', 'ok',
+                                                       mid='1')))
+
+    def test_fifo_without_ids(self):
+        protocol, transport = self._connect()
+        first = self._collect(protocol.send_request('watchdog'))
+        second = self._collect(protocol.send_request('help'))
+        self.assertEqual(transport.value(), '?watchdog\n?help\n')
+        protocol.dataReceived('!watchdog ok\n#help halt x\n!help ok 1\n')
+        self.assertEqual(first[0], ([], Message.reply('watchdog', 'ok')))
+        self.assertEqual(len(second[0][0]), 1)
+        self.assertEqual(len(protocol.fifo_queries), 0)
+
+    def test_streamed_informs(self):
+        protocol, transport = self._connect()
+        streamed = []
+        result = self._collect(protocol.send_request(
+            'sensor-value', inform_callback=streamed.append))
+        protocol.dataReceived('#sensor-value 0 1 foo nominal 3\n')
+        self.assertEqual(len(streamed), 1)
+        self.assertEqual(result, [])
+        protocol.dataReceived('#sensor-value 0 1 bar nominal 4\n'
+                              '!sensor-value ok 2\n')
+        self.assertEqual([m.arguments[2] for m in streamed], ['foo', 'bar'])
+        informs, reply = result[0]
+        self.assertEqual(list(informs), [])
+        self.assertEqual(reply, Message.reply('sensor-value', 'ok', '2'))
+
+    def test_connection_lost_errbacks_all(self):
+        protocol, transport = self._connect('5.0-IM')
+        failures = []
+        protocol.send_request('watchdog').addErrback(failures.append)
+        protocol.connectionLost(ConnectionDone())
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(protocol.queries, {})
+
+    def test_request_timeout_with_ids(self):
+        clock = Clock()
+        self.patch(katcp.tx.core, 'reactor', clock)
+        protocol, transport = self._connect('5.0-IM')
+        failures = []
+        protocol.send_request('watchdog', timeout=1).addErrback(
+            failures.append)
+        second = self._collect(protocol.send_request('help', timeout=5))
+        clock.advance(1.5)
+        self.assertEqual(len(failures), 1)
+        failures[0].trap(RequestTimeout)
+        self.assertEqual(protocol.timeouts, 1)
+        self.assertEqual(protocol.queries.keys(), ['2'])
+        # late reply is discarded, the outstanding request still matches
+        protocol.dataReceived('!watchdog[1] ok\n!help[2] ok 0\n')
+        self.assertEqual(second[0][1], Message.reply('help', 'ok', '0',
+                                                     mid='2'))
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_request_timeout_fifo(self):
+        clock = Clock()
+        self.patch(katcp.tx.core, 'reactor', clock)
+        protocol, transport = self._connect()
+        protocol.default_request_timeout = 1
+        failures = []
+        protocol.send_request('watchdog').addErrback(failures.append)
+        clock.advance(2)
+        self.assertEqual(len(failures), 1)
+        second = self._collect(protocol.send_request('watchdog'))
+        # the late reply belongs to the timed out request
+        protocol.dataReceived('!watchdog fail\n')
+        self.assertEqual(second, [])
+        protocol.dataReceived('!watchdog ok\n')
+        self.assertEqual(second[0], ([], Message.reply('watchdog', 'ok')))
+        self.assertEqual(len(protocol.fifo_queries), 0)
+        self.assertEqual(protocol.timeouts, 1)
+
+    def test_request_timeout_skips_unanswered(self):
+        clock = Clock()
+        self.patch(katcp.tx.core, 'reactor', clock)
+        protocol, transport = self._connect()
+        protocol.send_request('watchdog', timeout=1).addErrback(
+            lambda failure: None)
+        clock.advance(2)
+        second = self._collect(protocol.send_request('help'))
+        protocol.dataReceived('!help ok 0\n')
+        self.assertEqual(second[0], ([], Message.reply('help', 'ok', '0')))
+        self.assertEqual(len(protocol.fifo_queries), 0)
+
+
+class TestOutboundQueue(TestCase):
+    def _connect(self):
+        protocol = ClientKatCPProtocol()
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.pauseProducing()
+        return protocol, transport
+
+    def _status(self, name, value):
+        return Message.inform('sensor-status', '1.0', '1', name, 'nominal',
+                              str(value))
+
+    def test_coalescing(self):
+        protocol, transport = self._connect()
+        protocol.send_message(self._status('a', 1))
+        protocol.send_message(Message.inform('log', 'info'))
+        protocol.send_message(self._status('b', 1))
+        protocol.send_message(self._status('a', 2))
+        protocol.send_message(self._status('a', 3))
+        self.assertEqual(transport.value(), '')
+        self.assertEqual(protocol.coalesced, 2)
+        protocol.resumeProducing()
+        self.assertEqual(transport.value().splitlines(), [
+            '#sensor-status 1.0 1 a nominal 3', '#log info',
+            '#sensor-status 1.0 1 b nominal 1'])
+        self.assertEqual(len(protocol.queue), 0)
+        self.assertEqual(protocol.queued_status, {})
+
+    def test_drop(self):
+        protocol, transport = self._connect()
+        protocol.MAX_QUEUED = 2
+        for i in range(4):
+            protocol.send_message(Message.inform('log', str(i)))
+        self.assertEqual(protocol.dropped, 2)
+        protocol.resumeProducing()
+        self.assertEqual(transport.value(), '#log 0\n#log 1\n')
+        self.assertTrue(transport.connected)
+
+    def test_disconnect(self):
+        protocol, transport = self._connect()
+        protocol.MAX_QUEUED = 1
+        protocol.QUEUE_OVERFLOW = 'disconnect'
+        protocol.send_message(Message.inform('log', '0'))
+        protocol.send_message(Message.inform('log', '1'))
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(len(protocol.queue), 0)
+        protocol.send_message(Message.inform('log', '2'))
+        self.assertEqual(len(protocol.queue), 0)
+
+    def test_pause_while_resuming(self):
+        protocol, transport = self._connect()
+        for i in range(3):
+            protocol.send_message(Message.inform('log', str(i)))
+        transport.write = lambda data: protocol.pauseProducing()
+        protocol.resumeProducing()
+        self.assertEqual(len(protocol.queue), 2)
+
+    def test_queue_sensors(self):
+        class QueueDevice(DeviceServer):
+            QUEUE_SENSORS = True
+
+        device = QueueDevice(0, '')
+        device.queue_event('dropped')
+        device.queue_event('dropped')
+        self.assertEqual(device.sensors['outbound-dropped'].value(), 2)
+        self.assertEqual(device.sensors['outbound-coalesced'].value(), 0)
+        self.assertEqual(device.sensors['outbound-disconnected'].value(), 0)
+
+
 class TestMisc(TestCase):
     def test_requests(self):
         # Test that the twisted DeviceProtocol has the same requests as the
@@ -1,12 +1,20 @@
 
 from katcp.tx.core import DeviceServer, ClientKatCPProtocol
-from katcp.tx.proxy import ProxyKatCP, DeviceHandler, DeviceProtocol
+from katcp.tx.proxy import (ProxyKatCP, DeviceHandler, DeviceProtocol,
+                            ProxiedSensor, SensorIndex, SyncCache,
+                            literal_prefix, tightest_strategy)
 from twisted.trial.unittest import TestCase, SkipTest
 from twisted.internet.protocol import ClientCreator
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.error import ConnectionDone
 from katcp import Sensor, Message
 from katcp.kattypes import request, return_reply, Int
 from twisted.internet import reactor
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet.task import Clock
+import katcp.tx.core
+import shutil
+import tempfile
 
 timeout = 5
 #Deferred.debug = True
@@ -141,12 +149,12 @@ class TestProxyBase(TestCase):
 
     def test_all_forwarded_sensors(self):
         def callback((informs, reply)):
-            self.assertEquals(informs[2:],
+            self.assertEquals(informs[4:],
                   [Message.inform('sensor-value', '1.000000', '1',
                                   'device.sensor1', 'unknown', '0'),
                    Message.inform('sensor-value', '0.000000', '1', 'device.sensor2',
                                   'unknown', '0')])
-            self.assertEquals(reply, Message.reply('sensor-value', 'ok', '4'))
+            self.assertEquals(reply, Message.reply('sensor-value', 'ok', '6'))
 
         return self._base_test(('sensor-value',), callback)
 
@@ -174,10 +182,18 @@ class TestProxyBase(TestCase):
 
         return self._base_test(('sensor-value', 'device-state',), callback)
 
+    def test_request_timeouts_sensor(self):
+        def callback((informs, reply)):
+            assert len(informs) == 1
+            assert informs[0].arguments[3:] == ['ok', '0']
+
+        return self._base_test(('sensor-value', 'device-request-timeouts'),
+                               callback)
+
     def test_sensor_list(self):
         def callback((informs, reply)):
-            assert len(informs) == 4
-            assert reply == Message.reply('sensor-list', 'ok', '4')
+            assert len(informs) == 6
+            assert reply == Message.reply('sensor-list', 'ok', '6')
 
         return self._base_test(('sensor-list',), callback)
 
@@ -244,6 +260,61 @@ class TestProxyBase(TestCase):
 
         return self._base_test(None, callback)
 
+    def test_sensor_cache(self):
+        def check_cache():
+            device = self.proxy.devices['device']
+            sensors = sorted(device.sensors.itervalues(),
+                             key=lambda sensor: sensor.name)
+            assert all(sensor.cache_fresh() for sensor in sensors)
+            self.assertEquals([(sensor.name,) + sensor.cached_formatted[1:]
+                               for sensor in sensors],
+                              [('device.sensor1', 'unknown', '0'),
+                               ('device.sensor2', 'unknown', '0')])
+            self.example_device.sensors['sensor1'].set_value(7)
+            reactor.callLater(0.1, check_update)
+
+        def check_update():
+            sensor = self.proxy.sensors['device.sensor1']
+            self.assertEquals(sensor.read_formatted()[1:], ('nominal', '7'))
+            self.port.stopListening()
+            self.proxy.stop()
+            self.finish.callback(None)
+
+        def callback(_):
+            reactor.callLater(0.1, check_cache)
+            return True
+
+        return self._base_test(None, callback)
+
+    def test_help_proxied_requests(self):
+        def callback((informs, reply)):
+            names = [inform.arguments[0] for inform in informs]
+            self.assertEquals(reply, Message.reply('help', 'ok',
+                                                   str(len(informs))))
+            self.assertTrue('sensor-list' in names)
+            self.assertTrue('device-req' in names)
+            self.assertTrue('device-sensor-list' in names)
+            self.assertFalse('device2-req' in names)
+
+        return self._base_test(('help',), callback)
+
+    def test_help_one_proxied_request(self):
+        def callback((informs, reply)):
+            self.assertEquals(informs[0].arguments[0], 'device-watchdog')
+            self.assertTrue('alive' in informs[0].arguments[1])
+            self.assertEquals(reply, Message.reply('help', 'ok', '1'))
+
+        return self._base_test(('help', 'device-watchdog'), callback)
+
+    def test_forwarding_request_with_dashes(self):
+        def callback((informs, reply)):
+            self.assertEquals(reply, Message.reply('device-sensor-list',
+                                                   'ok', '1'))
+            self.assertEquals(informs[0].name, 'device-sensor-list')
+            self.assertEquals(informs[0].arguments[0], 'sensor1')
+
+        return self._base_test(('device-sensor-list', 'sensor1'), callback)
+
     def test_halt(self):
         def callback((informs, reply)):
             self.assertEquals(reply, Message.reply('halt', 'device', 'ok'))
@@ -252,6 +323,296 @@ class TestProxyBase(TestCase):
         return self._base_test(('halt', 'device'), callback)
 
 
+class FakeDevice(object):
+    name = 'device'
+
+    def __init__(self):
+        self.requests = []
+        self.subscribed = set()
+
+    def send_request(self, *args):
+        self.requests.append(args)
+        d = Deferred()
+        d.callback(([Message.inform('sensor-value', '2.000000', '1',
+                                    'sensor1', 'nominal', '4')],
+                     Message.reply('sensor-value', 'ok', '1')))
+        return d
+
+
+class TestProxiedSensorCache(TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.sensor = ProxiedSensor('sensor1', 'descr', 'count', 'integer',
+                                    self.device, ExampleProxy, '0', '10')
+
+    def test_stale_read(self):
+        results = []
+        self.sensor.read_formatted().addCallback(results.append)
+        self.assertEquals(self.device.requests,
+                          [('sensor-value', 'sensor1')])
+        self.assertEquals(len(results), 1)
+        # the live read refreshed the cache
+        self.assertEquals(self.sensor.read_formatted(),
+                          ('2.000000', 'nominal', '4'))
+        self.assertEquals(len(self.device.requests), 1)
+
+    def test_fresh_read(self):
+        self.sensor.set_formatted('1.000000', 'warn', '3')
+        self.assertEquals(self.sensor.read_formatted(),
+                          ('1.000000', 'warn', '3'))
+        self.assertEquals(self.sensor.value(), 3)
+        self.assertEquals(self.device.requests, [])
+
+    def test_expired_read(self):
+        self.sensor.set_formatted('1.000000', 'warn', '3')
+        self.sensor.cached_at -= ExampleProxy.SENSOR_CACHE_MAX_AGE + 1
+        self.sensor.read_formatted()
+        self.assertEquals(len(self.device.requests), 1)
+
+    def test_invalidate(self):
+        self.sensor.set_formatted('1.000000', 'warn', '3')
+        self.sensor.invalidate_cache()
+        self.sensor.read_formatted()
+        self.assertEquals(len(self.device.requests), 1)
+
+
+class NoCacheProxy(object):
+    SENSOR_CACHE_MAX_AGE = None
+
+
+class TestSamplingAggregation(TestCase):
+    def setUp(self):
+        self.device = DeviceHandler('device', 'localhost', 1)
+        self.device.proxy = NoCacheProxy
+        self.transport = StringTransport()
+        # skip connectionMade, which starts syncing the device
+        self.device.transport = self.transport
+        self.device.state = DeviceHandler.SYNCED
+
+    def test_tightest_strategy(self):
+        self.assertEquals(tightest_strategy([]), ('none',))
+        self.assertEquals(tightest_strategy([('period', '1'),
+                                             ('period', '0.5')]),
+                          ('period', '0.5'))
+        self.assertEquals(tightest_strategy([('period', '1'),
+                                             ('differential', '2')]),
+                          ('event',))
+        self.assertEquals(tightest_strategy([('event',), ('auto',)]),
+                          ('auto',))
+
+    def test_one_upstream_subscription(self):
+        self.device.set_downstream_sampling('sensor1', 'a', ('period', '1'))
+        self.device.set_downstream_sampling('sensor1', 'b', ('period', '0.1'))
+        self.device.set_downstream_sampling('sensor1', 'c', ('period', '0.5'))
+        self.assertEquals(self.transport.value(),
+                          '?sensor-sampling sensor1 period 1\n'
+                          '?sensor-sampling sensor1 period 0.1\n')
+        self.device.dataReceived('!sensor-sampling ok sensor1 period 1\n'
+                                 '!sensor-sampling ok sensor1 period 0.1\n')
+        self.assertEquals(self.device.subscribed, set(['sensor1']))
+        self.transport.clear()
+        self.device.set_downstream_sampling('sensor1', 'b', ('none',))
+        self.device.set_downstream_sampling('sensor1', 'a', ('none',))
+        self.device.set_downstream_sampling('sensor1', 'c', ('none',))
+        self.assertEquals(self.transport.value(),
+                          '?sensor-sampling sensor1 period 0.5\n'
+                          '?sensor-sampling sensor1 none\n')
+        self.device.dataReceived('!sensor-sampling ok sensor1 period 0.5\n'
+                                 '!sensor-sampling ok sensor1 none\n')
+        self.assertEquals(self.device.subscribed, set())
+        self.assertEquals(self.device.downstream_sampling, {})
+
+    def test_failed_subscription(self):
+        self.device.set_downstream_sampling('sensor1', 'a', ('event',))
+        self.device.dataReceived('!sensor-sampling fail Unknown\_sensor.\n')
+        self.assertEquals(self.device.subscribed, set())
+
+
+class TestSensorIndex(TestCase):
+    def setUp(self):
+        self.index = SensorIndex()
+        for name in ['b.temp', 'a.volt', 'a.temp', 'a-state', 'ab.volt']:
+            self.index.add(name)
+
+    def test_literal_prefix(self):
+        self.assertEquals(literal_prefix('device\.sensor1'), 'device.sensor1')
+        self.assertEquals(literal_prefix('dev.*'), 'dev')
+        self.assertEquals(literal_prefix('devx?'), 'dev')
+        self.assertEquals(literal_prefix('dev+'), 'dev')
+        self.assertEquals(literal_prefix('de\dv'), 'de')
+        self.assertEquals(literal_prefix('a|b'), '')
+        self.assertEquals(literal_prefix('(?i)dev'), '')
+
+    def test_names(self):
+        self.assertEquals(self.index.names(), ['a-state', 'a.temp', 'a.volt',
+                                               'ab.volt', 'b.temp'])
+        self.index.add('a.a')
+        self.index.add('a.a')
+        self.index.remove('b.temp')
+        self.assertEquals(self.index.names(), ['a-state', 'a.a', 'a.temp',
+                                               'a.volt', 'ab.volt'])
+
+    def test_remove_prefix(self):
+        self.assertEquals(self.index.remove_prefix('a.'), ['a.temp', 'a.volt'])
+        self.assertEquals(self.index.remove_prefix('c.'), [])
+        self.index.add('a.x')
+        self.assertEquals(self.index.names(), ['a-state', 'a.x', 'ab.volt',
+                                               'b.temp'])
+        self.assertEquals(self.index.remove_prefix('a-'), ['a-state'])
+        self.assertEquals(self.index.match('a'), ['a.x', 'ab.volt'])
+
+    def test_match(self):
+        self.assertEquals(self.index.match('a\.'), ['a.temp', 'a.volt'])
+        self.assertEquals(self.index.match('^a.*volt'), ['a.volt', 'ab.volt'])
+        self.assertEquals(self.index.match('.*temp'), ['a.temp', 'b.temp'])
+
+    def test_search(self):
+        self.assertEquals(self.index.search('temp'), ['a.temp', 'b.temp'])
+        self.assertEquals(self.index.search('^b'), ['b.temp'])
+
+    def test_pattern_cache(self):
+        self.assertTrue(self.index.compile('a.*') is self.index.compile('a.*'))
+
+
+def cache_dir(test):
+    """Create a temporary directory removed when the test finishes."""
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory, True)
+    return directory
+
+
+class TestSyncCache(TestCase):
+    def test_roundtrip(self):
+        cache = SyncCache(cache_dir(self))
+        self.assertEquals(cache.get('device', 'build-1.0'), None)
+        cache.put('device', 'build-1.0', [['help', 'descr']],
+                  [['sensor1', 'descr', 'count', 'integer', '0', '10']])
+        self.assertEquals(cache.get('device', 'build-1.0'),
+                          ([['help', 'descr']],
+                           [['sensor1', 'descr', 'count', 'integer', '0',
+                             '10']]))
+        help_args, sensor_list_args = cache.get('device', 'build-1.0')
+        self.assertEquals(set(type(arg)
+                              for args in help_args + sensor_list_args
+                              for arg in args), set([str]))
+        self.assertEquals(cache.get('device', 'build-1.1'), None)
+        self.assertEquals(cache.get('other', 'build-1.0'), None)
+
+
+class SyncProxy(object):
+    SENSOR_CACHE_MAX_AGE = None
+    SYNC_REQUEST_TIMEOUT = None
+    sync_cache = None
+
+    def __init__(self):
+        self.sync_semaphore = DeferredSemaphore(1)
+        self.ready = []
+
+    def add_sensor(self, sensor):
+        pass
+
+    def add_proxied_sensor(self, device, sensor):
+        pass
+
+    def device_ready(self, device):
+        self.ready.append(device.name)
+
+    def update_routes(self, device):
+        self.routed = list(device.requests)
+
+
+class TestParallelSync(TestCase):
+    def _device(self, name, proxy):
+        device = DeviceHandler(name, 'localhost', 1)
+        device.add_proxy(proxy)
+        device.makeConnection(StringTransport())
+        return device
+
+    def test_concurrency_limit(self):
+        proxy = SyncProxy()
+        first = self._device('first', proxy)
+        second = self._device('second', proxy)
+        self.assertEquals(first.transport.value(), '?help\n?sensor-list\n')
+        self.assertEquals(second.transport.value(), '')
+        first.dataReceived('#help watchdog descr\n!help ok 1\n'
+                           '#sensor-list sensor1 descr count integer 0 10\n'
+                           '!sensor-list ok 1\n')
+        self.assertEquals(first.requests, ['watchdog'])
+        self.assertEquals(first.sensors.keys(), ['sensor1'])
+        self.assertEquals(proxy.ready, ['first'])
+        self.assertEquals(second.transport.value(), '?help\n?sensor-list\n')
+
+    def test_sync_timeout(self):
+        clock = Clock()
+        self.patch(katcp.tx.core, 'reactor', clock)
+        proxy = SyncProxy()
+        proxy.SYNC_REQUEST_TIMEOUT = 5
+        first = self._device('first', proxy)
+        second = self._device('second', proxy)
+        self.assertEquals(second.transport.value(), '')
+        # a device that never replies gives up its turn and reconnects
+        clock.advance(5)
+        self.assertTrue(first.transport.disconnecting)
+        self.assertEquals(second.transport.value(), '?help\n?sensor-list\n')
+        second.dataReceived('!help ok 0\n!sensor-list ok 0\n')
+        self.assertEquals(proxy.ready, ['second'])
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+    def test_lost_while_waiting(self):
+        proxy = SyncProxy()
+        first = self._device('first', proxy)
+        second = self._device('second', proxy)
+        first.stopping = second.stopping = True
+        second.connectionLost(ConnectionDone())
+        first.connectionLost(ConnectionDone())
+        self.assertEquals(second.transport.value(), '')
+        self.assertEquals(proxy.sync_semaphore.tokens, 1)
+
+    def test_cached_sync(self):
+        proxy = SyncProxy()
+        proxy.sync_cache = SyncCache(cache_dir(self))
+        device = self._device('device', proxy)
+        device.dataReceived('#version-connect katcp-device dev-1.0 '
+                            'build-1.0\n')
+        self.assertEquals(device.transport.value(), '?watchdog\n')
+        device.dataReceived('!watchdog ok\n'
+                            '#help watchdog descr\n!help ok 1\n'
+                            '#sensor-list sensor1 descr count integer 0 10\n'
+                            '!sensor-list ok 1\n')
+        self.assertFalse(device.sync_cached)
+        device.stopping = True
+        device.connectionLost(ConnectionDone())
+
+        device = self._device('device', proxy)
+        device.dataReceived('#version-connect katcp-device dev-1.0 '
+                            'build-1.0\n!watchdog ok\n')
+        self.assertEquals(device.transport.value(), '?watchdog\n')
+        self.assertTrue(device.sync_cached)
+        self.assertEquals(device.state, DeviceHandler.SYNCED)
+        self.assertEquals(device.requests, ['watchdog'])
+        self.assertEquals(device.sensors['sensor1'].params, [0, 10])
+
+
+class TestInterfaceChanged(TestCase):
+    def test_refresh_requests(self):
+        proxy = SyncProxy()
+        device = DeviceHandler('device', 'localhost', 1)
+        device.add_proxy(proxy)
+        device.makeConnection(StringTransport())
+        device.dataReceived('#help watchdog descr\n!help ok 1\n'
+                            '!sensor-list ok 0\n')
+        self.assertEquals(proxy.routed, ['watchdog'])
+        device.transport.clear()
+        device.dataReceived('#interface-changed request new-req added\n')
+        self.assertEquals(device.transport.value(), '?help\n')
+        device.dataReceived('#help new-req descr\n#help watchdog descr\n'
+                            '!help ok 2\n')
+        self.assertEquals(proxy.routed, ['new-req', 'watchdog'])
+        device.transport.clear()
+        device.dataReceived('#interface-changed sensor foo added\n')
+        self.assertEquals(device.transport.value(), '')
+
+
 class RogueSensor(object):
     description = 'descr'
     units = 'some'
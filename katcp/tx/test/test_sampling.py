@@ -0,0 +1,147 @@
+import mock
+from katcp import Sensor, sampling
+from katcp.tx.sampling import TwistedSampleReactor
+from katcp.testutils import DeviceTestSensor
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+
+class LoopClock(Clock):
+    """ A Clock that pretends to be the reactor thread
+    """
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class QueueClock(Clock):
+    """ A Clock that queues calls from other threads until run_pending()
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.pending = []
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.pending.append((f, args, kwargs))
+
+    def run_pending(self):
+        pending, self.pending = self.pending, []
+        for f, args, kwargs in pending:
+            f(*args, **kwargs)
+
+
+class TestTwistedSampleReactor(TestCase):
+    def setUp(self):
+        self.clock = LoopClock()
+        self.clock.advance(1000)
+        self.reactor = TwistedSampleReactor(reactor=self.clock)
+        self.reactor.start()
+        self.sensor = DeviceTestSensor(
+            Sensor.INTEGER, "an.int", "An integer.", "count", [-4, 3],
+            timestamp=12345, status=Sensor.NOMINAL, value=3)
+        self.calls = []
+
+        def inform(sensor_name, timestamp, status, value):
+            self.calls.append((self.clock.seconds(), value))
+        self.inform = inform
+
+    def test_periodic(self):
+        strat = sampling.SamplePeriod(self.inform, self.sensor, 10)
+        self.reactor.add_strategy(strat)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        for i in range(5):
+            self.clock.advance(10)
+        self.assertEqual([t for t, v in self.calls],
+                         [1000 + i * 10 for i in range(6)])
+        self.reactor.remove_strategy(strat)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(100)
+        self.assertEqual(len(self.calls), 6)
+
+    def test_event_rate(self):
+        strat = sampling.SampleEventRate(self.inform, self.sensor, 1, 10)
+        strat._time = self.clock.seconds
+        self.reactor.add_strategy(strat)
+        self.assertEqual(len(self.calls), 1)
+        # A change within the shortest period is delayed until it expires
+        self.sensor.set_value(2, timestamp=self.clock.seconds())
+        self.assertEqual(len(self.calls), 1)
+        # Only one delayed call is kept per strategy
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.calls[1], (1001, '2'))
+        self.clock.advance(10)
+        self.assertEqual(self.calls[2], (1011, '2'))
+        self.reactor.remove_strategy(strat)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop(self):
+        for period in (1, 2, 3):
+            self.reactor.add_strategy(
+                sampling.SamplePeriod(self.inform, self.sensor, period))
+        self.assertEqual(len(self.clock.getDelayedCalls()), 3)
+        self.reactor.stop()
+        self.reactor.join()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_late_warning(self):
+        logger = mock.Mock()
+        self.reactor = TwistedSampleReactor(logger=logger, reactor=self.clock)
+        strat = sampling.SamplePeriod(self.inform, self.sensor, 10)
+        self.reactor.add_strategy(strat)
+        self.clock.advance(4)
+        self.clock.advance(6)
+        self.assertFalse(logger.warn.called)
+        self.assertEqual(self.reactor.lateness['period'].count, 1)
+        # fires 6s late for a 10s period
+        self.clock.advance(16)
+        self.assertEqual(logger.warn.call_count, 1)
+        self.assertTrue("fired late" in logger.warn.call_args[0][0])
+        # further late samples are counted but not logged until the
+        # warning interval expires
+        self.clock.advance(16)
+        self.assertEqual(logger.warn.call_count, 1)
+        self.assertEqual(self.reactor._late_samples, 1)
+        self.assertEqual(self.reactor.lateness['period'].count, 4)
+
+
+class TestTwistedSampleReactorFromThread(TestCase):
+    def setUp(self):
+        self.clock = QueueClock()
+        self.clock.advance(1000)
+        self.reactor = TwistedSampleReactor(reactor=self.clock)
+        self.sensor = DeviceTestSensor(
+            Sensor.INTEGER, "an.int", "An integer.", "count", [-4, 3],
+            timestamp=12345, status=Sensor.NOMINAL, value=3)
+        self.calls = []
+
+        def inform(sensor_name, timestamp, status, value):
+            self.calls.append((self.clock.seconds(), value))
+        self.inform = inform
+        patcher = mock.patch('katcp.tx.sampling.threadable.isInIOThread',
+                             return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_add_in_loop(self):
+        strat = sampling.SampleAuto(self.inform, self.sensor)
+        self.reactor.add_strategy(strat)
+        # nothing is attached or sampled outside the event loop
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.sensor._observers, set())
+        self.clock.run_pending()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.sensor._observers, set([strat]))
+        self.reactor.remove_strategy(strat)
+        self.assertEqual(self.sensor._observers, set([strat]))
+        self.clock.run_pending()
+        self.assertEqual(self.sensor._observers, set())
+
+    def test_remove_before_added(self):
+        strat = sampling.SamplePeriod(self.inform, self.sensor, 10)
+        self.reactor.add_strategy(strat)
+        self.reactor.remove_strategy(strat)
+        self.clock.run_pending()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.reactor.heap_size(), 0)
+        self.assertEqual(self.sensor._observers, set())